@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""
+
+A stand-in for a daemonized unicorn or gunicorn master, for exercising the
+herder's reload path without a real application server.
+
+It understands just enough of their command lines to be run by the herder::
+
+    fakeunicorn.py -D -P unicorn.pid  -w 4 --bind 127.0.0.1:8080
+    fakeunicorn.py -D -p gunicorn.pid -w 4 --bind 127.0.0.1:8080
+
+Being given ``-P`` selects unicorn's signal semantics, and ``-p`` gunicorn's
+(or use ``--flavour`` to choose explicitly):
+
+    USR2       re-exec a new master, handing over the listen socket. The old
+               master's pidfile is renamed to PIDFILE.oldbin. A new unicorn
+               writes PIDFILE; a new gunicorn writes PIDFILE.2, and renames
+               it to PIDFILE once the old master has gone.
+    WINCH      gracefully stop all workers
+    TTIN/TTOU  add/remove a worker
+    QUIT       graceful shutdown (unicorn), quick shutdown (gunicorn)
+    TERM       quick shutdown (unicorn), graceful shutdown (gunicorn)
+
+Workers answer every HTTP request on the listen socket with a tiny response
+naming their PID.
+
+"""
+import argparse
+import errno
+import os
+import select
+import signal
+import socket
+import sys
+import time
+
+LISTEN_FD_ENV = 'FAKEUNICORN_FD'
+OLD_MASTER_ENV = 'FAKEUNICORN_OLD_MASTER'
+
+parser = argparse.ArgumentParser(description='Pretend to be a (g)unicorn master.')
+parser.add_argument('-D', '--daemonize', action='store_true')
+parser.add_argument('-P', dest='unicorn_pidfile', metavar='PATH')
+parser.add_argument('-p', dest='gunicorn_pidfile', metavar='PATH')
+parser.add_argument('--flavour', choices=['unicorn', 'gunicorn'])
+parser.add_argument('-w', '--workers', type=int, default=2)
+parser.add_argument('--bind', default='127.0.0.1:8080', metavar='HOST:PORT')
+parser.add_argument('--boot-time', type=float, default=0.2, metavar='SECONDS',
+                    help='How long the master takes to load the "application"')
+parser.add_argument('--worker-boot-time', type=float, default=0.5, metavar='SECONDS',
+                    help='How long each worker takes before it starts accepting')
+parser.add_argument('--worker-memory', type=int, default=10, metavar='MB',
+                    help='How much memory each worker touches once booted')
+parser.add_argument('--request-time', type=float, default=0.01, metavar='SECONDS',
+                    help='How long each request takes to serve')
+
+
+class Worker(object):
+
+    def __init__(self, master, listener, opts):
+        self.master_pid = master
+        self.listener = listener
+        self.opts = opts
+        self.alive = True
+
+    def run(self):
+        graceful, quick = _shutdown_signals(self.opts.flavour)
+        signal.signal(graceful, self._stop)
+        signal.signal(quick, lambda signum, frame: os._exit(0))
+        signal.signal(signal.SIGINT, lambda signum, frame: os._exit(0))
+        for sig in (signal.SIGUSR2, signal.SIGWINCH, signal.SIGTTIN,
+                    signal.SIGTTOU, signal.SIGHUP):
+            signal.signal(sig, signal.SIG_IGN)
+
+        time.sleep(self.opts.worker_boot_time)
+        ballast = b'\x01' * (self.opts.worker_memory * 1024 * 1024)
+
+        while self.alive and os.getppid() == self.master_pid:
+            try:
+                ready, _, _ = select.select([self.listener], [], [], 0.2)
+            except (select.error, OSError):
+                continue
+            if not ready:
+                continue
+            try:
+                conn, _ = self.listener.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    continue
+                raise
+            self._serve(conn)
+
+        del ballast
+        os._exit(0)
+
+    def _stop(self, signum, frame):
+        self.alive = False
+
+    def _serve(self, conn):
+        conn.setblocking(True)
+        conn.settimeout(5)
+        try:
+            request = b''
+            while b'\r\n\r\n' not in request:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    return
+                request += chunk
+            time.sleep(self.opts.request_time)
+            body = ('%s\n' % os.getpid()).encode('ascii')
+            conn.sendall(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain\r\n'
+                         b'Content-Length: ' + str(len(body)).encode('ascii') +
+                         b'\r\nConnection: close\r\n\r\n' + body)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+
+class Master(object):
+
+    def __init__(self, opts, listener):
+        self.opts = opts
+        self.listener = listener
+        self.workers = set()
+        self.target = opts.workers
+        self.old_master = int(os.environ.pop(OLD_MASTER_ENV, 0))
+        self.stopping = None
+        self.signals = []
+
+        self.pidfile = opts.pidfile
+        if self.old_master and opts.flavour == 'gunicorn':
+            self.pidfile = opts.pidfile + '.2'
+
+    def run(self, ready=None):
+        for sig in (signal.SIGUSR2, signal.SIGWINCH, signal.SIGTTIN,
+                    signal.SIGTTOU, signal.SIGQUIT, signal.SIGTERM,
+                    signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, self._queue)
+
+        time.sleep(self.opts.boot_time)
+        _write_pidfile(self.pidfile)
+        if ready is not None:
+            os.write(ready, b'.')
+            os.close(ready)
+
+        while True:
+            self._handle_signals()
+            self._reap()
+
+            if self.stopping is not None and not self.workers:
+                self._exit()
+
+            if self.stopping is None:
+                while len(self.workers) < self.target:
+                    self._spawn_worker()
+                while len(self.workers) > self.target:
+                    self._signal_worker(self.workers.pop(), _shutdown_signals(self.opts.flavour)[0])
+
+            # A gunicorn which has outlived its predecessor takes over the
+            # main pidfile.
+            if (self.opts.flavour == 'gunicorn' and self.old_master
+                    and not _pid_exists(self.old_master)):
+                self.old_master = 0
+                os.rename(self.pidfile, self.opts.pidfile)
+                self.pidfile = self.opts.pidfile
+
+            time.sleep(0.05)
+
+    def _queue(self, signum, frame):
+        self.signals.append(signum)
+
+    def _handle_signals(self):
+        graceful, quick = _shutdown_signals(self.opts.flavour)
+        while self.signals:
+            signum = self.signals.pop(0)
+            if signum == signal.SIGUSR2:
+                self._reexec()
+            elif signum == signal.SIGWINCH:
+                self.target = 0
+            elif signum == signal.SIGTTIN:
+                self.target += 1
+            elif signum == signal.SIGTTOU:
+                self.target = max(self.target - 1, 0)
+            elif signum == graceful:
+                self.stopping = 'graceful'
+                for pid in self.workers:
+                    self._signal_worker(pid, graceful)
+            elif signum in (quick, signal.SIGINT):
+                self.stopping = 'quick'
+                for pid in self.workers:
+                    self._signal_worker(pid, signal.SIGKILL)
+
+    def _reexec(self):
+        oldbin = self.opts.pidfile + '.oldbin'
+        os.rename(self.pidfile, oldbin)
+        self.pidfile = oldbin
+        # Once we're being replaced ourselves, the main pidfile belongs to
+        # our successor, however long our own predecessor lingers.
+        self.old_master = 0
+
+        argv = [sys.executable, os.path.abspath(__file__)]
+        argv += [a for a in sys.argv[1:] if a not in ('-D', '--daemonize')]
+        env = dict(os.environ)
+        env[LISTEN_FD_ENV] = str(self.listener.fileno())
+        env[OLD_MASTER_ENV] = str(os.getpid())
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.execve(sys.executable, argv, env)
+            finally:
+                os._exit(1)
+
+    def _spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                Worker(os.getppid(), self.listener, self.opts).run()
+            finally:
+                os._exit(0)
+        self.workers.add(pid)
+
+    def _signal_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+    def _reap(self):
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            self.workers.discard(pid)
+
+    def _exit(self):
+        try:
+            os.unlink(self.pidfile)
+        except OSError:
+            pass
+        os._exit(0)
+
+
+def _shutdown_signals(flavour):
+    """Return the (graceful, quick) shutdown signals for a flavour."""
+    if flavour == 'gunicorn':
+        return signal.SIGTERM, signal.SIGQUIT
+    return signal.SIGQUIT, signal.SIGTERM
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _write_pidfile(path):
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write('%s\n' % os.getpid())
+    os.rename(tmp, path)
+
+
+def _listen(opts):
+    if LISTEN_FD_ENV in os.environ:
+        fd = int(os.environ.pop(LISTEN_FD_ENV))
+        listener = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(fd)
+    else:
+        host, port = opts.bind.rsplit(':', 1)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, int(port)))
+        listener.listen(128)
+    listener.setblocking(False)
+    if hasattr(listener, 'set_inheritable'):
+        listener.set_inheritable(True)
+    return listener
+
+
+def main():
+    opts = parser.parse_args()
+    opts.pidfile = opts.unicorn_pidfile or opts.gunicorn_pidfile
+    if opts.pidfile is None:
+        parser.error('one of -P or -p is required')
+    opts.pidfile = os.path.abspath(opts.pidfile)
+    if opts.flavour is None:
+        opts.flavour = 'unicorn' if opts.unicorn_pidfile else 'gunicorn'
+
+    listener = _listen(opts)
+
+    if not opts.daemonize:
+        Master(opts, listener).run()
+        return
+
+    # Like unicorn, only let the foreground process exit once the master is
+    # up and has written its pidfile.
+    r, w = os.pipe()
+    if os.fork() > 0:
+        os.close(w)
+        return 0 if os.read(r, 1) else 1
+
+    os.close(r)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    Master(opts, listener).run(ready=w)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""
+
+Measure how long a HUP-triggered hot-reload takes end to end, and what it
+costs, by running the real herder against fakeunicorn.py under HTTP load.
+
+    $ python benchmarks/reload_benchmark.py --flavour gunicorn --workers 4 \\
+          --reloads 3 -- --overlap 5
+
+Arguments after ``--`` are passed to unicornherder itself. For every reload we
+report:
+
+    reload     seconds from sending HUP to the old master exiting
+    new_pid    seconds from sending HUP to the new PID appearing in the pidfile
+    overlap    seconds during which both masters had live workers
+    peak_rss   peak RSS of the herder plus both process trees, in MB
+    requests   requests completed during the reload
+    failed     requests which failed during the reload
+    p99        99th percentile request latency during the reload, in ms
+
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import signal
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+FAKE = os.path.join(HERE, 'fakeunicorn.py')
+
+SAMPLE_INTERVAL = 0.02
+
+parser = argparse.ArgumentParser(description='Benchmark unicornherder hot-reloads.')
+parser.add_argument('--flavour', choices=['unicorn', 'gunicorn'], default='gunicorn')
+parser.add_argument('--workers', type=int, default=4)
+parser.add_argument('--reloads', type=int, default=3)
+parser.add_argument('--concurrency', type=int, default=4,
+                    help='Number of concurrent load-generating clients')
+parser.add_argument('--worker-boot-time', type=float, default=0.5, metavar='SECONDS')
+parser.add_argument('--worker-memory', type=int, default=10, metavar='MB')
+parser.add_argument('--request-time', type=float, default=0.01, metavar='SECONDS')
+parser.add_argument('--settle', type=float, default=1, metavar='SECONDS',
+                    help='Time to wait between reloads')
+parser.add_argument('--json', action='store_true',
+                    help='Print results as JSON lines rather than a table')
+parser.add_argument('herder_args', nargs=argparse.REMAINDER,
+                    help="Arguments for unicornherder, after '--'")
+
+
+class LoadGenerator(object):
+    """Keeps ``concurrency`` clients sending requests to ``address``."""
+
+    def __init__(self, address, concurrency):
+        self.address = address
+        self.concurrency = concurrency
+        self.results = []
+        self.running = False
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        self.running = True
+        for _ in range(self.concurrency):
+            thread = threading.Thread(target=self._client)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self.running = False
+        for thread in self._threads:
+            thread.join()
+
+    def between(self, start, end):
+        with self._lock:
+            return [r for r in self.results if start <= r[0] <= end]
+
+    def _client(self):
+        while self.running:
+            started = time.time()
+            ok = _request(self.address)
+            with self._lock:
+                self.results.append((started, time.time() - started, ok))
+
+
+def _request(address):
+    try:
+        sock = socket.create_connection(address, timeout=5)
+    except socket.error:
+        return False
+    try:
+        sock.sendall(b'GET / HTTP/1.0\r\nHost: benchmark\r\n\r\n')
+        response = b''
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+        return response.startswith(b'HTTP/1.0 200')
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _read_pid(pidfile):
+    for filename in (pidfile + '.2', pidfile, pidfile + '.oldbin'):
+        try:
+            with open(filename) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            continue
+    return None
+
+
+def _tree(pid):
+    try:
+        process = psutil.Process(pid)
+        return [process] + process.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return []
+
+
+def _rss(processes):
+    total = 0
+    for process in processes:
+        try:
+            total += process.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return total
+
+
+def _workers(pid, exclude=None):
+    try:
+        return len([c for c in psutil.Process(pid).children() if c.pid != exclude])
+    except psutil.NoSuchProcess:
+        return 0
+
+
+def _alive(pid):
+    try:
+        return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
+def _wait_for(predicate, timeout, what):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise RuntimeError('Timed out waiting for %s' % what)
+        time.sleep(SAMPLE_INTERVAL)
+
+
+def measure_reload(herder, pidfile, load, timeout=600):
+    old_pid = _read_pid(pidfile)
+    herder_process = psutil.Process(herder.pid)
+
+    started = time.time()
+    herder.send_signal(signal.SIGHUP)
+
+    new_pid = None
+    new_pid_at = None
+    overlap = 0.0
+    peak_rss = 0
+    last = started
+
+    while _alive(old_pid):
+        now = time.time()
+        if now - started > timeout:
+            raise RuntimeError('Reload did not finish within %s seconds' % timeout)
+
+        pid = _read_pid(pidfile)
+        if new_pid is None and pid not in (None, old_pid):
+            new_pid, new_pid_at = pid, now
+
+        processes = [herder_process] + _tree(old_pid)
+        if new_pid is not None:
+            processes += _tree(new_pid)
+            if _workers(old_pid, exclude=new_pid) and _workers(new_pid):
+                overlap += now - last
+        peak_rss = max(peak_rss, _rss(processes))
+
+        last = now
+        time.sleep(SAMPLE_INTERVAL)
+
+    finished = time.time()
+    results = load.between(started, finished)
+    latencies = sorted(r[1] for r in results)
+    p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+
+    return {
+        'reload': round(finished - started, 3),
+        'new_pid': round(new_pid_at - started, 3) if new_pid_at else None,
+        'overlap': round(overlap, 3),
+        'peak_rss': round(peak_rss / 1024.0 / 1024.0, 1),
+        'requests': len(results),
+        'failed': len([r for r in results if not r[2]]),
+        'p99': round(p99 * 1000, 1),
+    }
+
+
+def main():
+    opts = parser.parse_args()
+    herder_args = opts.herder_args
+    if herder_args and herder_args[0] == '--':
+        herder_args = herder_args[1:]
+
+    tmpdir = tempfile.mkdtemp(prefix='unicornherder-benchmark-')
+    pidfile = os.path.join(tmpdir, '%s.pid' % opts.flavour)
+    address = ('127.0.0.1', _free_port())
+
+    cmd = [sys.executable, '-m', 'unicornherder.command',
+           '-g' if opts.flavour == 'gunicorn' else '-b', FAKE,
+           '-p', pidfile] + herder_args + [
+           '--', '-w', str(opts.workers),
+           '--bind', '%s:%s' % address,
+           '--worker-boot-time', str(opts.worker_boot_time),
+           '--worker-memory', str(opts.worker_memory),
+           '--request-time', str(opts.request_time)]
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+
+    booted = time.time()
+    herder = subprocess.Popen(cmd, cwd=tmpdir, env=env)
+    load = LoadGenerator(address, opts.concurrency)
+
+    try:
+        _wait_for(lambda: _read_pid(pidfile) and _workers(_read_pid(pidfile)) >= opts.workers,
+                  60, 'unicorn to boot')
+        _wait_for(lambda: _request(address), 60, 'workers to accept requests')
+        print('Booted in %.3fs' % (time.time() - booted), file=sys.stderr)
+
+        load.start()
+        results = []
+        for i in range(opts.reloads):
+            time.sleep(opts.settle)
+            result = measure_reload(herder, pidfile, load)
+            result['n'] = i + 1
+            results.append(result)
+            _wait_for(lambda: _workers(_read_pid(pidfile)) >= opts.workers,
+                      60, 'workers after reload')
+    finally:
+        load.stop()
+        if herder.poll() is None:
+            herder.terminate()
+            herder.wait()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    columns = ['n', 'reload', 'new_pid', 'overlap', 'peak_rss', 'requests', 'failed', 'p99']
+    if opts.json:
+        for result in results:
+            print(json.dumps(result, sort_keys=True))
+    else:
+        print(''.join('%10s' % c for c in columns))
+        for result in results:
+            print(''.join('%10s' % result[c] for c in columns))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
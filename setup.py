@@ -4,12 +4,15 @@ from setuptools import setup, find_packages
 from unicornherder import __version__
 
 install_requires = [
-    'psutil>=0.5.1',
+    'psutil>=5.0',
 ]
 
 if sys.version_info < (2, 7):
     install_requires.append('argparse')
 
+if sys.version_info < (3, 3):
+    install_requires.append('monotonic')
+
 HERE = os.path.dirname(__file__)
 try:
     long_description = open(os.path.join(HERE, 'README.rst')).read()
@@ -38,7 +41,8 @@ setup(
 
     entry_points={
         'console_scripts': [
-            'unicornherder = unicornherder.command:main'
+            'unicornherder = unicornherder.command:main',
+            'unicornherderctl = unicornherder.control:main',
         ]
     }
 )
@@ -1,9 +1,69 @@
-import contextlib
+import itertools
 
 from nose.tools import assert_equal, assert_false, assert_raises, assert_true
 from mock import call, patch, MagicMock
 
-@contextlib.contextmanager
-def fake_timeout_fail(*args, **kwargs):
+def fake_clock(step=1):
+    """A monotonic clock which advances by ``step`` every time it's read."""
+    return itertools.count(0, step)
+
+
+def children_from_mocks():
+    """
+
+    Return a ``setup_module`` and ``teardown_module`` which, for the tests in
+    a module, have every ProcessTree ask processes for their children rather
+    than read them from /proc, where the PIDs given to mock processes may
+    well belong to real ones.
+
+    """
+    patcher = patch('unicornherder.snapshot.child_pids', return_value=None)
+    return patcher.start, patcher.stop
+
+
+def mock_process(pid, children=None, **returns):
+    """
+
+    Return a MagicMock standing in for psutil.Process ``pid``, whose
+    ``children()`` are ``children``. Every other keyword names a method and
+    what it returns, or raises if it's an exception: for instance
+    ``memory_info=MagicMock(rss=1024)`` or ``num_fds=psutil.AccessDenied()``.
+
+    """
+    process = MagicMock(pid=pid)
+    if children is not None:
+        process.children.return_value = list(children)
+    for method, value in returns.items():
+        if isinstance(value, Exception):
+            getattr(process, method).side_effect = value
+        else:
+            getattr(process, method).return_value = value
+    return process
+
+
+def fake_deadline_expired(deadline_mock):
     from unicornherder.timeout import TimeoutError
-    raise TimeoutError()
+    deadline_mock.return_value.expired.return_value = False
+    deadline_mock.return_value.remaining.return_value = 0
+    deadline_mock.return_value.check.side_effect = TimeoutError()
+
+
+def run_timers(herder, limit=10000, until=None):
+    """
+
+    Fire the herder's timers until there are none left, fast-forwarding the
+    monotonic clock to each one in turn. Returns the number of (fake) seconds
+    which passed. If ``until`` is given, stop as soon as it returns True.
+
+    """
+    from unicornherder import timeout
+    start = timeout.monotonic()
+    with patch('unicornherder.timeout.monotonic') as clock_mock:
+        clock_mock.return_value = start
+        for _ in range(limit):
+            if not len(herder.timers) or (until is not None and until()):
+                break
+            clock_mock.return_value += herder.timers.next_timeout()
+            herder.tree.refresh()
+            herder.timers.run()
+        return clock_mock.return_value - start
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import psutil
+
+from .helpers import children_from_mocks, mock_process
+from unicornherder.affinity import (AffinityError, WorkerPlacer, numa_nodes,
+                                    parse_cpulist)
+
+setup_module, teardown_module = children_from_mocks()
+
+
+def _master(*pids, **kwargs):
+    return mock_process(kwargs.get('pid', 100), [mock_process(pid) for pid in pids])
+
+
+def _affinity(master):
+    return dict((w.pid, w.cpu_affinity.call_args[0][0])
+                for w in master.children.return_value if w.cpu_affinity.called)
+
+
+class TestAffinity(unittest.TestCase):
+
+    def setUp(self):
+        self.sys = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.sys)
+
+    def _node(self, name, cpulist):
+        os.mkdir(os.path.join(self.sys, name))
+        with open(os.path.join(self.sys, name, 'cpulist'), 'w') as f:
+            f.write(cpulist + '\n')
+
+    def test_parse_cpulist(self):
+        assert parse_cpulist('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
+        assert parse_cpulist('\n') == []
+        self.assertRaises(AffinityError, parse_cpulist, 'a-b')
+
+    def test_numa_nodes(self):
+        assert numa_nodes(self.sys) is None
+        self._node('node10', '4-5')
+        self._node('node1', '2-3')
+        self._node('node0', '0-1')
+        os.mkdir(os.path.join(self.sys, 'power'))
+        assert numa_nodes(self.sys) == [[0, 1], [2, 3], [4, 5]]
+
+    def test_pins_to_cpus(self):
+        placer = WorkerPlacer('cpu', cpus=[0, 1, 2])
+        master = _master(101, 102, 103, 104)
+        assert placer.check(master) == [101, 102, 103, 104]
+        assert _affinity(master) == {101: [0], 102: [1], 103: [2], 104: [0]}
+
+        # Already pinned
+        assert placer.check(master) == []
+
+    def test_refills_gaps(self):
+        placer = WorkerPlacer('cpu', cpus=[0, 1, 2])
+        master = _master(101, 102, 103)
+        placer.check(master)
+
+        # Worker 102 died and the master forked 105 in its place
+        master.children.return_value[1] = mock_process(105)
+        assert placer.check(master) == [105]
+        assert _affinity(master)[105] == [1]
+
+    def test_spreads_across_masters(self):
+        placer = WorkerPlacer('cpu', cpus=[0, 1])
+        old, new = _master(101), _master(201, pid=200)
+        placer.check(old)
+        placer.check(new, old)
+        assert _affinity(new) == {201: [1]}
+
+    def test_skips_new_master(self):
+        placer = WorkerPlacer('cpu', cpus=[0, 1])
+        old, new = _master(101), _master(201, pid=200)
+        old.children.return_value.append(new)
+        assert placer.check(new, old) == [201, 101]
+        assert not new.cpu_affinity.called
+
+    def test_pins_to_nodes(self):
+        self._node('node0', '0-3')
+        self._node('node1', '4-7')
+        # Only some CPUs of node 1 are ours, and none of node 2
+        self._node('node2', '8-11')
+        placer = WorkerPlacer('node', node_dir=self.sys, cpus=[0, 1, 2, 3, 4, 5])
+        master = _master(101, 102, 103)
+        placer.check(master)
+        assert _affinity(master) == {101: [0, 1, 2, 3], 102: [4, 5], 103: [0, 1, 2, 3]}
+
+    def test_without_numa(self):
+        placer = WorkerPlacer('node', node_dir=self.sys, cpus=[0, 1])
+        assert placer.slots == [[0, 1]]
+
+    def test_access_denied(self):
+        placer = WorkerPlacer('cpu', cpus=[0, 1])
+        master = _master(101, 102)
+        master.children.return_value[0].cpu_affinity.side_effect = psutil.AccessDenied(101)
+        assert placer.check(master) == [102]
+        assert _affinity(master)[102] == [0]
+        assert placer.check(master) == []
+
+    def test_invalid(self):
+        self.assertRaises(AffinityError, WorkerPlacer, 'socket')
+        self.assertRaises(AffinityError, WorkerPlacer, 'cpu', cpus=[])
@@ -0,0 +1,82 @@
+import signal
+
+from .helpers import *
+from unicornherder.autoscale import Autoscaler
+
+setup_module, teardown_module = children_from_mocks()
+
+
+def _master(*cpu_seconds):
+    return mock_process(100, [mock_process(101 + i,
+                                           cpu_times=MagicMock(user=cpu, system=0))
+                              for i, cpu in enumerate(cpu_seconds)])
+
+
+@patch('unicornherder.autoscale.accept_queue')
+@patch('unicornherder.autoscale.monotonic')
+class TestAutoscaler(object):
+
+    def _sample(self, scaler, clock_mock, at, *cpu_seconds):
+        clock_mock.return_value = at
+        master = _master(*cpu_seconds)
+        return master, scaler.check(master)
+
+    def test_first_sample_does_nothing(self, clock_mock, queue_mock):
+        queue_mock.return_value = 0
+        scaler = Autoscaler(2, 4)
+        master, ret = self._sample(scaler, clock_mock, 0, 0, 0)
+        assert_equal(ret, 0)
+        assert_equal(master.send_signal.call_count, 0)
+
+    def test_scales_up_on_cpu(self, clock_mock, queue_mock):
+        queue_mock.return_value = 0
+        scaler = Autoscaler(2, 4)
+        self._sample(scaler, clock_mock, 0, 0, 0)
+        # Each worker used 9 of the last 10 seconds
+        master, ret = self._sample(scaler, clock_mock, 10, 9, 9)
+        assert_equal(ret, 1)
+        master.send_signal.assert_called_once_with(signal.SIGTTIN)
+
+    def test_scales_up_on_queue(self, clock_mock, queue_mock):
+        queue_mock.return_value = 5
+        scaler = Autoscaler(2, 4)
+        self._sample(scaler, clock_mock, 0, 0, 0)
+        master, ret = self._sample(scaler, clock_mock, 10, 5, 5)
+        assert_equal(ret, 1)
+
+    def test_scales_down_when_idle(self, clock_mock, queue_mock):
+        queue_mock.return_value = 0
+        scaler = Autoscaler(2, 4)
+        self._sample(scaler, clock_mock, 0, 0, 0, 0)
+        master, ret = self._sample(scaler, clock_mock, 10, 1, 1, 1)
+        assert_equal(ret, -1)
+        master.send_signal.assert_called_once_with(signal.SIGTTOU)
+
+    def test_hysteresis(self, clock_mock, queue_mock):
+        queue_mock.return_value = 0
+        scaler = Autoscaler(2, 4)
+        self._sample(scaler, clock_mock, 0, 0, 0, 0)
+        # 50% is between the thresholds
+        master, ret = self._sample(scaler, clock_mock, 10, 5, 5, 5)
+        assert_equal(ret, 0)
+
+    def test_respects_bounds(self, clock_mock, queue_mock):
+        queue_mock.return_value = 0
+        scaler = Autoscaler(2, 2)
+        self._sample(scaler, clock_mock, 0, 0, 0)
+        assert_equal(self._sample(scaler, clock_mock, 10, 10, 10)[1], 0)
+        assert_equal(self._sample(scaler, clock_mock, 20, 10, 10)[1], 0)
+
+    def test_restores_minimum(self, clock_mock, queue_mock):
+        queue_mock.return_value = 0
+        scaler = Autoscaler(2, 4)
+        master, ret = self._sample(scaler, clock_mock, 0, 0)
+        assert_equal(ret, 1)
+
+    def test_cooldown(self, clock_mock, queue_mock):
+        queue_mock.return_value = 0
+        scaler = Autoscaler(2, 4, cooldown=60)
+        self._sample(scaler, clock_mock, 0, 0, 0)
+        assert_equal(self._sample(scaler, clock_mock, 10, 9, 9)[1], 1)
+        assert_equal(self._sample(scaler, clock_mock, 20, 18, 18, 0)[1], 0)
+        assert_equal(self._sample(scaler, clock_mock, 80, 78, 78, 60)[1], 1)
@@ -0,0 +1,90 @@
+from .helpers import *
+from unicornherder.backlog import BacklogMonitor
+from unicornherder.netstat import ListenSocket
+
+
+def _sockets(*queues):
+    return [ListenSocket('127.0.0.1', 8080 + i, queue, 1000 + i)
+            for i, queue in enumerate(queues)]
+
+
+@patch('unicornherder.backlog.listen_overflows')
+@patch('unicornherder.backlog.listening_sockets')
+@patch('unicornherder.backlog.log')
+@patch('unicornherder.backlog.monotonic')
+class TestBacklogMonitor(object):
+
+    def test_sample(self, clock_mock, log_mock, sockets_mock, overflows_mock):
+        clock_mock.return_value = 0
+        sockets_mock.return_value = _sockets(3, 4)
+        overflows_mock.return_value = (5, 7)
+        monitor = BacklogMonitor(10)
+
+        sample = monitor.check(MagicMock(pid=123))
+        assert_equal((sample.queue, sample.overflows, sample.drops), (7, 5, 7))
+        assert_equal(list(monitor.samples), [sample])
+        sockets_mock.assert_called_once_with(123)
+
+    def test_warns_when_saturated(self, clock_mock, log_mock, sockets_mock, overflows_mock):
+        master = MagicMock(pid=123)
+        overflows_mock.return_value = None
+        monitor = BacklogMonitor(10, duration=5)
+
+        sockets_mock.return_value = _sockets(11)
+        for t in range(5):
+            clock_mock.return_value = t
+            monitor.check(master)
+        assert_equal(log_mock.warn.call_count, 0)
+
+        # Only once, however long it lasts
+        for t in range(5, 10):
+            clock_mock.return_value = t
+            monitor.check(master)
+        assert_equal(log_mock.warn.call_count, 1)
+        assert_true(monitor.warned)
+
+        sockets_mock.return_value = _sockets(10)
+        monitor.check(master)
+        assert_false(monitor.warned)
+        assert_equal(log_mock.info.call_count, 1)
+
+    def test_brief_spikes_are_ignored(self, clock_mock, log_mock, sockets_mock, overflows_mock):
+        master = MagicMock(pid=123)
+        overflows_mock.return_value = None
+        monitor = BacklogMonitor(0, duration=2)
+        for t, queue in enumerate([1, 1, 0, 1, 1, 0]):
+            clock_mock.return_value = t
+            sockets_mock.return_value = _sockets(queue)
+            monitor.check(master)
+        assert_equal(log_mock.warn.call_count, 0)
+
+    def test_warns_on_overflow(self, clock_mock, log_mock, sockets_mock, overflows_mock):
+        clock_mock.return_value = 0
+        master = MagicMock(pid=123)
+        sockets_mock.return_value = _sockets(0)
+        monitor = BacklogMonitor(10)
+
+        overflows_mock.return_value = (5, 7)
+        monitor.check(master)
+        monitor.check(master)
+        assert_equal(log_mock.warn.call_count, 0)
+
+        overflows_mock.return_value = (8, 10)
+        monitor.check(master)
+        assert_equal(log_mock.warn.call_count, 1)
+        assert_equal(log_mock.warn.call_args[0][2:4], (3, 3))
+
+    def test_history(self, clock_mock, log_mock, sockets_mock, overflows_mock):
+        clock_mock.return_value = 0
+        sockets_mock.return_value = _sockets(0)
+        overflows_mock.return_value = None
+        monitor = BacklogMonitor(10, history=3)
+        for _ in range(5):
+            monitor.check(MagicMock(pid=123))
+        assert_equal(len(monitor.samples), 3)
+
+    def test_unreadable(self, clock_mock, log_mock, sockets_mock, overflows_mock):
+        sockets_mock.side_effect = OSError(13, 'Permission denied')
+        monitor = BacklogMonitor(10)
+        assert_equal(monitor.check(MagicMock(pid=123)), None)
+        assert_equal(len(monitor.samples), 0)
@@ -0,0 +1,99 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from unicornherder.control import ControlError, ControlServer, main, request
+from unicornherder.events import Waiter
+
+
+class TestControlServer(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'control.sock')
+        self.waiter = Waiter()
+        self.requests = []
+
+    def tearDown(self):
+        self.waiter.close()
+        shutil.rmtree(self.dir)
+
+    def _handler(self, conn, words):
+        self.requests.append((conn, words))
+        if words == ['ping']:
+            conn.respond({'ok': True, 'pong': True})
+
+    def _request(self, command, until=None):
+        """Make a request from another thread while we run the loop."""
+        result = {}
+
+        def client():
+            try:
+                result['response'] = request(self.path, command, timeout=5)
+            except ControlError as e:
+                result['error'] = e
+
+        thread = threading.Thread(target=client)
+        thread.start()
+        for _ in range(100):
+            if not thread.is_alive():
+                break
+            self.waiter.wait(0.05)
+            if until is not None and until():
+                until = None
+        thread.join()
+        return result
+
+    def test_request(self):
+        server = ControlServer(self.path, self._handler)
+        server.start(self.waiter)
+        assert self._request('ping') == {'response': {'ok': True, 'pong': True}}
+        assert self.requests[0][1] == ['ping']
+        # The connection has been cleaned up
+        assert self.waiter.watchers == [server]
+
+    def test_deferred_response(self):
+        server = ControlServer(self.path, self._handler)
+        server.start(self.waiter)
+
+        def answer():
+            if self.requests:
+                self.requests[0][0].respond({'ok': True, 'done': 1})
+                return True
+
+        assert self._request('reload', until=answer) == {
+            'response': {'ok': True, 'done': 1}}
+
+    def test_close_answers_pending_requests(self):
+        server = ControlServer(self.path, self._handler)
+        server.start(self.waiter)
+
+        def close():
+            if self.requests:
+                server.close()
+                return True
+
+        result = self._request('reload', until=close)
+        assert result['response']['ok'] is False
+        assert not os.path.exists(self.path)
+        assert self.waiter.watchers == []
+
+    def test_replaces_stale_socket(self):
+        stale = socket.socket(socket.AF_UNIX)
+        stale.bind(self.path)
+        stale.close()
+        server = ControlServer(self.path, self._handler)
+        server.start(self.waiter)
+        assert self._request('ping')['response']['pong']
+
+    def test_socket_in_use(self):
+        ControlServer(self.path, self._handler).start(self.waiter)
+        with self.assertRaises(ControlError):
+            ControlServer(self.path, self._handler).start(Waiter())
+
+    def test_client_errors(self):
+        assert main([self.path, 'status']) == 1
+        assert main([self.path]) == 2
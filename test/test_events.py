@@ -0,0 +1,75 @@
+import os
+import signal
+import subprocess
+import unittest
+
+from mock import MagicMock, patch
+
+from unicornherder.events import Waiter, pidfd_open
+
+
+@unittest.skipUnless(hasattr(os, 'pidfd_open'), 'pidfd_open is not available')
+class TestPidfd(unittest.TestCase):
+
+    def setUp(self):
+        self.waiter = Waiter()
+        self.process = subprocess.Popen(['sleep', '30'])
+
+    def tearDown(self):
+        self.waiter.close()
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def test_track_returns_true_with_pidfds(self):
+        assert self.waiter.track([self.process.pid]) is True
+        assert self.process.pid in self.waiter.pidfds
+
+    def test_idle_wait_times_out(self):
+        self.waiter.track([self.process.pid])
+        assert self.waiter.wait(0.01) is False
+        assert self.waiter.exited == set()
+
+    def test_detects_exit(self):
+        self.waiter.track([self.process.pid])
+        self.process.kill()
+        assert self.waiter.wait(1) is True
+        assert self.waiter.exited == set([self.process.pid])
+        assert self.waiter.pidfds == {}
+
+    def test_untracks_pids(self):
+        self.waiter.track([self.process.pid])
+        self.waiter.track([])
+        assert self.waiter.pidfds == {}
+
+
+class TestWaiter(unittest.TestCase):
+
+    @patch('unicornherder.events.os')
+    def test_pidfd_unavailable(self, os_mock):
+        del os_mock.pidfd_open
+        assert pidfd_open(123) is None
+
+    @patch('unicornherder.events.pidfd_open')
+    def test_track_returns_false_without_pidfds(self, pidfd_open_mock):
+        pidfd_open_mock.return_value = None
+        assert Waiter().track([123]) is False
+
+    def test_signal_wakes_waiter(self):
+        waiter = Waiter()
+        old = signal.signal(signal.SIGUSR1, lambda signum, frame: None)
+        try:
+            waiter.install_wakeup_fd()
+            os.kill(os.getpid(), signal.SIGUSR1)
+            assert waiter.wait(1) is True
+        finally:
+            waiter.close()
+            signal.signal(signal.SIGUSR1, old)
+
+    def test_remove_watcher(self):
+        waiter = Waiter()
+        watcher = MagicMock()
+        waiter.add_watcher(watcher)
+        waiter.remove_watcher(watcher)
+        assert waiter.watchers == []
+        watcher.close.assert_called_once_with()
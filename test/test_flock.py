@@ -0,0 +1,221 @@
+import os
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+
+from .helpers import *
+from unicornherder.events import Waiter
+from unicornherder.flock import Flock, load_config
+from unicornherder.herder import MANAGED_PIDS, HerderError
+from unicornherder.timeout import monotonic
+
+
+class TestLoadConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _config(self, text):
+        path = os.path.join(self.dir, 'herd.ini')
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_instances(self):
+        path = self._config('[DEFAULT]\n'
+                            'overlap = 10\n'
+                            '\n'
+                            '[frontend]\n'
+                            'pidfile = /run/frontend.pid\n'
+                            'args = -w 4 --log-format "%(h)s" frontend:app\n'
+                            '\n'
+                            '[backend]\n'
+                            'unicorn = unicorn\n'
+                            'pidfile = /run/backend.pid\n'
+                            'worker-memory-limit = 200\n'
+                            'overlap = 5\n')
+        config = load_config(path)
+        assert_equal(list(config), ['frontend', 'backend'])
+        assert_equal(config['frontend'], {
+            'overlap': 10,
+            'pidfile': '/run/frontend.pid',
+            'args': '-w 4 --log-format "%(h)s" frontend:app'})
+        assert_equal(config['backend'], {
+            'overlap': 5,
+            'unicorn': 'unicorn',
+            'pidfile': '/run/backend.pid',
+            'worker_memory_limit': 200})
+
+    def test_unknown_setting(self):
+        path = self._config('[app]\nworkers = 4\n')
+        assert_raises(HerderError, load_config, path)
+
+    def test_bad_value(self):
+        path = self._config('[app]\noverlap = soon\n')
+        assert_raises(HerderError, load_config, path)
+
+    def test_no_instances(self):
+        path = self._config('[DEFAULT]\noverlap = 10\n')
+        assert_raises(HerderError, load_config, path)
+
+    def test_missing_file(self):
+        assert_raises(HerderError, load_config, os.path.join(self.dir, 'nope.ini'))
+
+
+def _flock():
+    return Flock({'one': {'pidfile': 'one.pid', 'args': 'one:app'},
+                  'two': {'unicorn': 'unicorn', 'pidfile': 'two.pid'}})
+
+
+class TestFlock(object):
+
+    def test_init(self):
+        flock = _flock()
+        assert_equal(flock.herders['one'].pidfile, 'one.pid')
+        assert_equal(flock.herders['two'].unicorn, 'unicorn')
+
+    def test_init_shared_pidfile(self):
+        assert_raises(HerderError, Flock, {'one': {'pidfile': 'app.pid'},
+                                           'two': {'pidfile': 'app.pid'}})
+
+    def test_init_shared_addresses(self):
+        assert_raises(HerderError, Flock, {'one': {'pidfile': 'one.pid', 'metrics': ':9100'},
+                                           'two': {'pidfile': 'two.pid', 'metrics': ':9100'}})
+        assert_raises(HerderError, Flock, {'one': {'pidfile': 'one.pid', 'control': 'uh.sock'},
+                                           'two': {'pidfile': 'two.pid', 'control': 'uh.sock'}})
+
+    def test_init_bad_instance(self):
+        assert_raises(HerderError, Flock, {'one': {'unicorn': 'rainbow'}})
+
+    @patch('unicornherder.flock.install_signal_handlers')
+    @patch('unicornherder.flock.Waiter')
+    @patch('unicornherder.herder.subprocess.Popen')
+    def test_spawns_in_parallel(self, popen_mock, waiter_mock, handlers_mock):
+        one, two = MagicMock(pid=-1), MagicMock(pid=-2)
+        one.poll.side_effect = [None, None, 0]
+        two.poll.side_effect = [None, 0]
+        popen_mock.side_effect = [one, two]
+
+        assert_true(_flock().spawn())
+        # Both were started before either had daemonized
+        assert_equal(popen_mock.call_count, 2)
+        assert_equal(waiter_mock.return_value.wait.call_count, 2)
+        waiter_mock.return_value.track.assert_called_with([-1])
+        assert_equal(handlers_mock.call_count, 1)
+
+    @patch('unicornherder.flock.Waiter')
+    @patch('unicornherder.herder.subprocess.Popen')
+    @patch('unicornherder.herder.Deadline')
+    def test_spawn_timeout(self, deadline_mock, popen_mock, waiter_mock):
+        popen_mock.return_value.pid = -1
+        popen_mock.return_value.poll.return_value = None
+        fake_deadline_expired(deadline_mock)
+        assert_false(_flock().spawn())
+        # The second instance is stopped too, rather than left unherded
+        assert_equal(popen_mock.return_value.terminate.call_count, 2)
+
+    @patch('unicornherder.herder.Herder._terminate_spawned')
+    @patch('unicornherder.flock.Waiter')
+    @patch('unicornherder.herder.subprocess.Popen')
+    @patch('unicornherder.herder.Deadline')
+    def test_spawn_failure_stops_booted_instances(self, deadline_mock, popen_mock,
+                                                  waiter_mock, terminate_mock):
+        one, two = MagicMock(pid=-1), MagicMock(pid=-2)
+        one.poll.return_value = 0
+        two.poll.return_value = None
+        popen_mock.side_effect = [one, two]
+        fake_deadline_expired(deadline_mock)
+
+        assert_false(_flock().spawn())
+        two.terminate.assert_called_once_with()
+        # Only the instance which daemonized has a master to stop
+        terminate_mock.assert_called_once_with()
+
+    @patch('unicornherder.herder.time.sleep')
+    @patch('unicornherder.herder.psutil.Process')
+    @patch('unicornherder.herder.Pidfile')
+    def test_terminate_spawned(self, pidfile_mock, process_mock, sleep_mock):
+        herder = _flock().herders['one']
+        herder.spawned_at = monotonic()
+        herder.boot_deadline = MagicMock()
+        herder.boot_deadline.expired.return_value = False
+        pidfile_mock.return_value.pid = 123
+        # A stale pidfile first, then the one our unicorn wrote
+        stale, master = MagicMock(), MagicMock()
+        stale.create_time.return_value = time.time() - 3600
+        master.create_time.return_value = time.time()
+        process_mock.side_effect = [stale, master]
+
+        herder._terminate_spawned()
+        assert_equal(stale.terminate.call_count, 0)
+        master.terminate.assert_called_once_with()
+
+    def test_signals_go_to_every_instance(self):
+        flock = _flock()
+        flock._queue_signal(signal.SIGHUP, None)
+        for herder in flock.herders.values():
+            assert_equal(herder.pending_signals, [signal.SIGHUP])
+
+    def test_reload_one_instance(self):
+        flock = _flock()
+        for herder in flock.herders.values():
+            herder.master = MagicMock()
+        flock.reload('two')
+        assert_false(flock.herders['one'].reloading)
+        assert_true(flock.herders['two'].reloading)
+        flock.herders['two'].master.send_signal.assert_called_once_with(signal.SIGUSR2)
+        assert_raises(HerderError, flock.reload, 'three')
+
+    @patch('unicornherder.flock.Waiter')
+    def test_failing_instance_is_removed(self, waiter_mock):
+        flock = _flock()
+        one, two = flock.herders['one'], flock.herders['two']
+        one.master = MagicMock(pid=100)
+        one._tick = MagicMock(side_effect=HerderError('Failed to read pidfile'))
+        two._tick = MagicMock(side_effect=[True, True, False])
+        two.master = MagicMock(pid=200)
+
+        assert_equal(flock.loop(), 1)
+        # The other instance carried on until its own unicorn died
+        assert_equal(two._tick.call_count, 3)
+        one.master.kill.assert_called_once_with()
+        assert_equal(two.master.kill.call_count, 0)
+
+    def test_remove_dead_instance(self):
+        flock = _flock()
+        flock.waiter = MagicMock()
+        herder = flock.herders['one']
+        herder.watcher = MagicMock()
+        herder.master = MagicMock(pid=100)
+        old_master = MagicMock(pid=99)
+        herder.reloads = [MagicMock(old_master=old_master)]
+        MANAGED_PIDS.update([99, 100])
+
+        flock._remove('one')
+        assert_equal(list(flock.herders), ['two'])
+        flock.waiter.remove_watcher.assert_called_once_with(herder.watcher)
+        old_master.kill.assert_called_once_with()
+        assert_false(99 in MANAGED_PIDS or 100 in MANAGED_PIDS)
+
+    def test_remove_stops_watching_control_socket(self):
+        dir = tempfile.mkdtemp()
+        try:
+            flock = Flock({'one': {'pidfile': os.path.join(dir, 'one.pid'),
+                                   'control': os.path.join(dir, 'one.sock')},
+                           'two': {'pidfile': os.path.join(dir, 'two.pid')}})
+            flock.waiter = Waiter()
+            for herder in flock.herders.values():
+                herder._start(flock.waiter)
+            try:
+                flock._remove('one')
+                assert_equal(flock.waiter.watchers, [flock.herders['two'].watcher])
+            finally:
+                flock.herders['two']._stop()
+                flock.waiter.close()
+        finally:
+            shutil.rmtree(dir)
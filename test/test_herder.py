@@ -1,13 +1,27 @@
+import itertools
 import signal
 import sys
+import tempfile
+from psutil import NoSuchProcess
+
 from .helpers import *
 from unicornherder.herder import Herder, HerderError
+from unicornherder.timeout import Deadline, monotonic
 
 if sys.version_info > (3, 0):
     builtin_mod = 'builtins'
 else:
     builtin_mod = '__builtin__'
 
+setup_module, teardown_module = children_from_mocks()
+
+
+def _loop_until_done(herder, limit=100):
+    for _ in range(limit):
+        if not herder._loop_inner():
+            return False
+    raise AssertionError('The herder never gave up')
+
 
 class TestHerder(object):
 
@@ -28,6 +42,12 @@ class TestHerder(object):
     def test_init_unicornbad(self):
         assert_raises(HerderError, Herder, unicorn='unicornbad')
 
+    def test_init_probebad(self):
+        assert_raises(HerderError, Herder, probe='ftp://example.com')
+
+    def test_init_metricsbad(self):
+        assert_raises(HerderError, Herder, metrics='localhost')
+
     @patch('unicornherder.herder.subprocess.Popen')
     def test_spawn_returns_true(self, popen_mock):
         h = Herder()
@@ -50,26 +70,28 @@ class TestHerder(object):
         assert_equal(popen_mock.call_count, 1)
         popen_mock.assert_called_once_with(['unicorn', '-D', '-P', 'unicorn.pid'])
 
+    @patch('unicornherder.herder.time.sleep')
     @patch('unicornherder.herder.subprocess.Popen')
-    @patch('unicornherder.herder.timeout')
-    def test_spawn_unicorn_timeout(self, timeout_mock, popen_mock):
+    @patch('unicornherder.herder.Deadline')
+    def test_spawn_unicorn_timeout(self, deadline_mock, popen_mock, sleep_mock):
         popen_mock.return_value.pid = -1
-        timeout_mock.side_effect = fake_timeout_fail
+        fake_deadline_expired(deadline_mock)
         h = Herder()
         popen_mock.return_value.poll.return_value = None
         ret = h.spawn()
         assert_false(ret)
         popen_mock.return_value.terminate.assert_called_once_with()
 
+    @patch('unicornherder.herder.time.sleep')
     @patch('unicornherder.herder.subprocess.Popen')
-    @patch('unicornherder.herder.timeout')
-    def test_configurable_boot_timeout(self, timeout_mock, popen_mock):
+    @patch('unicornherder.herder.Deadline')
+    def test_configurable_boot_timeout(self, deadline_mock, popen_mock, sleep_mock):
         popen_mock.return_value.pid = -1
-        timeout_mock.side_effect = fake_timeout_fail
+        fake_deadline_expired(deadline_mock)
         h = Herder(boot_timeout=45)
         popen_mock.return_value.poll.return_value = None
         ret = h.spawn()
-        timeout_mock.assert_called_once_with(45)
+        deadline_mock.assert_called_once_with(45)
         assert_false(ret)
         popen_mock.return_value.terminate.assert_called_once_with()
 
@@ -96,7 +118,8 @@ class TestHerder(object):
         h._handle_HUP(signal.SIGHUP, None)
 
         h._loop_inner()
-        sleep_mock.assert_any_call(17)
+        assert_equal(h.reloads[0].phase, 'overlap')
+        assert_equal(h.reloads[0].deadline.seconds, 17)
 
 
     @patch('unicornherder.herder.time.sleep')
@@ -110,14 +133,17 @@ class TestHerder(object):
         open_mock.return_value.read.return_value = '123\n'
         process = MagicMock(pid=123)
         process.children.return_value = ["forked process", "worker 1", "worker 2"]
+        # It exits as soon as it's sent QUIT.
+        process.is_running.return_value = False
         process_mock.return_value = process
         h._loop_inner()
 
         # Simulate a reloaded Unicorn
         open_mock.return_value.read.return_value = '456\n'
         process = MagicMock(pid=456)
-        # First call returns an empty list, the second returns 2 workers
-        process.children.side_effect = [[], ["worker 1", "worker 2"]]
+        # First call returns an empty list, later ones 2 workers
+        process.children.side_effect = itertools.chain(
+            [[]], itertools.repeat(["worker 1", "worker 2"]))
         process_mock.return_value = process
 
         # Simulate SIGHUP, so the Herder thinks it's reloading
@@ -126,22 +152,53 @@ class TestHerder(object):
         h._loop_inner()
 
         # while waiting for workers
-        sleep_mock.asset_any_call(1)
+        assert_equal(h.reloads[0].phase, 'workers')
+        elapsed = run_timers(h)
         # overlap of both processes
-        sleep_mock.asset_any_call(30)
+        assert_true(30 < elapsed < 32)
+        assert_equal(h.reloads, [])
+
+    @patch('unicornherder.reload.listens_on', return_value=False)
+    @patch('unicornherder.herder.time.sleep')
+    @patch('unicornherder.herder.psutil.Process')
+    @patch('%s.open' % builtin_mod)
+    def test_probe_replaces_overlap(self, open_mock, process_mock, sleep_mock,
+                                    listens_mock):
+        h = Herder(overlap=17, probe='tcp://127.0.0.1:8080')
+        h.probe = MagicMock()
+        h.probe.check.side_effect = [False, True]
+
+        open_mock.return_value.read.return_value = '123\n'
+        old_process = MagicMock(pid=123)
+        old_process.children.return_value = ["forked process", "worker 1"]
+        old_process.is_running.return_value = False
+        process_mock.return_value = old_process
+        h._loop_inner()
+
+        open_mock.return_value.read.return_value = '456\n'
+        process = MagicMock(pid=456)
+        process.children.return_value = ["worker 1"]
+        process_mock.return_value = process
+
+        h._handle_HUP(signal.SIGHUP, None)
+        h._loop_inner()
+        elapsed = run_timers(h)
+
+        assert_equal(h.probe.check.call_count, 2)
+        assert_true(elapsed < 17)
+        old_process.send_signal.assert_called_with(signal.SIGQUIT)
 
     @patch('unicornherder.herder.time.sleep')
-    @patch('unicornherder.herder.timeout')
     @patch('unicornherder.herder.psutil.Process')
     @patch('%s.open' % builtin_mod)
-    def test_recovers_from_less_workers(self, open_mock, process_mock, timeout_mock, sleep_mock):
-        timeout_mock.side_effect = fake_timeout_fail
+    def test_recovers_from_less_workers(self, open_mock, process_mock, sleep_mock):
         h = Herder()
 
         # Set up an initial dummy master process for the herder to kill later
         open_mock.return_value.read.return_value = '123\n'
         old_process = MagicMock(pid=123)
         old_process.children.return_value = ["forked process", "worker 1", "worker 2"]
+        old_process.is_running.return_value = False
         process_mock.return_value = old_process
         h._loop_inner()
 
@@ -155,6 +212,8 @@ class TestHerder(object):
         h._handle_HUP(signal.SIGHUP, None)
 
         h._loop_inner()
+        elapsed = run_timers(h)
+        assert_true(elapsed >= 120)
         old_process.send_signal.assert_called_with(signal.SIGQUIT)
 
     @patch('unicornherder.herder.time.sleep')
@@ -167,21 +226,29 @@ class TestHerder(object):
         assert_equal(ret, True)
         process_mock.assert_called_once_with(123)
 
+    @patch('unicornherder.timeout.monotonic')
     @patch('unicornherder.herder.time.sleep')
     @patch('%s.open' % builtin_mod)
-    def test_loop_invalid_pid(self, open_mock, sleep_mock):
+    def test_loop_invalid_pid(self, open_mock, sleep_mock, clock_mock):
+        clock_mock.side_effect = fake_clock()
         open_mock.return_value.read.return_value = 'foobar'
         h = Herder()
-        assert_raises(HerderError, h._loop_inner)
+        # Retried on a timer, without sleeping, until the timeout
+        assert_true(h._loop_inner())
+        assert_true('pidfile' in h.timers)
+        assert_raises(HerderError, _loop_until_done, h)
+        assert_equal(sleep_mock.call_count, 0)
 
+    @patch('unicornherder.timeout.monotonic')
     @patch('unicornherder.herder.time.sleep')
     @patch('%s.open' % builtin_mod)
-    def test_loop_nonexistent_pidfile(self, open_mock, sleep_mock):
+    def test_loop_nonexistent_pidfile(self, open_mock, sleep_mock, clock_mock):
+        clock_mock.side_effect = fake_clock()
         def _fail():
             raise IOError()
         open_mock.return_value.read.side_effect = _fail
         h = Herder()
-        assert_raises(HerderError, h._loop_inner)
+        assert_raises(HerderError, _loop_until_done, h)
 
     @patch('unicornherder.herder.time.sleep')
     @patch('%s.open' % builtin_mod)
@@ -227,6 +294,7 @@ class TestHerder(object):
         proc2.pid = 456
         proc1.children = MagicMock(return_value=[proc2, "worker"])
         proc2.children = MagicMock(return_value=["worker 1"])
+        proc1.is_running = MagicMock(return_value=False)
 
         h = Herder()
 
@@ -242,11 +310,16 @@ class TestHerder(object):
         process_mock.return_value = proc2
         ret = h._loop_inner()
         assert_equal(ret, True)
+        run_timers(h)
+        assert_equal(h.metrics.reloads, 1)
+        assert_equal(sorted(h.metrics.phase_seconds),
+                     ['drain', 'exit', 'fork', 'overlap', 'workers'])
 
         expected_calls = [call.send_signal(signal.SIGUSR2),
                           call.children(),
                           call.send_signal(signal.SIGWINCH),
-                          call.send_signal(signal.SIGQUIT)]
+                          call.send_signal(signal.SIGQUIT),
+                          call.is_running()]
         assert_equal(proc1.mock_calls, expected_calls)
 
     def test_forward_signal(self):
@@ -263,3 +336,546 @@ class TestHerder(object):
     def test_handle_hup_nomaster(self):
         h = Herder()
         h._handle_HUP(signal.SIGHUP, None)
+
+    @patch('unicornherder.herder.time.sleep')
+    @patch('unicornherder.herder.psutil.Process')
+    @patch('%s.open' % builtin_mod)
+    def test_loop_master_exited(self, open_mock, process_mock, sleep_mock):
+        open_mock.return_value.read.return_value = '123\n'
+        process_mock.return_value = MagicMock(pid=123)
+        h = Herder()
+        h._loop_inner()
+
+        # The pidfd for the master has fired, but the pidfile is stale
+        h.waiter = MagicMock(exited=set([123]))
+        assert_equal(h._loop_inner(), False)
+        assert_equal(process_mock.call_count, 1)
+
+
+    def test_queued_signals_are_dispatched(self):
+        h = Herder()
+        h.master = MagicMock()
+
+        h._queue_signal(signal.SIGTTIN, None)
+        h._queue_signal(signal.SIGHUP, None)
+        assert_equal(h.master.send_signal.call_count, 0)
+
+        h._dispatch_signals()
+        expected_calls = [call.send_signal(signal.SIGTTIN),
+                          call.send_signal(signal.SIGUSR2)]
+        assert_equal(h.master.mock_calls, expected_calls)
+        assert_true(h.reloading)
+        assert_equal(h.pending_signals, [])
+
+    @patch('unicornherder.herder.psutil.Process')
+    @patch('%s.open' % builtin_mod)
+    def test_terminate_during_reload(self, open_mock, process_mock):
+        h = Herder()
+
+        open_mock.return_value.read.return_value = '123\n'
+        old_process = MagicMock(pid=123)
+        old_process.children.return_value = ["forked process", "worker 1"]
+        process_mock.return_value = old_process
+        h._loop_inner()
+        h._handle_HUP(signal.SIGHUP, None)
+
+        # The new master hasn't started its workers yet, but that doesn't
+        # hold up the loop.
+        open_mock.return_value.read.return_value = '456\n'
+        new_process = MagicMock(pid=456)
+        new_process.children.return_value = []
+        process_mock.return_value = new_process
+        assert_equal(h._loop_inner(), True)
+        assert_equal(len(h.reloads), 1)
+
+        h._handle_signal('TERM')(signal.SIGTERM, None)
+
+        assert_true(h.terminating)
+        assert_equal(h.reloads, [])
+        assert_equal(len(h.timers), 0)
+        old_process.send_signal.assert_called_with(signal.SIGTERM)
+        new_process.send_signal.assert_called_with(signal.SIGTERM)
+
+    def test_memory_guard_flavour(self):
+        h = Herder(unicorn='gunicorn', worker_memory_limit=100)
+        assert_equal(h.memory_guard.recycle_signal, signal.SIGTERM)
+        assert_equal(h.memory_guard.worker_limit, 100 * 1024 * 1024)
+
+        h = Herder(unicorn='unicorn', memory_budget=1000)
+        assert_equal(h.memory_guard.recycle_signal, signal.SIGQUIT)
+
+        assert_equal(Herder().memory_guard, None)
+
+    def test_check_memory_reschedules(self):
+        h = Herder(worker_memory_limit=100, memory_interval=5)
+        h.master = MagicMock()
+        h.memory_guard = MagicMock()
+        h._check_memory()
+        h.memory_guard.check.assert_called_once_with(h.master)
+        assert_true('memory' in h.timers)
+
+    def test_autoscaler(self):
+        h = Herder(min_workers=2, max_workers=8, scale_cooldown=10)
+        assert_equal(h.autoscaler.min_workers, 2)
+        assert_equal(h.autoscaler.max_workers, 8)
+        assert_equal(h.autoscaler.cooldown, 10)
+
+        assert_equal(Herder(min_workers=2).autoscaler, None)
+        assert_raises(HerderError, Herder, min_workers=8, max_workers=2)
+
+    def test_autoscale_skipped_during_reload(self):
+        h = Herder(min_workers=2, max_workers=8)
+        h.master = MagicMock()
+        h.autoscaler = MagicMock()
+        h.reloads = [MagicMock()]
+        h._autoscale()
+        assert_equal(h.autoscaler.check.call_count, 0)
+        assert_true('autoscale' in h.timers)
+
+        h.reloads = []
+        h.autoscaler.check.return_value = 1
+        h._autoscale()
+        h.autoscaler.check.assert_called_once_with(h.master)
+        assert_equal(h.scaled_workers, 1)
+
+    def test_reload_expects_unscaled_workers(self):
+        h = Herder()
+        old_master = MagicMock(pid=123)
+        h.master = old_master
+        h.scaled_workers = 3
+        h._control(MagicMock(), ['scale', 'down', '1'])
+        assert_equal(h.scaled_workers, 2)
+
+        # Six workers and the new master, two of them added at runtime
+        h.master = MagicMock(pid=456)
+        old_master.children.return_value = [h.master] + ['worker'] * 6
+        h._start_reload(old_master)
+        assert_equal(h.reloads[0].expected_children, 4)
+        assert_equal(h.scaled_workers, 0)
+
+    def test_old_master_exit_ends_reload(self):
+        h = Herder()
+        h.master = MagicMock(pid=456)
+        old_master = MagicMock(pid=123)
+        old_master.children.return_value = [h.master]
+        h._start_reload(old_master)
+        reload = h.reloads[0]
+        reload.phase = 'exit'
+        h.waiter = MagicMock(exited=set())
+
+        h._step_exited_reloads()
+        assert_equal(h.reloads, [reload])
+
+        old_master.is_running.return_value = False
+        h.waiter.exited.add(123)
+        h._step_exited_reloads()
+        assert_equal(h.reloads, [])
+        assert_false(reload in h.timers)
+
+    @patch('unicornherder.herder.psutil.Process')
+    @patch('%s.open' % builtin_mod)
+    def test_reuses_tracked_master(self, open_mock, process_mock):
+        open_mock.return_value.read.return_value = '123\n'
+        process_mock.return_value = MagicMock(pid=123)
+        h = Herder()
+        h._loop_inner()
+        h.waiter = MagicMock(pidfds={123: 5}, exited=set())
+        h._loop_inner()
+        assert_equal(process_mock.call_count, 1)
+
+        # Without a pidfd, we have to look again
+        h.waiter.pidfds = {}
+        h._loop_inner()
+        assert_equal(process_mock.call_count, 2)
+
+    def test_rolling_options(self):
+        h = Herder(rolling_step=2, rolling_budget=100)
+        assert_equal(h.rolling_step, 2)
+        assert_equal(h.rolling_budget, 100 * 1024 * 1024)
+        assert_raises(HerderError, Herder, rolling_step=0)
+
+    @patch('unicornherder.herder.psutil.Process')
+    @patch('%s.open' % builtin_mod)
+    def test_reload_timeline(self, open_mock, process_mock):
+        h = Herder()
+        h.timeline = MagicMock()
+        h.master = MagicMock(pid=123)
+        h._handle_HUP(signal.SIGHUP, None)
+        h.timeline.bind.assert_called_once_with(reload=1)
+        bound = h.timeline.bind.return_value
+        assert_equal(bound.event.call_args_list[:2],
+                     [call('hup', pid=123), call('signal', signal='USR2', pid=123)])
+
+        open_mock.return_value.read.return_value = '456\n'
+        process_mock.return_value = MagicMock(pid=456)
+        h._loop_inner()
+        bound.event.assert_any_call('new_pid', old_pid=123, new_pid=456)
+        assert_equal(h.reloads[0].timeline, bound)
+        assert_equal(h.reload_timeline, None)
+
+    def test_control_status(self):
+        h = Herder()
+        h.master = MagicMock(pid=123)
+        h.master.children.return_value = [MagicMock(pid=124), MagicMock(pid=125)]
+        conn = MagicMock()
+        h._control(conn, ['status'])
+        status = conn.respond.call_args[0][0]
+        assert_equal(status['master'], 123)
+        assert_equal(status['workers'], [124, 125])
+        assert_equal(status['reloading'], False)
+
+    @patch('unicornherder.herder.psutil.Process')
+    @patch('%s.open' % builtin_mod)
+    def test_control_reload(self, open_mock, process_mock):
+        h = Herder(overlap=0)
+        old = MagicMock(pid=123)
+        old.children.return_value = ['new master', 'worker']
+        old.is_running.return_value = False
+        h.master = old
+        conn = MagicMock()
+        h._control(conn, ['reload'])
+        old.send_signal.assert_called_once_with(signal.SIGUSR2)
+        assert_equal(conn.respond.call_count, 0)
+
+        # A second reload waits for the first, and is answered by the
+        # follow-up reload
+        other = MagicMock()
+        h._control(other, ['reload'])
+        assert_equal(other.respond.call_count, 0)
+
+        new = MagicMock(pid=456)
+        new.children.return_value = ['worker']
+        new.is_running.return_value = False
+        open_mock.return_value.read.return_value = '456\n'
+        process_mock.return_value = new
+        h._loop_inner()
+        run_timers(h, until=lambda: not h.reloads)
+
+        response = conn.respond.call_args[0][0]
+        assert_true(response['ok'])
+        assert_equal((response['old_master'], response['new_master']), (123, 456))
+        new.send_signal.assert_called_with(signal.SIGUSR2)
+        assert_equal(other.respond.call_count, 0)
+
+        newer = MagicMock(pid=789)
+        newer.children.return_value = ['worker']
+        open_mock.return_value.read.return_value = '789\n'
+        process_mock.return_value = newer
+        h._loop_inner()
+        run_timers(h)
+
+        response = other.respond.call_args[0][0]
+        assert_true(response['ok'])
+        assert_equal((response['old_master'], response['new_master']), (456, 789))
+
+    @patch('unicornherder.herder.psutil.Process')
+    @patch('%s.open' % builtin_mod)
+    def test_hups_during_reload_are_coalesced(self, open_mock, process_mock):
+        h = Herder(overlap=10)
+        old = MagicMock(pid=123)
+        old.children.return_value = ['new master', 'worker']
+        old.is_running.return_value = False
+        h.master = old
+        assert_equal(h.reload_state, 'idle')
+
+        h._handle_HUP(signal.SIGHUP, None)
+        assert_equal(h.reload_state, 'forking')
+        h._handle_HUP(signal.SIGHUP, None)
+        h._handle_HUP(signal.SIGHUP, None)
+        old.send_signal.assert_called_once_with(signal.SIGUSR2)
+        assert_true(h.reload_pending)
+
+        new = MagicMock(pid=456)
+        new.children.return_value = ['worker']
+        open_mock.return_value.read.return_value = '456\n'
+        process_mock.return_value = new
+        h._loop_inner()
+        assert_equal(h.reload_state, 'overlapping')
+        h._handle_HUP(signal.SIGHUP, None)
+        assert_equal(new.send_signal.call_count, 0)
+
+        # Once the old master is retired, the new one is reloaded just once
+        run_timers(h, until=lambda: not h.reloads)
+        old.send_signal.assert_any_call(signal.SIGWINCH)
+        new.send_signal.assert_called_once_with(signal.SIGUSR2)
+        assert_false(h.reload_pending)
+        assert_equal(h.reload_state, 'forking')
+
+    @patch('unicornherder.herder.psutil.Process')
+    @patch('%s.open' % builtin_mod)
+    def test_fork_timeout(self, open_mock, process_mock):
+        h = Herder(overlap=0)
+        old = MagicMock(pid=123)
+        old.children.return_value = ['new master', 'worker']
+        old.is_running.return_value = False
+        h.master = old
+        conn = MagicMock()
+        h._control(conn, ['reload'])
+        h._handle_HUP(signal.SIGHUP, None)
+
+        # No new master appears, so the reload is given up on, and the
+        # queued one tried instead.
+        h._fork_timed_out()
+        assert_false(conn.respond.call_args[0][0]['ok'])
+        assert_equal(old.send_signal.call_args_list, [call(signal.SIGUSR2)] * 2)
+        assert_equal(h.reload_state, 'forking')
+
+        # A master which forks late is still retired
+        h._fork_timed_out()
+        assert_equal(h.reload_state, 'idle')
+        new = MagicMock(pid=456)
+        new.children.return_value = ['worker']
+        open_mock.return_value.read.return_value = '456\n'
+        process_mock.return_value = new
+        h._loop_inner()
+        assert_equal(len(h.reloads), 1)
+        run_timers(h)
+        old.send_signal.assert_any_call(signal.SIGWINCH)
+        assert_equal(h.reloads, [])
+
+    @patch('unicornherder.herder.psutil.Process')
+    @patch('%s.open' % builtin_mod)
+    def test_new_master_dies(self, open_mock, process_mock):
+        h = Herder()
+        old = MagicMock(pid=123)
+        old.children.return_value = ['new master', 'worker']
+        h.master = old
+        h._handle_HUP(signal.SIGHUP, None)
+
+        new = MagicMock(pid=456)
+        new.children.return_value = []
+        open_mock.return_value.read.return_value = '456\n'
+        process_mock.return_value = new
+        h._loop_inner()
+        assert_equal(h.reloads[0].phase, 'workers')
+
+        # Its workers fail to boot, it exits, and the old master takes the
+        # pidfile back.
+        new.children.side_effect = NoSuchProcess(456)
+        new.is_running.return_value = False
+        open_mock.return_value.read.return_value = '123\n'
+        process_mock.return_value = old
+        assert_true(h._loop_inner())
+        assert_equal(h.master, old)
+
+        run_timers(h)
+        assert_equal(h.reloads, [])
+        assert_equal(old.send_signal.call_args_list, [call(signal.SIGUSR2)])
+        assert_true(h._loop_inner())
+        assert_equal(h.master, old)
+
+    @patch('unicornherder.herder.psutil.Process')
+    @patch('%s.open' % builtin_mod)
+    def test_rollback(self, open_mock, process_mock):
+        h = Herder(rollback_crashes=1)
+        old = MagicMock(pid=123)
+        old.children.return_value = ['new master', 'worker']
+        h.master = old
+        conn = MagicMock()
+        h._control(conn, ['reload'])
+
+        new = MagicMock(pid=456)
+        new.children.return_value = [MagicMock(pid=457)]
+        open_mock.return_value.read.return_value = '456\n'
+        process_mock.return_value = new
+        h._loop_inner()
+        assert_equal(h.master, new)
+
+        # The new master's worker crashes and is replaced
+        new.children.return_value = [MagicMock(pid=458)]
+        run_timers(h, until=lambda: h.master is old)
+        new.send_signal.assert_called_once_with(signal.SIGQUIT)
+        assert_equal(h.reload_state, 'rolling_back')
+
+        # Until the old master puts the pidfile back, it names the new one
+        assert_true(h._loop_inner())
+        assert_equal(h.master, old)
+
+        new.is_running.return_value = False
+        run_timers(h)
+        assert_equal(h.reloads, [])
+        response = conn.respond.call_args[0][0]
+        assert_false(response['ok'])
+        assert_true(response['rolled_back'])
+
+        open_mock.return_value.read.return_value = '123\n'
+        process_mock.return_value = old
+        assert_true(h._loop_inner())
+        assert_equal(h.master, old)
+
+    @patch('unicornherder.herder.is_listening')
+    @patch('unicornherder.herder.psutil.Process')
+    @patch('%s.open' % builtin_mod)
+    def test_boot(self, open_mock, process_mock, listening_mock):
+        h = Herder()
+        h.spawned_at = monotonic()
+        h.boot_deadline = Deadline(30)
+        h.metrics = MagicMock()
+
+        # The pidfile hasn't been written yet, which is fine while booting
+        open_mock.side_effect = IOError(2, 'No such file or directory')
+        assert_true(h._loop_inner())
+        assert_equal(h.master, None)
+
+        # Then the master appears, but isn't listening yet
+        open_mock.side_effect = None
+        open_mock.return_value.read.return_value = '123\n'
+        process_mock.return_value = MagicMock(pid=123)
+        listening_mock.return_value = False
+        assert_true(h._loop_inner())
+        assert_false(h.booted)
+        assert_true('boot' in h.timers)
+
+        listening_mock.return_value = True
+        h._check_boot()
+        assert_true(h.booted)
+        assert_equal(h.metrics.observe_boot.call_count, 1)
+        listening_mock.assert_called_with(123)
+
+    def test_sharing_report(self):
+        h = Herder(sharing_delay=30)
+        h.master = MagicMock(pid=123)
+        h.metrics = MagicMock()
+        h.booted = True
+        h._schedule_sharing()
+        assert_true('sharing' in h.timers)
+
+        h.sharing_monitor = MagicMock()
+        run_timers(h)
+        h.sharing_monitor.check.assert_called_once_with(h.master)
+        h.metrics.observe_sharing.assert_called_once_with(h.sharing_monitor.check.return_value)
+
+        # Not unless asked for
+        h = Herder()
+        h._schedule_sharing()
+        assert_false('sharing' in h.timers)
+
+    def test_warmup(self):
+        assert_raises(HerderError, Herder, warmup='/nonexistent/warmup.txt')
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as f:
+            f.write('/\n')
+            f.flush()
+            assert_raises(HerderError, Herder, warmup=f.name, warmup_target='ftp://x')
+            # Through the socket it shares with the old master, the old
+            # workers would answer.
+            assert_raises(HerderError, Herder, warmup=f.name)
+
+            h = Herder(warmup=f.name, warmup_target='http://127.0.0.1:8080',
+                       warmup_latency=250)
+        assert_equal(h.warmup.target, ('tcp', ('127.0.0.1', 8080)))
+        assert_equal(h.warmup.latency, 0.25)
+
+    def test_demote_old(self):
+        assert_raises(HerderError, Herder, demote_old=20)
+        h = Herder(demote_old=10)
+        h.master = MagicMock(pid=456)
+        old_master = MagicMock(pid=123)
+        old_master.children.return_value = [h.master]
+        h._start_reload(old_master)
+        assert_equal(h.reloads[0].demote, 10)
+
+    def test_pin_workers(self):
+        assert_raises(HerderError, Herder, pin_workers='socket')
+
+        h = Herder(pin_workers='cpu')
+        h.placer = MagicMock()
+        h.master = MagicMock(pid=123)
+        old_master = MagicMock(pid=122)
+        h.reloads = [MagicMock(old_master=old_master)]
+        h._pin_workers()
+        h.placer.check.assert_called_once_with(h.master, old_master)
+        assert_true('pin' in h.timers)
+
+        # With a real placer, the new master is left alone
+        h = Herder(pin_workers='cpu')
+        h.master = MagicMock(pid=456)
+        h.master.children.return_value = [MagicMock(pid=457)]
+        old_master.children.return_value = [h.master, MagicMock(pid=124)]
+        h.reloads = [MagicMock(old_master=old_master)]
+        h._pin_workers()
+        assert_false(h.master.cpu_affinity.called)
+        assert_equal(sorted(h.placer.placed), [124, 457])
+
+    def test_control_backlog(self):
+        h = Herder()
+        conn = MagicMock()
+        h._control(conn, ['backlog'])
+        assert_false(conn.respond.call_args[0][0]['ok'])
+
+        h = Herder(backlog_threshold=5)
+        h.master = MagicMock(pid=123)
+        h.metrics = MagicMock()
+        with patch('unicornherder.backlog.listening_sockets') as sockets_mock:
+            sockets_mock.return_value = []
+            h._check_backlog()
+        h.metrics.observe_backlog.assert_called_once_with(h.backlog_monitor.samples[0])
+        assert_true('backlog' in h.timers)
+
+        h._control(conn, ['backlog'])
+        response = conn.respond.call_args[0][0]
+        assert_true(response['ok'])
+        assert_equal(response['threshold'], 5)
+        assert_equal(response['samples'][0]['queue'], 0)
+
+    def test_control_usage(self):
+        h = Herder()
+        conn = MagicMock()
+        h._control(conn, ['usage'])
+        assert_false(conn.respond.call_args[0][0]['ok'])
+
+        h = Herder(usage_interval=5, usage_history=10)
+        h.master = MagicMock(pid=123)
+        h.master.children.return_value = []
+        h.master.num_fds.return_value = 7
+        h._sample_usage()
+        assert_true('usage' in h.timers)
+
+        h._control(conn, ['usage', '60'])
+        response = conn.respond.call_args[0][0]
+        assert_true(response['ok'])
+        assert_equal(dict(zip(response['fields'], response['rows'][0]))['fds'], 7)
+
+        h._control(conn, ['usage', 'lots'])
+        assert_false(conn.respond.call_args[0][0]['ok'])
+
+    def test_control_scale(self):
+        h = Herder()
+        h.master = MagicMock(pid=123)
+        conn = MagicMock()
+        h._control(conn, ['scale', 'up', '3'])
+        assert_true(conn.respond.call_args[0][0]['ok'])
+        run_timers(h)
+        assert_equal(h.master.send_signal.call_args_list, [call(signal.SIGTTIN)] * 3)
+
+        h._control(conn, ['scale', 'down', 'lots'])
+        assert_false(conn.respond.call_args[0][0]['ok'])
+        h._control(conn, ['scale', 'sideways'])
+        assert_false(conn.respond.call_args[0][0]['ok'])
+
+    def test_control_scale_overlapping(self):
+        h = Herder()
+        h.master = MagicMock(pid=123)
+        conn = MagicMock()
+        h._control(conn, ['scale', 'up', '5'])
+        h._control(conn, ['scale', 'up', '3'])
+        run_timers(h)
+        assert_equal(h.master.send_signal.call_args_list, [call(signal.SIGTTIN)] * 8)
+        assert_equal(h.scaled_workers, 8)
+
+    @patch('unicornherder.herder.psutil.Process')
+    @patch('%s.open' % builtin_mod)
+    def test_control_scale_cancelled_by_new_master(self, open_mock, process_mock):
+        h = Herder()
+        old = MagicMock(pid=123)
+        h.master = old
+        h._control(MagicMock(), ['scale', 'down', '4'])
+        assert_equal(h.scaled_workers, -1)
+
+        # A new master turns up part way through
+        open_mock.return_value.read.return_value = '456\n'
+        process_mock.return_value = MagicMock(pid=456)
+        h._loop_inner()
+        run_timers(h)
+        assert_equal(old.send_signal.call_count, 1)
+        assert_equal(h.master.send_signal.call_count, 0)
+        assert_equal(h.scaled_workers, -1)
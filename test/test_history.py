@@ -0,0 +1,76 @@
+import psutil
+
+from .helpers import *
+from unicornherder.history import FIELDS, RingBuffer, UsageHistory
+
+setup_module, teardown_module = children_from_mocks()
+
+
+def _process(pid, children=(), rss=1000, fds=5, **returns):
+    return mock_process(pid, children,
+                        cpu_times=MagicMock(user=1.5, system=0.5),
+                        memory_info=MagicMock(rss=rss),
+                        num_ctx_switches=MagicMock(voluntary=10, involuntary=2),
+                        num_fds=fds, **returns)
+
+
+class TestRingBuffer(object):
+
+    def test_append(self):
+        buf = RingBuffer(('a', 'b'), 3)
+        assert_equal(len(buf), 0)
+        assert_equal(buf.rows(), [])
+
+        buf.append((1, 2))
+        buf.append((3, 4))
+        assert_equal(len(buf), 2)
+        assert_equal(buf.rows(), [(1, 2), (3, 4)])
+
+    def test_wraps_around(self):
+        buf = RingBuffer(('a',), 3)
+        for i in range(7):
+            buf.append((i,))
+        assert_equal(len(buf), 3)
+        assert_equal(buf.rows(), [(4,), (5,), (6,)])
+
+    def test_size(self):
+        assert_raises(ValueError, RingBuffer, ('a',), 0)
+
+
+class TestUsageHistory(object):
+
+    def test_sample(self):
+        master = _process(100, [_process(101), _process(102, fds=psutil.AccessDenied())],
+                          rss=5000)
+        history = UsageHistory(10)
+
+        history.sample(master)
+        rows = history.dump()
+        assert_equal(len(rows), 3)
+        assert_equal(dict(zip(FIELDS, rows[0]))['rss'], 5000)
+        assert_equal([row[1:3] for row in rows], [[100, 1], [101, 0], [102, 0]])
+        assert_equal(rows[1][3:], [1.5, 0.5, 1000, 10, 2, 5])
+        assert_equal(rows[2][-1], None)
+
+    def test_skips_vanished_processes(self):
+        master = _process(100, [_process(101, oneshot=psutil.NoSuchProcess(101))])
+        history = UsageHistory(10)
+
+        history.sample(master)
+        assert_equal([row[1] for row in history.dump()], [100])
+
+        master.children.side_effect = psutil.NoSuchProcess(100)
+        history.sample(master)
+        assert_equal(len(history.buffer), 1)
+
+    @patch('unicornherder.history.time')
+    def test_dump_since(self, time_mock):
+        master = _process(100)
+        history = UsageHistory(2)
+        for t in (10, 20, 30):
+            time_mock.time.return_value = t
+            history.sample(master)
+
+        # The first sample has been overwritten
+        assert_equal([row[0] for row in history.dump()], [20, 30])
+        assert_equal([row[0] for row in history.dump(since=25)], [30])
@@ -0,0 +1,66 @@
+import psutil
+import signal
+
+from .helpers import *
+from unicornherder.memory import MB, MemoryGuard
+
+setup_module, teardown_module = children_from_mocks()
+
+
+def _process(pid, rss_mb, children=None):
+    return mock_process(pid, children,
+                        memory_info=MagicMock(rss=rss_mb * MB),
+                        memory_full_info=MagicMock(uss=rss_mb * MB // 2))
+
+
+def _master(*worker_rss):
+    return _process(100, 50, [_process(101 + i, rss)
+                              for i, rss in enumerate(worker_rss)])
+
+
+class TestMemoryGuard(object):
+
+    def test_within_limits(self):
+        guard = MemoryGuard(worker_limit=200 * MB, total_limit=1000 * MB)
+        assert_equal(guard.check(_master(100, 150)), [])
+
+    def test_recycles_big_worker(self):
+        master = _master(100, 250)
+        guard = MemoryGuard(worker_limit=200 * MB)
+        assert_equal(guard.check(master), [102])
+        master.children.return_value[1].send_signal.assert_called_once_with(signal.SIGQUIT)
+
+    def test_rate_limited(self):
+        master = _master(300, 250, 400)
+        guard = MemoryGuard(worker_limit=200 * MB, max_recycling=2)
+        assert_equal(guard.check(master), [103, 101])
+
+        # Neither has exited yet, so nothing more happens
+        assert_equal(guard.check(master), [])
+
+        # Once one has been replaced, the next can go
+        master.children.return_value = master.children.return_value[1:]
+        assert_equal(guard.check(master), [102])
+
+    def test_total_budget(self):
+        # 50 + 100 + 300 + 200 = 650MB, against a 300MB budget
+        master = _master(100, 300, 200)
+        guard = MemoryGuard(total_limit=300 * MB, max_recycling=3)
+        assert_equal(guard.check(master), [102, 103])
+
+    def test_uss(self):
+        guard = MemoryGuard(worker_limit=200 * MB, metric='uss')
+        assert_equal(guard.check(_master(300)), [])
+        assert_equal(guard.check(_master(500)), [101])
+
+    def test_recycle_signal(self):
+        master = _master(250)
+        guard = MemoryGuard(worker_limit=200 * MB, recycle_signal=signal.SIGTERM)
+        guard.check(master)
+        master.children.return_value[0].send_signal.assert_called_once_with(signal.SIGTERM)
+
+    def test_worker_gone(self):
+        master = _master(250)
+        master.children.return_value[0].memory_info.side_effect = psutil.NoSuchProcess(101)
+        guard = MemoryGuard(worker_limit=200 * MB)
+        assert_equal(guard.check(master), [])
@@ -0,0 +1,174 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+try:
+    from urllib.request import urlopen
+except ImportError:  # Python 2
+    from urllib2 import urlopen
+
+from mock import MagicMock
+
+from .helpers import children_from_mocks
+from unicornherder.metrics import (Histogram, Metrics, MetricsError,
+                                   MetricsServer, parse_address)
+from unicornherder.sharing import ProcessMemory, SharingReport
+
+setup_module, teardown_module = children_from_mocks()
+
+
+def _reload(duration, aborted=False, rolled_back=False, **durations):
+    return MagicMock(duration=duration, durations=durations, aborted=aborted,
+                     rolled_back=rolled_back)
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_render(self):
+        h = Histogram(buckets=(1, 10))
+        h.observe(0.5)
+        h.observe(5)
+        assert h.render('x') == ['x_bucket{le="1"} 1',
+                                 'x_bucket{le="10"} 2',
+                                 'x_bucket{le="+Inf"} 2',
+                                 'x_sum 5.5',
+                                 'x_count 2']
+
+    def test_render_labels(self):
+        h = Histogram(buckets=(1,))
+        h.observe(2)
+        assert h.render('x', 'phase="overlap"') == [
+            'x_bucket{phase="overlap",le="1"} 0',
+            'x_bucket{phase="overlap",le="+Inf"} 1',
+            'x_sum{phase="overlap"} 2.0',
+            'x_count{phase="overlap"} 1']
+
+
+class TestMetrics(unittest.TestCase):
+
+    def _master(self):
+        worker = MagicMock(pid=457)
+        worker.memory_info.return_value.rss = 1024
+        worker.cpu_times.return_value = MagicMock(user=1.5, system=0.5)
+        master = MagicMock(pid=456)
+        master.create_time.return_value = 1000.0
+        master.children.return_value = [worker]
+        return master
+
+    def test_render_reloads(self):
+        m = Metrics()
+        m.observe_boot(1.25)
+        m.observe_reload(_reload(35, fork=0.5, workers=3, overlap=30))
+        m.observe_reload(_reload(10, aborted=True))
+        m.observe_reload(_reload(5, rolled_back=True))
+        text = m.render(None)
+
+        assert 'unicornherder_boot_seconds 1.25\n' in text
+        assert 'unicornherder_reloads_total 1\n' in text
+        assert 'unicornherder_aborted_reloads_total 1\n' in text
+        assert 'unicornherder_rolled_back_reloads_total 1\n' in text
+        assert 'unicornherder_reload_duration_seconds_bucket{le="45"} 1\n' in text
+        assert 'unicornherder_reload_phase_seconds_sum{phase="overlap"} 30' in text
+        assert 'unicornherder_master_pid' not in text
+
+    def test_render_sharing(self):
+        m = Metrics()
+        memory = ProcessMemory(123, 1000, 600, 400, 600)
+        m.observe_sharing(SharingReport(memory, [memory, memory], 0.6))
+        text = m.render(None)
+
+        assert 'unicornherder_shared_memory_ratio 0.6\n' in text
+        assert 'unicornherder_memory_bytes{kind="pss"} 1800\n' in text
+
+    def test_render_workers(self):
+        text = Metrics().render(self._master())
+
+        assert 'unicornherder_master_pid 456\n' in text
+        assert 'unicornherder_master_start_time_seconds 1000.0\n' in text
+        assert 'unicornherder_workers 1\n' in text
+        assert 'unicornherder_worker_rss_bytes{pid="457"} 1024\n' in text
+        assert 'unicornherder_worker_cpu_seconds_total{pid="457",mode="user"} 1.5\n' in text
+
+
+class TestMetricsServer(unittest.TestCase):
+
+    def test_parse_address(self):
+        assert parse_address('127.0.0.1:9100') == ('tcp', ('127.0.0.1', 9100))
+        assert parse_address(':9100') == ('tcp', ('127.0.0.1', 9100))
+        assert parse_address('unix:/run/uh.sock') == ('unix', '/run/uh.sock')
+        with self.assertRaises(MetricsError):
+            parse_address('localhost')
+
+    def test_serves_tcp(self):
+        server = MetricsServer('127.0.0.1:0', lambda: 'metric 1\n')
+        server.start()
+        try:
+            port = server.server.server_address[1]
+            response = urlopen('http://127.0.0.1:%s/metrics' % port)
+            assert response.read() == b'metric 1\n'
+        finally:
+            server.stop()
+
+    def test_serves_unix(self):
+        dir = tempfile.mkdtemp()
+        path = os.path.join(dir, 'metrics.sock')
+        server = MetricsServer('unix:%s' % path, lambda: 'metric 1\n')
+        server.start()
+        try:
+            sock = socket.socket(socket.AF_UNIX)
+            sock.connect(path)
+            sock.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+            response = b''
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                response += chunk
+            sock.close()
+            assert response.startswith(b'HTTP/1.0 200')
+            assert response.endswith(b'metric 1\n')
+        finally:
+            server.stop()
+            shutil.rmtree(dir)
+        assert not os.path.exists(path)
+
+    def test_replaces_stale_unix_socket(self):
+        dir = tempfile.mkdtemp()
+        path = os.path.join(dir, 'metrics.sock')
+        stale = socket.socket(socket.AF_UNIX)
+        stale.bind(path)
+        stale.close()
+        try:
+            server = MetricsServer('unix:%s' % path, lambda: 'metric 1\n')
+            server.start()
+            server.stop()
+        finally:
+            shutil.rmtree(dir)
+
+    def test_unix_socket_in_use(self):
+        dir = tempfile.mkdtemp()
+        path = os.path.join(dir, 'metrics.sock')
+        server = MetricsServer('unix:%s' % path, lambda: 'metric 1\n')
+        server.start()
+        try:
+            with self.assertRaises(MetricsError):
+                MetricsServer('unix:%s' % path, lambda: 'metric 2\n')
+            assert os.path.exists(path)
+        finally:
+            server.stop()
+            shutil.rmtree(dir)
+
+    def test_not_a_socket(self):
+        dir = tempfile.mkdtemp()
+        path = os.path.join(dir, 'metrics.sock')
+        with open(path, 'w') as f:
+            f.write('precious')
+        try:
+            with self.assertRaises(MetricsError):
+                MetricsServer('unix:%s' % path, lambda: 'metric 1\n')
+            with open(path) as f:
+                assert f.read() == 'precious'
+        finally:
+            shutil.rmtree(dir)
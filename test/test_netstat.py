@@ -0,0 +1,129 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from unicornherder.netstat import (accept_queue, is_listening, listen_overflows,
+                                   listening_sockets, listening_unix_sockets,
+                                   listens_on)
+
+TCP = """\
+  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 0100007F:1F90 00000000:0000 0A 00000000:00000003 00:00000000 00000000  1000        0 1001 1 0000000000000000 100 0 0 10 0
+   1: 0100007F:1F90 0100007F:C350 01 00000000:00000000 00:00000000 00000000  1000        0 1002 1 0000000000000000 20 4 30 10 -1
+   2: 00000000:0016 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 9999 1 0000000000000000 100 0 0 10 0
+"""
+
+TCP6 = """\
+  sl  local_address                         remote_address                        st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 00000000000000000000000001000000:1F91 00000000000000000000000000000000:0000 0A 00000000:00000001 00:00000000 00000000  1000        0 1003 1 0000000000000000 100 0 0 10 0
+"""
+
+NETSTAT = """\
+TcpExt: SyncookiesSent SyncookiesRecv ListenOverflows ListenDrops
+TcpExt: 0 0 12 15
+IpExt: InNoRoutes InTruncatedPkts
+IpExt: 0 0
+"""
+
+UNIX = """\
+Num       RefCount Protocol Flags    Type St Inode Path
+0000000000000000: 00000002 00000000 00010000 0001 01 1004 /run/app.sock
+0000000000000000: 00000003 00000000 00000000 0001 03 1005 /run/app.sock
+0000000000000000: 00000002 00000000 00010000 0001 01 9998 /run/other.sock
+"""
+
+
+class TestListeningSockets(unittest.TestCase):
+
+    def setUp(self):
+        self.proc = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.proc, '123', 'fd'))
+        os.makedirs(os.path.join(self.proc, '123', 'net'))
+        for fd, target in enumerate(['socket:[1001]', 'socket:[1002]',
+                                     'socket:[1003]', 'socket:[1004]',
+                                     'socket:[1005]', '/dev/null']):
+            os.symlink(target, os.path.join(self.proc, '123', 'fd', str(fd)))
+        with open(os.path.join(self.proc, '123', 'net', 'tcp'), 'w') as f:
+            f.write(TCP)
+        with open(os.path.join(self.proc, '123', 'net', 'tcp6'), 'w') as f:
+            f.write(TCP6)
+        with open(os.path.join(self.proc, '123', 'net', 'unix'), 'w') as f:
+            f.write(UNIX)
+        with open(os.path.join(self.proc, '123', 'net', 'netstat'), 'w') as f:
+            f.write(NETSTAT)
+
+    def tearDown(self):
+        shutil.rmtree(self.proc)
+
+    def test_listening_sockets(self):
+        sockets = listening_sockets(123, proc=self.proc)
+        assert [(s.address, s.port, s.queue, s.inode) for s in sockets] == [
+            ('127.0.0.1', 8080, 3, 1001),
+            ('::1', 8081, 1, 1003)]
+
+    def test_listen_overflows(self):
+        assert listen_overflows(123, proc=self.proc) == (12, 15)
+        assert listen_overflows(456, proc=self.proc) is None
+
+    def test_listening_unix_sockets(self):
+        assert listening_unix_sockets(123, proc=self.proc) == ['/run/app.sock']
+
+    def test_is_listening(self):
+        assert is_listening(123, proc=self.proc)
+        os.unlink(os.path.join(self.proc, '123', 'fd', '0'))
+        os.unlink(os.path.join(self.proc, '123', 'fd', '2'))
+        assert is_listening(123, proc=self.proc)
+        os.unlink(os.path.join(self.proc, '123', 'fd', '3'))
+        assert not is_listening(123, proc=self.proc)
+
+    def test_listens_on(self):
+        assert listens_on(123, ('tcp', ('127.0.0.1', 8080)), proc=self.proc)
+        assert listens_on(123, ('tcp', ('localhost', 8080)), proc=self.proc)
+        assert listens_on(123, ('tcp', ('::1', 8081)), proc=self.proc)
+        assert not listens_on(123, ('tcp', ('10.0.0.1', 8080)), proc=self.proc)
+        assert not listens_on(123, ('tcp', ('127.0.0.1', 8082)), proc=self.proc)
+        assert listens_on(123, ('unix', '/run/app.sock'), proc=self.proc)
+        assert not listens_on(123, ('unix', '/run/other.sock'), proc=self.proc)
+        assert not listens_on(456, ('tcp', ('127.0.0.1', 8080)), proc=self.proc)
+
+    def test_listens_on_all_addresses(self):
+        os.symlink('socket:[9999]', os.path.join(self.proc, '123', 'fd', '6'))
+        assert listens_on(123, ('tcp', ('10.0.0.1', 22)), proc=self.proc)
+
+    def test_accept_queue(self):
+        assert accept_queue(123, proc=self.proc) == 4
+
+    def test_accept_queue_no_process(self):
+        assert accept_queue(456, proc=self.proc) is None
+
+
+@unittest.skipUnless(os.path.exists('/proc/self/net/tcp'), 'needs /proc/net/tcp')
+class TestLiveSockets(unittest.TestCase):
+
+    def test_counts_queued_connections(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        clients = [socket.create_connection(listener.getsockname()) for _ in range(2)]
+        try:
+            sockets = listening_sockets(os.getpid())
+            port = listener.getsockname()[1]
+            assert [s.queue for s in sockets if s.port == port] == [2]
+        finally:
+            for client in clients:
+                client.close()
+            listener.close()
+
+    def test_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'app.sock')
+        listener = socket.socket(socket.AF_UNIX)
+        try:
+            listener.bind(path)
+            assert path not in listening_unix_sockets(os.getpid())
+            listener.listen(5)
+            assert path in listening_unix_sockets(os.getpid())
+        finally:
+            listener.close()
+            shutil.rmtree(os.path.dirname(path))
@@ -0,0 +1,142 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from mock import MagicMock, patch
+
+from .helpers import children_from_mocks
+from unicornherder.flock import Flock
+from unicornherder.herder import Herder
+from unicornherder.notify import READY_INTERVAL, Notifier
+
+setup_module, teardown_module = children_from_mocks()
+
+
+class TestNotifier(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'notify')
+        self.systemd = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.systemd.bind(self.path)
+        self.systemd.setblocking(False)
+
+    def tearDown(self):
+        self.systemd.close()
+        shutil.rmtree(self.dir)
+
+    def _received(self):
+        lines = []
+        while True:
+            try:
+                lines.extend(self.systemd.recv(4096).decode('utf-8').splitlines())
+            except socket.error:
+                return lines
+
+    def test_from_environment(self):
+        assert Notifier.from_environment({}) is None
+
+        notifier = Notifier.from_environment({'NOTIFY_SOCKET': self.path,
+                                              'WATCHDOG_USEC': '10000000'})
+        assert notifier.address == self.path
+        assert notifier.watchdog == 10
+
+        # The watchdog was meant for some other process
+        notifier = Notifier.from_environment({'NOTIFY_SOCKET': '@abstract',
+                                              'WATCHDOG_USEC': '10000000',
+                                              'WATCHDOG_PID': '1'})
+        assert notifier.address == '\0abstract'
+        assert notifier.watchdog is None
+
+    def test_lifecycle(self):
+        notifier = Notifier(self.path)
+        assert notifier.next_timeout(30) == READY_INTERVAL
+
+        notifier.update(False, status='Booting')
+        notifier.update(True, status='Booting')
+        notifier.update(True, status='Booting')
+        assert self._received() == ['STATUS=Booting', 'READY=1']
+        assert notifier.next_timeout(30) == 30
+
+        notifier.update(True, reloading=True)
+        received = self._received()
+        assert received[0] == 'RELOADING=1'
+        assert received[1].startswith('MONOTONIC_USEC=')
+        notifier.update(True, reloading=True)
+        notifier.update(True)
+        notifier.update(True, stopping=True)
+        assert self._received() == ['READY=1', 'STOPPING=1']
+
+    @patch('unicornherder.timeout.monotonic')
+    def test_watchdog(self, clock_mock):
+        clock_mock.return_value = 0
+        notifier = Notifier(self.path, watchdog=10)
+        notifier.update(True)
+        assert self._received() == ['READY=1', 'WATCHDOG=1']
+        assert notifier.next_timeout(30) == 5
+
+        clock_mock.return_value = 4
+        notifier.update(True)
+        assert self._received() == []
+
+        clock_mock.return_value = 5
+        notifier.update(True)
+        assert self._received() == ['WATCHDOG=1']
+
+    def test_send_errors_are_swallowed(self):
+        notifier = Notifier(os.path.join(self.dir, 'missing'))
+        notifier.update(True)
+        assert notifier.failing
+
+    def test_herder_readiness(self):
+        h = Herder()
+        assert not h._check_ready()
+        assert h._describe() == 'Waiting for gunicorn'
+
+        h.master = MagicMock(pid=123)
+        h.master.children.return_value = []
+        assert not h._check_ready()
+
+        h.booted = True
+        h.tree.refresh()
+        h.master.children.return_value = [MagicMock(), MagicMock()]
+        assert h._check_ready()
+        assert h._describe() == 'PID 123 with 2 workers'
+
+        h.reloading = True
+        assert h._describe() == 'PID 123 with 2 workers, reloading (forking)'
+
+    def test_herder_waits_for_probe(self):
+        h = Herder()
+        h.master = MagicMock(pid=123)
+        h.master.children.return_value = [MagicMock()]
+        h.booted = True
+        h.probe = MagicMock()
+        h.probe.check.return_value = False
+        assert not h._check_ready()
+        h.probe.check.return_value = True
+        assert h._check_ready()
+
+    def test_flock(self):
+        flock = Flock({'one': {'pidfile': 'one.pid'}, 'two': {'pidfile': 'two.pid'}})
+        flock.notifier = Notifier(self.path)
+        for name, herder in flock.herders.items():
+            herder.master = MagicMock(pid=len(name))
+            herder.master.children.return_value = [MagicMock()]
+            herder.booted = True
+        flock.herders['two'].probe = MagicMock()
+        flock.herders['two'].probe.check.return_value = False
+
+        flock._notify()
+        assert self._received() == ['STATUS=one: PID 3 with 1 workers; '
+                                    'two: PID 3 with 1 workers']
+
+        flock.herders['two'].probe.check.return_value = True
+        flock._notify()
+        flock.herders['one'].reloading = True
+        flock._notify()
+        received = self._received()
+        assert received[0] == 'READY=1'
+        assert received[1] == 'RELOADING=1'
@@ -0,0 +1,44 @@
+import psutil
+
+from .helpers import *
+from unicornherder.priority import IONICE_LEVEL, MAX_NICE, Demotion
+
+
+def _process(pid, nice=0, ioclass=psutil.IOPRIO_CLASS_NONE, value=0):
+    return mock_process(pid, nice=nice,
+                        ionice=MagicMock(ioclass=ioclass, value=value))
+
+
+class TestDemotion(object):
+
+    def test_demote_and_restore(self):
+        master = _process(100)
+        worker = _process(101, nice=15, ioclass=psutil.IOPRIO_CLASS_BE, value=2)
+        demotion = Demotion([master, worker], 10)
+
+        assert_equal(demotion.pids, [100, 101])
+        master.nice.assert_called_with(10)
+        worker.nice.assert_called_with(MAX_NICE)
+        master.ionice.assert_called_with(psutil.IOPRIO_CLASS_BE, IONICE_LEVEL)
+
+        demotion.restore()
+        master.nice.assert_called_with(0)
+        master.ionice.assert_called_with(psutil.IOPRIO_CLASS_NONE)
+        worker.nice.assert_called_with(15)
+        worker.ionice.assert_called_with(psutil.IOPRIO_CLASS_BE, 2)
+        assert_equal(demotion.saved, [])
+
+    def test_skips_processes_it_cannot_touch(self):
+        gone = _process(100)
+        gone.nice.side_effect = psutil.NoSuchProcess(100)
+        other = _process(101)
+        other.nice.side_effect = [0, psutil.AccessDenied(101)]
+        demotion = Demotion([gone, other], 5)
+        assert_equal(demotion.pids, [])
+
+    def test_restore_not_permitted(self):
+        process = _process(100)
+        demotion = Demotion([process], 5)
+        process.nice.side_effect = psutil.AccessDenied(100)
+        demotion.restore()
+        assert_equal(demotion.saved, [])
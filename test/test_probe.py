@@ -0,0 +1,145 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from mock import patch
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from unicornherder.probe import (HttpProbe, ProbeError, TcpProbe, UnixProbe,
+                                 parse_probe)
+
+
+def _answer(probe):
+    # HTTP probes answer from a background thread
+    for _ in range(500):
+        passed = probe.check()
+        if passed is not None:
+            return passed
+        time.sleep(0.01)
+    raise AssertionError('Probe %s never answered' % probe)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(200 if self.path == '/healthcheck' else 503)
+        self.end_headers()
+        self.wfile.write(b'OK')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHttpProbe(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), _StubHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base = 'http://127.0.0.1:%s' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_passes_on_success(self):
+        assert _answer(HttpProbe(self.base + '/healthcheck'))
+
+    def test_fails_on_error_status(self):
+        assert not _answer(HttpProbe(self.base + '/broken'))
+
+    def test_does_not_block(self):
+        probe = HttpProbe(self.base + '/healthcheck')
+        assert probe.check() is None
+        assert _answer(probe)
+        # Each answer is only given once
+        assert probe.check() is None
+
+    def test_ignores_proxies(self):
+        env = {'http_proxy': 'http://127.0.0.1:1', 'no_proxy': ''}
+        with patch.dict(os.environ, env):
+            assert _answer(HttpProbe(self.base + '/healthcheck'))
+
+    def test_fails_on_garbage(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+
+        def reply():
+            conn, _ = sock.accept()
+            conn.recv(4096)
+            conn.sendall(b'garbage\r\n')
+            conn.close()
+
+        thread = threading.Thread(target=reply)
+        thread.daemon = True
+        thread.start()
+        try:
+            assert not _answer(HttpProbe('http://127.0.0.1:%s/' % sock.getsockname()[1]))
+        finally:
+            thread.join(5)
+            sock.close()
+
+    def test_tcp_passes_when_listening(self):
+        assert TcpProbe('127.0.0.1', self.server.server_address[1]).check()
+
+
+class TestSocketProbes(unittest.TestCase):
+
+    def test_tcp_fails_when_closed(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        assert not TcpProbe('127.0.0.1', port).check()
+
+    def test_unix(self):
+        dir = tempfile.mkdtemp()
+        path = os.path.join(dir, 'app.sock')
+        try:
+            assert not UnixProbe(path).check()
+            sock = socket.socket(socket.AF_UNIX)
+            sock.bind(path)
+            sock.listen(1)
+            try:
+                assert UnixProbe(path).check()
+            finally:
+                sock.close()
+        finally:
+            shutil.rmtree(dir)
+
+
+class TestParseProbe(unittest.TestCase):
+
+    def test_http(self):
+        probe = parse_probe('http://127.0.0.1:8080/healthcheck')
+        assert isinstance(probe, HttpProbe)
+        assert probe.url == 'http://127.0.0.1:8080/healthcheck'
+        assert probe.target == ('tcp', ('127.0.0.1', 8080))
+        assert parse_probe('https://localhost/').target == ('tcp', ('localhost', 443))
+
+    def test_tcp(self):
+        probe = parse_probe('tcp://127.0.0.1:8080')
+        assert isinstance(probe, TcpProbe)
+        assert probe.address == ('127.0.0.1', 8080)
+        assert probe.target == ('tcp', ('127.0.0.1', 8080))
+
+    def test_unix(self):
+        probe = parse_probe('unix:///var/run/app.sock')
+        assert isinstance(probe, UnixProbe)
+        assert probe.address == '/var/run/app.sock'
+        assert probe.target == ('unix', '/var/run/app.sock')
+
+    def test_invalid(self):
+        for spec in ['ftp://example.com', 'tcp://127.0.0.1', 'unix://']:
+            with self.assertRaises(ProbeError):
+                parse_probe(spec)
@@ -0,0 +1,580 @@
+import psutil
+import signal
+
+from .helpers import *
+from unicornherder.reload import (DRAIN_INTERVAL, KILL_TIMEOUT, PROBE_INTERVAL,
+                                  ROLLING_INTERVAL, ROLLING_TIMEOUT,
+                                  WARMUP_INTERVAL, WORKERS_INTERVAL, Reload)
+
+setup_module, teardown_module = children_from_mocks()
+
+
+def _worker(*statuses):
+    worker = MagicMock()
+    worker.net_connections.return_value = [MagicMock(status=s) for s in statuses]
+    return worker
+
+
+def _masters(old_children=2, new_children=1):
+    old = MagicMock(pid=123)
+    old.children.return_value = ['forked process'] + ['worker'] * (old_children - 1)
+    new = MagicMock(pid=456)
+    new.children.return_value = ['worker'] * new_children
+    return old, new
+
+
+@patch('unicornherder.timeout.monotonic')
+class TestReload(object):
+
+    def test_expected_children(self, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _masters(old_children=4)
+        assert_equal(Reload(old, new).expected_children, 3)
+
+    def test_expected_children_capped(self, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _masters(old_children=9)
+        assert_equal(Reload(old, new, scaled_workers=4).expected_children, 4)
+        assert_equal(Reload(old, new, scaled_workers=12).expected_children, 1)
+        # Scaling down doesn't stop the new master starting its usual number.
+        assert_equal(Reload(old, new, scaled_workers=-2).expected_children, 8)
+
+    def test_waits_for_workers(self, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _masters(new_children=0)
+        reload = Reload(old, new, overlap=10)
+
+        assert_equal(reload.step(), WORKERS_INTERVAL)
+        assert_equal(reload.phase, 'workers')
+
+        new.children.return_value = ['worker']
+        assert_equal(reload.step(), 10)
+        assert_equal(reload.phase, 'overlap')
+        assert_equal(old.send_signal.call_count, 0)
+
+    def test_overlap_then_winch_then_quit(self, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _masters()
+        reload = Reload(old, new, overlap=10)
+        reload.step()
+
+        clock_mock.return_value = 10
+        assert_equal(reload.step(), 1)
+        old.send_signal.assert_called_once_with(signal.SIGWINCH)
+
+        clock_mock.return_value = 11
+        assert_equal(reload.step(), DRAIN_INTERVAL)
+        old.send_signal.assert_called_with(signal.SIGQUIT)
+        assert_equal(reload.phase, 'exit')
+
+        # The reload lasts until the old master has gone.
+        clock_mock.return_value = 13
+        old.is_running.return_value = False
+        assert_equal(reload.step(), None)
+        assert_equal(reload.phase, 'done')
+
+    @patch('unicornherder.reload.listens_on', return_value=False)
+    def test_probe_skips_overlap(self, listens_mock, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _masters()
+        probe = MagicMock()
+        probe.check.side_effect = [False, True]
+        reload = Reload(old, new, overlap=10, probe=probe)
+
+        assert_equal(reload.step(), PROBE_INTERVAL)
+        assert_equal(reload.step(), 1)
+        old.send_signal.assert_called_once_with(signal.SIGWINCH)
+
+    @patch('unicornherder.reload.listens_on', return_value=False)
+    def test_probe_timeout(self, listens_mock, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _masters()
+        probe = MagicMock()
+        probe.check.return_value = False
+        reload = Reload(old, new, probe=probe, probe_timeout=5)
+
+        reload.step()
+        clock_mock.return_value = 5
+        reload.step()
+        old.send_signal.assert_called_once_with(signal.SIGWINCH)
+
+    @patch('unicornherder.reload.listens_on', return_value=False)
+    def test_probe_pending(self, listens_mock, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _masters()
+        probe = MagicMock()
+        probe.check.return_value = None
+        reload = Reload(old, new, probe=probe, rollback_probe_failures=1)
+
+        assert_equal(reload.step(), PROBE_INTERVAL)
+        assert_equal(reload.step(), PROBE_INTERVAL)
+        assert_equal(reload.phase, 'probe')
+
+    @patch('unicornherder.reload.listens_on', return_value=True)
+    def test_probe_shared_with_old_master(self, listens_mock, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _masters()
+        probe = MagicMock()
+        reload = Reload(old, new, overlap=10, probe=probe)
+
+        listens_mock.assert_called_once_with(old.pid, probe.target)
+        assert_equal(reload.probe, None)
+        assert_equal(reload.step(), 10)
+        assert_equal(probe.check.call_count, 0)
+
+    def test_abort(self, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _masters()
+        reload = Reload(old, new)
+        reload.step()
+        reload.abort()
+        assert_equal(reload.step(), None)
+        assert_equal(old.send_signal.call_count, 0)
+
+
+@patch('unicornherder.timeout.monotonic')
+class TestDrain(object):
+
+    def _draining(self, clock_mock, old, drain_timeout=10):
+        clock_mock.return_value = 0
+        new = MagicMock(pid=456)
+        new.children.return_value = ['worker']
+        reload = Reload(old, new, overlap=0, drain_timeout=drain_timeout)
+        old.reset_mock()
+        return reload
+
+    def test_waits_for_drain(self, clock_mock):
+        old = MagicMock(pid=123)
+        old.children.return_value = []
+        reload = self._draining(clock_mock, old)
+        busy = _worker(psutil.CONN_ESTABLISHED, psutil.CONN_LISTEN)
+        idle = _worker(psutil.CONN_LISTEN)
+        old.children.side_effect = [[busy], [idle]]
+        old.is_running.return_value = True
+        old.status.return_value = psutil.STATUS_SLEEPING
+
+        assert_equal(reload.step(), DRAIN_INTERVAL)
+        assert_equal(reload.step(), DRAIN_INTERVAL)
+        assert_equal(reload.phase, 'exit')
+
+        old.is_running.return_value = False
+        assert_equal(reload.step(), None)
+        expected_calls = [call.send_signal(signal.SIGWINCH),
+                          call.children(),
+                          call.children(),
+                          call.send_signal(signal.SIGQUIT),
+                          call.is_running(),
+                          call.status(),
+                          call.is_running()]
+        assert_equal(old.mock_calls, expected_calls)
+
+    def test_zombie_has_exited(self, clock_mock):
+        old = MagicMock(pid=123)
+        old.children.return_value = []
+        reload = self._draining(clock_mock, old)
+        old.is_running.return_value = True
+        old.status.return_value = psutil.STATUS_ZOMBIE
+
+        assert_equal(reload.step(), None)
+        assert_equal(old.kill.call_count, 0)
+
+    def test_drain_timeout(self, clock_mock):
+        old = MagicMock(pid=123)
+        old.children.return_value = []
+        reload = self._draining(clock_mock, old)
+        old.children.return_value = [_worker(psutil.CONN_ESTABLISHED)]
+
+        reload.step()
+        assert_equal(old.send_signal.call_count, 1)
+
+        clock_mock.return_value = 10
+        reload.step()
+        old.send_signal.assert_called_with(signal.SIGQUIT)
+        assert_equal(reload.phase, 'exit')
+
+    def test_kills_stuck_master(self, clock_mock):
+        old = MagicMock(pid=123)
+        old.children.return_value = []
+        old.is_running.return_value = True
+        reload = self._draining(clock_mock, old)
+
+        assert_equal(reload.step(), DRAIN_INTERVAL)
+        assert_equal(old.kill.call_count, 0)
+
+        clock_mock.return_value = KILL_TIMEOUT
+        assert_equal(reload.step(), None)
+        old.kill.assert_called_once_with()
+
+    def test_never_kills_without_drain_timeout(self, clock_mock):
+        old = MagicMock(pid=123)
+        old.children.return_value = []
+        old.is_running.return_value = True
+        reload = self._draining(clock_mock, old, drain_timeout=None)
+        assert_equal(reload.step(), 1)
+
+        clock_mock.return_value = 1
+        assert_equal(reload.step(), DRAIN_INTERVAL)
+        assert_equal(reload.phase, 'exit')
+
+        clock_mock.return_value = 1 + KILL_TIMEOUT
+        assert_equal(reload.step(), None)
+        assert_equal(old.kill.call_count, 0)
+        assert_equal(old.send_signal.call_args_list,
+                     [call(signal.SIGWINCH), call(signal.SIGQUIT)])
+
+
+class _Master(object):
+    """A master whose workers follow TTIN and TTOU straight away."""
+
+    def __init__(self, pid, workers, rss=0):
+        self.pid = pid
+        self.workers = workers
+        self.rss = rss
+        self.extra = []
+        self.signals = []
+        self.peak = workers
+        self.running = True
+        # Bumped when the workers crash and are replaced
+        self.generation = 0
+
+    def children(self):
+        workers = []
+        for i in range(self.workers):
+            worker = MagicMock(pid=(self.pid * 100 + self.generation) * 100 + i)
+            worker.memory_info.return_value.rss = self.rss
+            workers.append(worker)
+        return workers + self.extra
+
+    def send_signal(self, signum):
+        self.signals.append(signum)
+        if signum == signal.SIGTTIN:
+            self.workers += 1
+        elif signum == signal.SIGTTOU:
+            self.workers -= 1
+        elif signum == signal.SIGQUIT:
+            self.running = False
+        self.peak = max(self.peak, self.workers)
+
+    def is_running(self):
+        return self.running
+
+    def oneshot(self):
+        return MagicMock()
+
+    def memory_info(self):
+        return MagicMock(rss=0)
+
+    def cpu_times(self):
+        return MagicMock(user=0, system=0)
+
+
+def _rolling_masters(workers=6, rss=0):
+    new = _Master(456, workers, rss)
+    old = _Master(123, workers, rss)
+    old.extra = [new]
+    return old, new
+
+
+def _run(reload, clock_mock, limit=1000):
+    """Step a reload until it leaves the rolling phase, returning the peak total."""
+    old, new = reload.old_master, reload.new_master
+    peak = 0
+    for _ in range(limit):
+        if reload.phase != 'rolling':
+            break
+        clock_mock.return_value += reload.step() or 0
+        if not reload.signals:
+            peak = max(peak, old.workers + new.workers)
+    return peak
+
+
+@patch('unicornherder.timeout.monotonic')
+class TestRolling(object):
+
+    def test_rolling_handover(self, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _rolling_masters(workers=6)
+        reload = Reload(old, new, overlap=10, rolling_step=2)
+        assert_equal(reload.phase, 'rolling')
+
+        peak = _run(reload, clock_mock)
+        assert_equal((old.workers, new.workers), (2, 6))
+        # Never more than one full set plus a step
+        assert_true(peak <= 8)
+
+        # And then on with the usual overlap
+        assert_equal(reload.phase, 'overlap')
+
+    def test_step_bigger_than_pool(self, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _rolling_masters(workers=2)
+        reload = Reload(old, new, rolling_step=2)
+        assert_equal(reload.phase, 'workers')
+        assert_equal(new.signals, [])
+
+    def test_waits_for_new_workers(self, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _rolling_masters(workers=4)
+        reload = Reload(old, new, rolling_step=1)
+        # Flush the trim, but the new master doesn't stop its workers
+        new.send_signal = lambda signum: None
+        for _ in range(3):
+            reload.step()
+        new.workers = 0
+
+        assert_equal(reload.step(), ROLLING_INTERVAL)
+        assert_equal(old.signals, [])
+
+    @patch('unicornherder.reload.listens_on', return_value=False)
+    def test_readiness_gate(self, listens_mock, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _rolling_masters(workers=4)
+        probe = MagicMock()
+        probe.check.return_value = False
+        reload = Reload(old, new, probe=probe, rolling_step=1)
+        for _ in range(3):
+            reload.step()
+
+        assert_equal(reload.step(), PROBE_INTERVAL)
+        assert_equal(old.signals, [])
+
+    def test_budget(self, clock_mock):
+        clock_mock.return_value = 0
+        # 4 workers of 100 bytes each, so one full set is 400
+        old, new = _rolling_masters(workers=4, rss=100)
+        reload = Reload(old, new, rolling_step=1, rolling_budget=450)
+        _run(reload, clock_mock, limit=50)
+
+        # With no room for even one more worker, the new master can't grow.
+        assert_equal(new.workers, 1)
+        assert_equal(old.workers, 3)
+
+    def test_stalled(self, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _rolling_masters(workers=4)
+        reload = Reload(old, new, rolling_step=1)
+        for _ in range(3):
+            reload.step()
+        # The old master ignores TTOU
+        old.send_signal = lambda signum: None
+        reload.step()
+        assert_equal(reload.step(), ROLLING_INTERVAL)
+
+        clock_mock.return_value = ROLLING_TIMEOUT + 1
+        _run(reload, clock_mock)
+        assert_equal(reload.phase, 'overlap')
+        assert_equal(new.workers, 4)
+
+
+@patch('unicornherder.timeout.monotonic')
+class TestRollback(object):
+
+    def test_crashing_workers(self, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _masters(old_children=3, new_children=0)
+        reload = Reload(old, new, rollback_crashes=2)
+        for pid in [1, 2]:
+            new.children.return_value = [MagicMock(pid=pid)]
+            assert_equal(reload.step(), WORKERS_INTERVAL)
+
+        # The third worker replaces the second crash
+        new.children.return_value = [MagicMock(pid=3)]
+        reload.step()
+        assert_true(reload.rolled_back)
+        assert_equal(reload.phase, 'rollback')
+        new.send_signal.assert_called_once_with(signal.SIGQUIT)
+
+        new.is_running.return_value = False
+        assert_equal(reload.step(), None)
+        # The old master never gave anything up
+        assert_equal(old.send_signal.call_count, 0)
+
+    def test_restores_workers_after_winch(self, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _masters(old_children=3)
+        new.children.return_value = [MagicMock(), MagicMock()]
+        reload = Reload(old, new, overlap=0, rollback_crashes=1)
+        assert_equal(reload.step(), 1)
+        assert_equal(reload.phase, 'drain')
+
+        new.children.return_value = [MagicMock(), MagicMock()]
+        new.is_running.return_value = False
+        while reload.step() is not None:
+            pass
+        assert_equal(old.send_signal.call_args_list,
+                     [call(signal.SIGWINCH), call(signal.SIGTTIN), call(signal.SIGTTIN)])
+
+    def test_new_master_exits(self, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _masters()
+        reload = Reload(old, new, rollback_crashes=5)
+        new.children.side_effect = psutil.NoSuchProcess(456)
+        reload.step()
+        assert_true(reload.rolled_back)
+
+    def test_new_master_exits_without_rollback(self, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _masters(new_children=0)
+        reload = Reload(old, new)
+        assert_equal(reload.step(), WORKERS_INTERVAL)
+        assert_equal(reload.phase, 'workers')
+
+        new.children.side_effect = psutil.NoSuchProcess(456)
+        new.is_running.return_value = False
+        assert_equal(reload.step(), None)
+        assert_true(reload.rolled_back)
+        # Neither master is signalled: the old one is all we have left.
+        assert_equal(old.send_signal.call_count, 0)
+        assert_equal(new.send_signal.call_count, 0)
+
+    @patch('unicornherder.reload.listens_on', return_value=False)
+    def test_probe_failures(self, listens_mock, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _masters()
+        probe = MagicMock()
+        probe.check.return_value = False
+        reload = Reload(old, new, probe=probe, rollback_probe_failures=3)
+        for _ in range(2):
+            assert_equal(reload.step(), PROBE_INTERVAL)
+        assert_false(reload.rolled_back)
+
+        reload.step()
+        assert_true(reload.rolled_back)
+
+    def test_rolling_handover(self, clock_mock):
+        clock_mock.return_value = 0
+        old, new = _rolling_masters(workers=4)
+        reload = Reload(old, new, rolling_step=1, rollback_crashes=1)
+        # Trimming the new master doesn't count as crashing
+        for _ in range(4):
+            clock_mock.return_value += reload.step() or 0
+        assert_equal(reload.phase, 'rolling')
+        assert_equal(old.workers, 3)
+
+        new.generation += 1
+        while reload.step() is not None:
+            pass
+        assert_true(reload.rolled_back)
+        assert_false(new.running)
+        assert_equal(old.workers, 4)
+
+
+@patch('unicornherder.reload.Demotion')
+@patch('unicornherder.timeout.monotonic')
+class TestDemotion(object):
+
+    def _masters(self):
+        old, new = _masters()
+        worker = MagicMock(pid=124)
+        old.children.return_value = [new, worker]
+        return old, new, worker
+
+    def test_demotes_once_new_workers_are_up(self, clock_mock, demotion_mock):
+        clock_mock.return_value = 0
+        old, new, worker = self._masters()
+        new.children.return_value = []
+        reload = Reload(old, new, overlap=10, demote=10)
+        reload.step()
+        assert_equal(demotion_mock.call_count, 0)
+
+        new.children.return_value = ['worker']
+        reload.step()
+        # Not the new master, even though it's one of the old master's children
+        demotion_mock.assert_called_once_with([old, worker], 10)
+
+        clock_mock.return_value = 10
+        old.is_running.return_value = False
+        while reload.step() is not None:
+            clock_mock.return_value += 1
+        assert_equal(demotion_mock.return_value.restore.call_count, 0)
+
+    def test_restores_on_abort(self, clock_mock, demotion_mock):
+        clock_mock.return_value = 0
+        old, new, worker = self._masters()
+        reload = Reload(old, new, demote=10)
+        reload.step()
+        reload.abort()
+        demotion_mock.return_value.restore.assert_called_once_with()
+
+    @patch('unicornherder.reload.listens_on', return_value=False)
+    def test_restores_on_rollback(self, listens_mock, clock_mock, demotion_mock):
+        clock_mock.return_value = 0
+        old, new, worker = self._masters()
+        probe = MagicMock()
+        probe.check.return_value = False
+        reload = Reload(old, new, probe=probe, rollback_probe_failures=1, demote=10)
+        reload.step()
+        assert_true(reload.rolled_back)
+        demotion_mock.return_value.restore.assert_called_once_with()
+
+    def test_off_by_default(self, clock_mock, demotion_mock):
+        clock_mock.return_value = 0
+        old, new, worker = self._masters()
+        reload = Reload(old, new)
+        reload.step()
+        reload.abort()
+        assert_equal(demotion_mock.call_count, 0)
+
+
+def _warmup(*latencies):
+    warmup = MagicMock(latency=0.1, target=('tcp', ('127.0.0.1', 8080)))
+    rounds = [MagicMock(latency=l, errors=0) for l in latencies]
+    for round in rounds:
+        round.done.return_value = False
+    warmup.start.side_effect = rounds
+    warmup.settled.side_effect = lambda round: round.latency <= 0.1
+    return warmup
+
+
+@patch('unicornherder.reload.listens_on', return_value=False)
+@patch('unicornherder.timeout.monotonic')
+class TestWarmup(object):
+
+    def test_warms_up_until_settled(self, clock_mock, listens_mock):
+        clock_mock.return_value = 0
+        old, new = _masters()
+        warmup = _warmup(0.5, 0.05)
+        reload = Reload(old, new, overlap=30, warmup=warmup)
+
+        assert_equal(reload.step(), WARMUP_INTERVAL)
+        assert_equal(reload.phase, 'warmup')
+        assert_equal(reload.state, 'warming')
+        listens_mock.assert_called_once_with(123, ('tcp', ('127.0.0.1', 8080)))
+
+        # Too slow, so another round
+        reload.warmup_round.done.return_value = True
+        assert_equal(reload.step(), WARMUP_INTERVAL)
+        assert_equal(old.send_signal.call_count, 0)
+
+        # Fast enough: no need for the overlap
+        reload.warmup_round.done.return_value = True
+        assert_equal(reload.step(), 1)
+        old.send_signal.assert_called_once_with(signal.SIGWINCH)
+        assert_equal(reload.warmup_rounds, 2)
+
+    def test_after_probe(self, clock_mock, listens_mock):
+        clock_mock.return_value = 0
+        old, new = _masters()
+        probe = MagicMock()
+        probe.check.return_value = True
+        reload = Reload(old, new, probe=probe, warmup=_warmup(0.05))
+        assert_equal(reload.step(), WARMUP_INTERVAL)
+        assert_equal(reload.phase, 'warmup')
+
+    def test_timeout(self, clock_mock, listens_mock):
+        clock_mock.return_value = 0
+        old, new = _masters()
+        reload = Reload(old, new, warmup=_warmup(0.5, 0.5), warmup_timeout=10)
+        reload.step()
+
+        clock_mock.return_value = 10
+        assert_equal(reload.step(), 1)
+        old.send_signal.assert_called_once_with(signal.SIGWINCH)
+
+    def test_target_shared_with_old_master(self, clock_mock, listens_mock):
+        clock_mock.return_value = 0
+        old, new = _masters()
+        listens_mock.return_value = True
+        reload = Reload(old, new, warmup=_warmup())
+        assert_equal(reload.step(), 1)
+        assert_equal(reload.phase, 'drain')
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import psutil
+from mock import MagicMock, patch
+
+from .helpers import children_from_mocks
+from unicornherder.sharing import (ProcessMemory, SharingMonitor, process_memory,
+                                   smaps_rollup)
+
+setup_module, teardown_module = children_from_mocks()
+
+ROLLUP = """\
+00400000-7ffc5a1f7000 ---p 00000000 00:00 0                              [rollup]
+Rss:               %(rss)d kB
+Pss:               %(pss)d kB
+Shared_Clean:      %(shared)d kB
+Shared_Dirty:          0 kB
+Private_Clean:       100 kB
+Private_Dirty:     %(dirty)d kB
+Referenced:        %(rss)d kB
+Anonymous:          4000 kB
+Swap:                  0 kB
+SwapPss:               0 kB
+Locked:                0 kB
+"""
+
+
+class TestSharing(unittest.TestCase):
+
+    def setUp(self):
+        self.proc = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.proc)
+
+    def _rollup(self, pid, shared, private):
+        os.mkdir(os.path.join(self.proc, str(pid)))
+        with open(os.path.join(self.proc, str(pid), 'smaps_rollup'), 'w') as f:
+            f.write(ROLLUP % {'rss': shared + private, 'pss': shared // 4 + private,
+                              'shared': shared, 'dirty': private - 100})
+
+    def _master(self, *workers):
+        self._rollup(100, 8000, 2000)
+        master = MagicMock(pid=100)
+        master.children.return_value = []
+        for i, (shared, private) in enumerate(workers):
+            self._rollup(101 + i, shared, private)
+            master.children.return_value.append(MagicMock(pid=101 + i))
+        return master
+
+    def test_smaps_rollup(self):
+        self._rollup(123, 6000, 2000)
+        assert smaps_rollup(123, self.proc) == ProcessMemory(
+            123, 8000 * 1024, 3500 * 1024, 2000 * 1024, 6000 * 1024)
+        assert smaps_rollup(124, self.proc) is None
+
+    def test_falls_back_to_psutil(self):
+        process = MagicMock(pid=123)
+        process.memory_full_info.return_value = MagicMock(rss=1000, pss=600, uss=400)
+        assert process_memory(process, self.proc) == ProcessMemory(123, 1000, 600, 400, 600)
+
+    @patch('unicornherder.sharing.log')
+    def test_report(self, log_mock):
+        monitor = SharingMonitor(proc=self.proc)
+        report = monitor.check(self._master((6000, 2000), (6000, 2000)))
+
+        assert report.master.pid == 100
+        assert [w.pid for w in report.workers] == [101, 102]
+        assert report.ratio == 0.75
+        assert log_mock.info.call_count == 1
+        assert log_mock.warn.call_count == 0
+
+    @patch('unicornherder.sharing.log')
+    def test_warns_when_sharing_falls(self, log_mock):
+        monitor = SharingMonitor(proc=self.proc)
+        monitor.check(self._master((6000, 2000)))
+        shutil.rmtree(self.proc)
+        os.mkdir(self.proc)
+
+        report = monitor.check(self._master((1000, 7000)))
+        assert report.ratio == 0.125
+        assert log_mock.warn.call_count == 1
+
+    def test_without_workers(self):
+        report = SharingMonitor(proc=self.proc).check(self._master())
+        assert report.ratio is None
+        assert report.workers == []
+
+    def test_vanished(self):
+        master = MagicMock(pid=100)
+        master.children.side_effect = psutil.NoSuchProcess(100)
+        assert SharingMonitor(proc=self.proc).check(master) is None
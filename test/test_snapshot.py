@@ -0,0 +1,82 @@
+import os
+import psutil
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from mock import MagicMock
+
+from unicornherder.snapshot import ProcessTree, child_pids
+
+
+class TestChildPids(unittest.TestCase):
+
+    def setUp(self):
+        self.proc = tempfile.mkdtemp()
+        for tid, children in (('100', '101 102 '), ('103', '104 ')):
+            os.makedirs(os.path.join(self.proc, '100', 'task', tid))
+            with open(os.path.join(self.proc, '100', 'task', tid, 'children'), 'w') as f:
+                f.write(children)
+
+    def tearDown(self):
+        shutil.rmtree(self.proc)
+
+    def test_every_thread(self):
+        assert sorted(child_pids(100, self.proc)) == [101, 102, 104]
+
+    def test_no_such_process(self):
+        assert child_pids(200, self.proc) is None
+
+
+class TestProcessTree(unittest.TestCase):
+
+    def test_snapshot(self):
+        master = MagicMock(pid=100)
+        master.children.return_value = ['worker']
+        tree = ProcessTree(proc=None)
+
+        assert tree.children(master) == ['worker']
+        master.children.return_value = ['worker', 'worker']
+        assert tree.children(master) == ['worker']
+        assert master.children.call_count == 1
+
+        tree.refresh()
+        assert tree.children(master) == ['worker', 'worker']
+
+    def test_stats(self):
+        worker = MagicMock(pid=101)
+        worker.memory_info.return_value.rss = 1024
+        worker.cpu_times.return_value = MagicMock(user=1.5, system=0.5)
+        tree = ProcessTree()
+
+        stats = tree.stats(worker)
+        assert (stats.rss, stats.cpu_user, stats.cpu_system) == (1024, 1.5, 0.5)
+        tree.stats(worker)
+        assert worker.oneshot.call_count == 1
+
+    def test_gone(self):
+        master = MagicMock(pid=100)
+        master.children.side_effect = psutil.NoSuchProcess(100)
+        with self.assertRaises(psutil.NoSuchProcess):
+            ProcessTree(proc=None).children(master)
+
+    @unittest.skipIf(child_pids(os.getpid()) is None, 'needs /proc/PID/task/TID/children')
+    def test_live(self):
+        tree = ProcessTree()
+        me = psutil.Process()
+        child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(10)'])
+        try:
+            children = tree.children(me)
+            assert child.pid in [c.pid for c in children]
+
+            # The same objects are handed out in the next snapshot.
+            tree.refresh()
+            again = [c for c in tree.children(me) if c.pid == child.pid]
+            assert again[0] is [c for c in children if c.pid == child.pid][0]
+        finally:
+            child.kill()
+            child.wait()
+        tree.refresh()
+        assert child.pid not in [c.pid for c in tree.children(me)]
@@ -0,0 +1,110 @@
+import json
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import unittest
+
+from mock import MagicMock, patch
+
+from .helpers import children_from_mocks
+from unicornherder.reload import Reload
+from unicornherder.timeline import Timeline, TimelineError, signal_name
+
+setup_module, teardown_module = children_from_mocks()
+
+
+class TestTimeline(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'reloads.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _events(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_file(self):
+        timeline = Timeline(self.path, pidfile='app.pid')
+        timeline.bind(reload=1).event('hup', pid=123)
+        timeline.event('other')
+        timeline.close()
+
+        events = self._events()
+        assert [e['event'] for e in events] == ['hup', 'other']
+        assert events[0]['reload'] == 1
+        assert events[0]['pid'] == 123
+        assert events[0]['pidfile'] == 'app.pid'
+        assert 'reload' not in events[1]
+        assert 'time' in events[0] and 'monotonic' in events[0]
+
+    def test_unix(self):
+        path = os.path.join(self.dir, 'timeline.sock')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        listener.bind(path)
+        try:
+            timeline = Timeline('unix:%s' % path)
+            timeline.event('hup')
+            assert json.loads(listener.recv(4096).decode('utf-8'))['event'] == 'hup'
+            timeline.close()
+        finally:
+            listener.close()
+
+    def test_write_errors_are_swallowed(self):
+        timeline = Timeline('unix:%s' % os.path.join(self.dir, 'nobody-listening'))
+        timeline.event('hup')
+        timeline.event('hup')
+        assert timeline.sink.failing
+
+    def test_bad_targets(self):
+        with self.assertRaises(TimelineError):
+            Timeline('udp:localhost')
+        with self.assertRaises(TimelineError):
+            Timeline(os.path.join(self.dir, 'missing', 'reloads.jsonl'))
+
+    def test_signal_name(self):
+        assert signal_name(signal.SIGWINCH) == 'WINCH'
+
+    @patch('unicornherder.reload.monotonic')
+    @patch('unicornherder.timeout.monotonic')
+    def test_reload_events(self, clock_mock, reload_clock_mock):
+        now = [0]
+        reload_clock_mock.side_effect = clock_mock.side_effect = lambda: now[0]
+        old = MagicMock(pid=123)
+        old.children.return_value = ['new master', 'worker']
+        new = MagicMock(pid=456)
+        new.children.return_value = ['worker']
+        timeline = Timeline(self.path).bind(reload=7)
+
+        reload = Reload(old, new, overlap=10, timeline=timeline)
+        reload.step()
+        now[0] = 10
+        reload.step()
+        now[0] = 11
+        reload.step()
+        now[0] = 12
+        old.is_running.return_value = False
+        reload.step()
+        timeline.close()
+
+        events = self._events()
+        assert [(e['event'], e.get('phase') or e.get('signal')) for e in events] == [
+            ('phase', 'workers'),
+            ('workers_ready', None),
+            ('phase', 'overlap'),
+            ('signal', 'WINCH'),
+            ('phase', 'drain'),
+            ('signal', 'QUIT'),
+            ('phase', 'exit'),
+            ('exited', None),
+            ('phase', 'done'),
+            ('summary', None)]
+        assert all(e['reload'] == 7 for e in events)
+        assert events[-1]['durations']['overlap'] == 10
+        assert events[-1]['durations']['exit'] == 1
+        assert events[-1]['duration'] == 12
+        assert events[-1]['aborted'] is False
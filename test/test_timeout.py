@@ -0,0 +1,33 @@
+import unittest
+
+from mock import patch
+
+from unicornherder.timeout import Deadline, TimeoutError
+
+
+@patch('unicornherder.timeout.monotonic')
+class TestDeadline(unittest.TestCase):
+
+    def test_remaining(self, clock_mock):
+        clock_mock.return_value = 100
+        deadline = Deadline(2.5)
+        clock_mock.return_value = 101
+        assert deadline.remaining() == 1.5
+        assert not deadline.expired()
+
+    def test_expired(self, clock_mock):
+        clock_mock.return_value = 100
+        deadline = Deadline(0.5)
+        clock_mock.return_value = 100.5
+        assert deadline.remaining() == 0
+        assert deadline.expired()
+        with self.assertRaises(TimeoutError):
+            deadline.check()
+
+    def test_deadlines_are_independent(self, clock_mock):
+        clock_mock.return_value = 100
+        outer = Deadline(10)
+        inner = Deadline(1)
+        clock_mock.return_value = 102
+        assert inner.expired()
+        assert not outer.expired()
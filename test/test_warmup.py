@@ -0,0 +1,91 @@
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+from unicornherder.metrics import MetricsServer
+from unicornherder.warmup import (Warmup, WarmupError, WarmupRequest,
+                                  load_requests, parse_target)
+
+
+def _wait(round):
+    for _ in range(500):
+        if round.done():
+            return round
+        time.sleep(0.01)
+    raise AssertionError('Warm-up round never finished')
+
+
+class TestWarmup(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _file(self, text):
+        path = os.path.join(self.dir, 'warmup.txt')
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_load_requests(self):
+        path = self._file('# Home page\n/\n\npost /search?q=x\n')
+        assert load_requests(path) == [WarmupRequest('GET', '/'),
+                                       WarmupRequest('POST', '/search?q=x')]
+
+        self.assertRaises(WarmupError, load_requests, self._file('GET search\n'))
+        self.assertRaises(WarmupError, load_requests, self._file('# Nothing\n'))
+        self.assertRaises(WarmupError, load_requests, os.path.join(self.dir, 'missing'))
+
+    def test_parse_target(self):
+        assert parse_target('http://127.0.0.1:8080') == ('tcp', ('127.0.0.1', 8080))
+        assert parse_target('http://localhost') == ('tcp', ('localhost', 80))
+        assert parse_target('unix:///run/app.sock') == ('unix', '/run/app.sock')
+        self.assertRaises(WarmupError, parse_target, 'https://localhost')
+        self.assertRaises(WarmupError, parse_target, 'unix://')
+
+    def test_round_over_tcp(self):
+        server = MetricsServer('127.0.0.1:0', lambda: 'metric 1\n')
+        server.start()
+        try:
+            target = ('tcp', ('127.0.0.1', server.server.server_address[1]))
+            warmup = Warmup([WarmupRequest('GET', '/metrics'),
+                             WarmupRequest('GET', '/missing')] * 3,
+                            target, concurrency=2, latency=5)
+            round = _wait(warmup.start())
+            assert round.errors == 0
+            assert len(round.latencies) == 6
+            assert warmup.settled(round)
+
+            warmup.latency = 0
+            assert not warmup.settled(round)
+        finally:
+            server.stop()
+
+    def test_round_over_unix(self):
+        path = os.path.join(self.dir, 'app.sock')
+        server = MetricsServer('unix:%s' % path, lambda: 'metric 1\n')
+        server.start()
+        try:
+            round = _wait(Warmup([WarmupRequest('GET', '/metrics')], ('unix', path)).start())
+            assert round.errors == 0
+            assert round.latency is not None
+        finally:
+            server.stop()
+
+    def test_round_with_errors(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        warmup = Warmup([WarmupRequest('GET', '/')], ('tcp', ('127.0.0.1', port)),
+                        latency=5)
+        round = _wait(warmup.start())
+        assert round.errors == 1
+        assert round.latency is None
+        assert not warmup.settled(round)
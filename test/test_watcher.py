@@ -0,0 +1,71 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from mock import patch
+
+from unicornherder.events import Waiter
+from unicornherder.watcher import InotifyWatcher, PollWatcher, watch
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is Linux-only')
+class TestInotifyWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.pidfile = os.path.join(self.dir, 'gunicorn.pid')
+        self.watcher = InotifyWatcher([self.pidfile + '.2',
+                                       self.pidfile,
+                                       self.pidfile + '.oldbin'])
+        self.waiter = Waiter()
+        self.waiter.add_watcher(self.watcher)
+
+    def tearDown(self):
+        self.waiter.close()
+        shutil.rmtree(self.dir)
+
+    def _write(self, filename, content):
+        with open(filename, 'w') as f:
+            f.write(content)
+
+    def test_idle_wait_times_out(self):
+        assert self.waiter.wait(0.01) is False
+
+    def test_wakes_on_pidfile_write(self):
+        self._write(self.pidfile, '123\n')
+        assert self.waiter.wait(1) is True
+
+    def test_wakes_on_pidfile_rename(self):
+        self._write(self.pidfile, '123\n')
+        self.waiter.wait(1)
+        os.rename(self.pidfile, self.pidfile + '.oldbin')
+        assert self.waiter.wait(1) is True
+        # The events have all been read
+        assert self.waiter.wait(0.01) is False
+
+    def test_reads_pidfile_changes(self):
+        self._write(self.pidfile, '123\n')
+        assert self.watcher.read() is True
+        assert self.watcher.read() is False
+
+    def test_ignores_unrelated_files(self):
+        self._write(os.path.join(self.dir, 'other.txt'), 'hello')
+        assert self.watcher.read() is False
+
+
+class TestWatch(unittest.TestCase):
+
+    @patch('unicornherder.watcher.InotifyWatcher')
+    def test_falls_back_to_polling(self, inotify_mock):
+        inotify_mock.side_effect = OSError(38, 'Function not implemented')
+        assert isinstance(watch(['gunicorn.pid']), PollWatcher)
+
+    @patch('unicornherder.events.select.select')
+    def test_poll_watcher_sleeps(self, select_mock):
+        select_mock.return_value = ([], [], [])
+        waiter = Waiter()
+        waiter.add_watcher(PollWatcher(['gunicorn.pid']))
+        assert waiter.wait(2) is False
+        select_mock.assert_called_once_with([], [], [], 2)
@@ -0,0 +1,156 @@
+import glob
+import logging
+import os
+import psutil
+import re
+
+from .snapshot import ProcessTree
+
+log = logging.getLogger(__name__)
+
+NODE_DIR = '/sys/devices/system/node'
+
+MODES = ('cpu', 'node')
+
+
+class AffinityError(Exception):
+    pass
+
+
+def parse_cpulist(text):
+    """
+
+    Parse a kernel CPU list such as ``0-3,8,10-11`` into a sorted list of CPU
+    numbers.
+
+    """
+    cpus = set()
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        try:
+            cpus.update(range(int(first), int(last or first) + 1))
+        except ValueError:
+            raise AffinityError('Invalid CPU list %r' % text)
+    return sorted(cpus)
+
+
+def numa_nodes(node_dir=NODE_DIR):
+    """
+
+    Return the CPUs of each NUMA node, in node order, from
+    /sys/devices/system/node/nodeN/cpulist, or None if the kernel doesn't
+    describe any (it needs CONFIG_NUMA).
+
+    """
+    nodes = []
+    for path in glob.glob(os.path.join(node_dir, 'node*')):
+        match = re.match(r'node(\d+)$', os.path.basename(path))
+        if match is None:
+            continue
+        try:
+            with open(os.path.join(path, 'cpulist')) as f:
+                nodes.append((int(match.group(1)), parse_cpulist(f.read())))
+        except (IOError, OSError):
+            continue
+    if not nodes:
+        return None
+    return [cpus for _, cpus in sorted(nodes)]
+
+
+class WorkerPlacer(object):
+    """
+
+    Pins workers to CPUs, so that each one keeps its caches warm rather than
+    being moved from core to core by the scheduler.
+
+    With ``mode`` 'cpu' each worker is pinned to a single CPU, and with 'node'
+    to all the CPUs of one NUMA node, so that its memory stays local. Only the
+    CPUs the herder itself may run on are used, so a herder started under
+    ``taskset`` or in a cpuset cgroup keeps its workers within the same set.
+
+    Every ``check()`` pins the workers that have appeared since the last one
+    -- after a reload, or when the master replaces a worker that died -- to
+    whichever CPU or node has the fewest workers already, so that the
+    workers stay evenly spread however they come and go. Workers are read
+    from ``tree``, a ProcessTree shared with the rest of the herder, if given.
+
+    """
+
+    def __init__(self, mode='cpu', tree=None, node_dir=NODE_DIR, cpus=None):
+        if mode not in MODES:
+            raise AffinityError('Unknown placement mode %r: expected cpu or node' % mode)
+        if not hasattr(psutil.Process, 'cpu_affinity'):
+            raise AffinityError('Setting CPU affinity is not supported on this platform')
+        if cpus is None:
+            cpus = psutil.Process().cpu_affinity()
+        allowed = set(cpus)
+
+        if mode == 'node':
+            nodes = numa_nodes(node_dir)
+            if nodes is None:
+                log.warn('No NUMA nodes found in %s, treating the machine as one node',
+                         node_dir)
+                nodes = [sorted(allowed)]
+            self.slots = [[c for c in node if c in allowed] for node in nodes]
+            self.slots = [slot for slot in self.slots if slot]
+        else:
+            self.slots = [[c] for c in sorted(allowed)]
+        if not self.slots:
+            raise AffinityError('No CPUs to place workers on')
+
+        self.mode = mode
+        self.tree = tree
+        self.placed = {}
+
+    def check(self, *masters):
+        """
+
+        Pin any workers of ``masters`` that haven't been pinned yet. Returns
+        the PIDs of the workers pinned.
+
+        During a reload the new master is still a child of the old one, but
+        it isn't a worker: pinning it would pin everything it forks. Pass
+        both masters, and neither is treated as a worker of the other.
+
+        """
+        tree = self.tree or ProcessTree()
+        master_pids = set(m.pid for m in masters)
+        workers = []
+        for master in masters:
+            try:
+                workers.extend(c for c in tree.children(master)
+                               if c.pid not in master_pids)
+            except psutil.NoSuchProcess:
+                continue
+
+        # Forget about workers which have gone, freeing their places.
+        live = set(w.pid for w in workers)
+        for pid in list(self.placed):
+            if pid not in live:
+                del self.placed[pid]
+
+        pinned = []
+        for worker in workers:
+            if worker.pid in self.placed:
+                continue
+            counts = [0] * len(self.slots)
+            for slot in self.placed.values():
+                if slot is not None:
+                    counts[slot] += 1
+            slot = counts.index(min(counts))
+            try:
+                worker.cpu_affinity(self.slots[slot])
+            except psutil.NoSuchProcess:
+                continue
+            except psutil.AccessDenied as e:
+                log.warn('Could not pin worker PID %s: %s', worker.pid, e)
+                # Don't keep trying, or count it as being anywhere.
+                self.placed[worker.pid] = None
+                continue
+            log.debug('Pinned worker PID %s to CPUs %s', worker.pid,
+                      ','.join(str(c) for c in self.slots[slot]))
+            self.placed[worker.pid] = slot
+            pinned.append(worker.pid)
+        return pinned
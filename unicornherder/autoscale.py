@@ -0,0 +1,113 @@
+import logging
+import psutil
+import signal
+
+from .netstat import accept_queue
+from .snapshot import ProcessTree
+from .timeout import monotonic
+
+log = logging.getLogger(__name__)
+
+
+class Autoscaler(object):
+    """
+
+    Adds and removes workers with TTIN/TTOU to follow load, keeping the
+    worker count between ``min_workers`` and ``max_workers``.
+
+    Load is judged from two signals, sampled on every ``check()``:
+
+    - the mean CPU utilisation of the workers since the previous check, from
+      psutil (0.0 - 1.0 per worker)
+    - the number of connections waiting in the master's listen queue, from
+      /proc/net/tcp
+
+    A worker is added if utilisation is above ``up_cpu`` or the queue is
+    longer than ``up_queue``, and removed if utilisation is below
+    ``down_cpu`` and nothing is queued. The gap between the two thresholds
+    gives us some hysteresis, and after any change we leave the worker count
+    alone for ``cooldown`` seconds so that it can take effect.
+
+    Workers are read from ``tree``, a ProcessTree shared with the rest of the
+    herder, if given.
+
+    """
+
+    def __init__(self, min_workers, max_workers, up_cpu=0.75, down_cpu=0.25,
+                 up_queue=0, cooldown=60, tree=None):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.up_cpu = up_cpu
+        self.down_cpu = down_cpu
+        self.up_queue = up_queue
+        self.cooldown = cooldown
+        self.tree = tree
+
+        self.cpu_times = {}
+        self.sampled_at = None
+        self.scaled_at = None
+
+    def check(self, master):
+        """
+
+        Sample the load on ``master`` and, if needed, send it TTIN or TTOU.
+        Returns +1 or -1 if a worker was added or removed, and 0 otherwise.
+
+        """
+        tree = self.tree or ProcessTree()
+        workers = tree.children(master)
+        count = len(workers)
+        utilisation = self._utilisation(workers, tree)
+        queue = accept_queue(master.pid)
+
+        now = monotonic()
+        if self.scaled_at is not None and now - self.scaled_at < self.cooldown:
+            return 0
+
+        if count < self.min_workers:
+            return self._scale(master, +1, 'below the minimum of %s workers' % self.min_workers)
+        if count > self.max_workers:
+            return self._scale(master, -1, 'above the maximum of %s workers' % self.max_workers)
+        if utilisation is None:
+            return 0
+
+        if count < self.max_workers:
+            if utilisation > self.up_cpu:
+                return self._scale(master, +1, 'CPU utilisation is %.0f%%' % (utilisation * 100))
+            if queue is not None and queue > self.up_queue:
+                return self._scale(master, +1, '%s connections are queued' % queue)
+
+        if count > self.min_workers and utilisation < self.down_cpu and not queue:
+            return self._scale(master, -1, 'CPU utilisation is %.0f%%' % (utilisation * 100))
+
+        return 0
+
+    def _utilisation(self, workers, tree):
+        now = monotonic()
+        cpu_times = {}
+        for worker in workers:
+            try:
+                stats = tree.stats(worker)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            cpu_times[worker.pid] = stats.cpu_user + stats.cpu_system
+
+        previous, self.cpu_times = self.cpu_times, cpu_times
+        sampled_at, self.sampled_at = self.sampled_at, now
+
+        # Only workers we saw last time can tell us anything.
+        used = [cpu_times[pid] - previous[pid] for pid in cpu_times if pid in previous]
+        if sampled_at is None or not used or now <= sampled_at:
+            return None
+        return sum(used) / (len(used) * (now - sampled_at))
+
+    def _scale(self, master, direction, reason):
+        signum = signal.SIGTTIN if direction > 0 else signal.SIGTTOU
+        log.info('%s a worker for PID %s: %s',
+                 'Adding' if direction > 0 else 'Removing', master.pid, reason)
+        try:
+            master.send_signal(signum)
+        except psutil.NoSuchProcess:
+            return 0
+        self.scaled_at = monotonic()
+        return direction
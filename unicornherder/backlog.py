@@ -0,0 +1,86 @@
+import collections
+import logging
+import time
+
+from .netstat import listen_overflows, listening_sockets
+from .timeout import monotonic
+
+log = logging.getLogger(__name__)
+
+# How many samples to keep: ten minutes' worth at the default interval
+HISTORY = 600
+
+BacklogSample = collections.namedtuple('BacklogSample', 'time queue overflows drops')
+BacklogSample.__doc__ = """
+
+The state of a master's listen sockets at wall-clock ``time``: how many
+connections were waiting to be accepted on all of them (``queue``), and the
+ListenOverflows and ListenDrops counters of its network namespace (None if
+they couldn't be read).
+
+"""
+
+
+class BacklogMonitor(object):
+    """
+
+    Watches the master's listen sockets for signs that the workers can't
+    keep up: connections piling up in the accept queue, or being turned
+    away once it's full.
+
+    Every ``check()`` takes a BacklogSample, and the last ``history`` of
+    them are kept in ``samples`` for anyone who wants the time series. A
+    warning is logged once the queue has been longer than ``threshold`` for
+    ``duration`` seconds (and again when it recovers), and whenever the
+    overflow counters go up.
+
+    """
+
+    def __init__(self, threshold, duration=10, history=HISTORY):
+        self.threshold = threshold
+        self.duration = duration
+        self.samples = collections.deque(maxlen=history)
+        self.saturated_since = None
+        self.warned = False
+
+    def check(self, master):
+        """
+
+        Sample the listen sockets of ``master``, and warn if need be. Returns
+        the new BacklogSample, or None if the sockets couldn't be read.
+
+        """
+        try:
+            sockets = listening_sockets(master.pid)
+        except OSError as e:
+            log.debug('Could not read the listen sockets of PID %s: %s', master.pid, e)
+            return None
+
+        counters = listen_overflows(master.pid) or (None, None)
+        sample = BacklogSample(time.time(), sum(s.queue for s in sockets), *counters)
+        previous = self.samples[-1] if self.samples else None
+        self.samples.append(sample)
+
+        if (previous is not None and previous.overflows is not None and
+                sample.overflows is not None and sample.overflows > previous.overflows):
+            log.warn('Listen queue overflowed: pid=%s overflows=%s drops=%s queue=%s',
+                     master.pid, sample.overflows - previous.overflows,
+                     sample.drops - previous.drops, sample.queue)
+
+        now = monotonic()
+        if sample.queue <= self.threshold:
+            if self.warned:
+                log.info('Listen queue recovered: pid=%s queue=%s threshold=%s '
+                         'seconds=%.1f', master.pid, sample.queue, self.threshold,
+                         now - self.saturated_since)
+            self.saturated_since = None
+            self.warned = False
+        elif self.saturated_since is None:
+            self.saturated_since = now
+        elif not self.warned and now - self.saturated_since >= self.duration:
+            log.warn('Listen queue saturated: pid=%s queue=%s threshold=%s '
+                     'seconds=%.1f', master.pid, sample.queue, self.threshold,
+                     now - self.saturated_since)
+            self.warned = True
+
+        return sample
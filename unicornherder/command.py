@@ -6,7 +6,8 @@ import os
 import sys
 
 from . import __version__
-from .herder import Herder
+from .flock import Flock, load_config
+from .herder import Herder, HerderError
 
 
 parser = argparse.ArgumentParser(description='Manage daemonized (g)unicorns.')
@@ -27,6 +28,146 @@ parser.add_argument('-t', '--timeout', default=30, type=int, metavar='30', dest=
 parser.add_argument('-o', '--overlap', default=30, type=int, metavar='30',
                     dest='overlap',
                     help='Time to wait before killing old unicorns when reloading')
+parser.add_argument('--probe', default=None, metavar='URL',
+                    help='Readiness probe that must pass before old unicorns are '
+                         'killed when reloading, instead of waiting for the '
+                         'overlap (http://..., tcp://HOST:PORT or unix:///PATH)')
+parser.add_argument('--probe-timeout', default=120, type=int, metavar='120',
+                    dest='probe_timeout',
+                    help='Time to wait for the readiness probe to pass')
+parser.add_argument('--drain-timeout', default=None, type=int, metavar='SECONDS',
+                    dest='drain_timeout',
+                    help='When reloading, wait up to this long for old workers '
+                         'to finish their open connections before stopping the '
+                         'old master (and KILL it if it will not stop)')
+parser.add_argument('--metrics', default=None, metavar='ADDRESS',
+                    help='Serve Prometheus metrics on HOST:PORT or unix:PATH')
+parser.add_argument('--worker-memory-limit', default=None, type=int, metavar='MB',
+                    dest='worker_memory_limit',
+                    help='Gracefully recycle any worker using more than this '
+                         'much memory')
+parser.add_argument('--memory-budget', default=None, type=int, metavar='MB',
+                    dest='memory_budget',
+                    help='Gracefully recycle the largest workers while unicorn '
+                         'uses more than this much memory in total')
+parser.add_argument('--memory-metric', default='rss', choices=['rss', 'uss'],
+                    dest='memory_metric',
+                    help='How to measure memory use (rss or uss)')
+parser.add_argument('--memory-interval', default=30, type=float, metavar='30',
+                    dest='memory_interval',
+                    help='How often to check memory use, in seconds')
+parser.add_argument('--max-recycling', default=1, type=int, metavar='1',
+                    dest='max_recycling',
+                    help='How many workers may be recycled at once')
+parser.add_argument('--min-workers', default=None, type=int, metavar='N',
+                    dest='min_workers',
+                    help='With --max-workers, scale the number of workers with '
+                         'load using TTIN/TTOU, between these bounds')
+parser.add_argument('--max-workers', default=None, type=int, metavar='N',
+                    dest='max_workers')
+parser.add_argument('--scale-up-cpu', default=0.75, type=float, metavar='0.75',
+                    dest='scale_up_cpu',
+                    help='Add a worker above this mean worker CPU utilisation')
+parser.add_argument('--scale-down-cpu', default=0.25, type=float, metavar='0.25',
+                    dest='scale_down_cpu',
+                    help='Remove a worker below this mean worker CPU utilisation')
+parser.add_argument('--scale-queue', default=0, type=int, metavar='0',
+                    dest='scale_queue',
+                    help='Add a worker when more than this many connections '
+                         'are waiting to be accepted')
+parser.add_argument('--scale-cooldown', default=60, type=float, metavar='60',
+                    dest='scale_cooldown',
+                    help='Seconds to wait after changing the number of workers '
+                         'before changing it again')
+parser.add_argument('--scale-interval', default=5, type=float, metavar='5',
+                    dest='scale_interval',
+                    help='How often to sample load, in seconds')
+parser.add_argument('--backlog-threshold', default=None, type=int, metavar='N',
+                    dest='backlog_threshold',
+                    help='Monitor the listen queues, and warn when more than N '
+                         'connections stay waiting to be accepted')
+parser.add_argument('--backlog-duration', default=10, type=float, metavar='10',
+                    dest='backlog_duration',
+                    help='How many seconds the listen queue must stay above '
+                         '--backlog-threshold before we warn')
+parser.add_argument('--backlog-interval', default=1, type=float, metavar='1',
+                    dest='backlog_interval',
+                    help='How often to sample the listen queues, in seconds')
+parser.add_argument('--usage-interval', default=None, type=float, metavar='SECONDS',
+                    dest='usage_interval',
+                    help='Record the CPU time, RSS, context switches and open '
+                         'files of the master and every worker this often, for '
+                         'the usage command of the control socket')
+parser.add_argument('--usage-history', default=50000, type=int, metavar='50000',
+                    dest='usage_history',
+                    help='How many usage records (one per process) to keep')
+parser.add_argument('--sharing-delay', default=None, type=float, metavar='SECONDS',
+                    dest='sharing_delay',
+                    help='Log how much memory the workers share with their '
+                         'master (USS, PSS and shared) this long after boot '
+                         'and after each reload')
+parser.add_argument('--pin-workers', default=None, choices=['cpu', 'node'],
+                    dest='pin_workers',
+                    help='Pin each worker to one CPU (cpu) or to the CPUs of '
+                         'one NUMA node (node), spreading them evenly')
+parser.add_argument('--pin-interval', default=1, type=float, metavar='1',
+                    dest='pin_interval',
+                    help='How often to look for new workers to pin, in seconds')
+parser.add_argument('--demote-old', default=None, type=int, metavar='N',
+                    dest='demote_old',
+                    help='When reloading, once the new master has all its '
+                         'workers, renice the old master and its workers by N '
+                         'and lower their I/O priority')
+parser.add_argument('--warmup', default=None, metavar='FILE',
+                    help='When reloading, replay the requests in FILE (one '
+                         '"GET /path" per line) against the new master until '
+                         'they are fast enough, before retiring the old master')
+parser.add_argument('--warmup-target', default=None, metavar='URL',
+                    dest='warmup_target',
+                    help='Where to send warm-up requests (http://HOST:PORT or '
+                         'unix:///PATH): an address only the new master listens '
+                         'on, required with --warmup')
+parser.add_argument('--warmup-concurrency', default=4, type=int, metavar='4',
+                    dest='warmup_concurrency',
+                    help='How many warm-up requests to send at once')
+parser.add_argument('--warmup-latency', default=100, type=float, metavar='100',
+                    dest='warmup_latency',
+                    help='Warm-up is over once the 90th percentile latency of '
+                         'a round is at most this many milliseconds')
+parser.add_argument('--warmup-timeout', default=120, type=int, metavar='120',
+                    dest='warmup_timeout',
+                    help='Time to spend warming up before retiring the old '
+                         'master regardless')
+parser.add_argument('--rolling-step', default=None, type=int, metavar='N',
+                    dest='rolling_step',
+                    help='When reloading, hand workers over to the new master '
+                         'N at a time with TTIN/TTOU, instead of running two '
+                         'full sets of workers side by side')
+parser.add_argument('--rolling-budget', default=None, type=int, metavar='MB',
+                    dest='rolling_budget',
+                    help='During a rolling handover, only add workers to the '
+                         'new master while both masters use less than this '
+                         'much memory in total')
+parser.add_argument('--rollback-crashes', default=None, type=int, metavar='N',
+                    dest='rollback_crashes',
+                    help='When reloading, go back to the old master if N of '
+                         "the new master's workers die before the old master "
+                         'is shut down')
+parser.add_argument('--rollback-probe-failures', default=None, type=int,
+                    metavar='N', dest='rollback_probe_failures',
+                    help='When reloading, go back to the old master if the '
+                         'readiness probe fails N times in a row')
+parser.add_argument('--reload-log', default=None, metavar='TARGET',
+                    dest='reload_log',
+                    help='Record each step of every reload as JSON lines, in '
+                         'this file or sent to unix:PATH or udp:HOST:PORT')
+parser.add_argument('--control', default=None, metavar='PATH',
+                    help='Accept status, reload and scale commands on a UNIX '
+                         'socket at PATH (see unicornherderctl)')
+parser.add_argument('-c', '--config', default=None, metavar='PATH',
+                    help='Herd every instance defined in this config file from '
+                         'one process, instead of the single unicorn described '
+                         'by the other options')
 parser.add_argument('-v', '--version', action='version', version=__version__)
 parser.add_argument('args', nargs=argparse.REMAINDER,
                     help='Any additional arguments will be passed to unicorn/'
@@ -53,15 +194,24 @@ def main():
 
     args = parser.parse_args()
 
-    if len(args.args) > 0 and args.args[0] == '--':
-        args.args.pop(0)
+    try:
+        if args.config is not None:
+            herder = Flock(load_config(args.config))
+        else:
+            if len(args.args) > 0 and args.args[0] == '--':
+                args.args.pop(0)
 
-    args.args = ' '.join(args.args)
+            args.args = ' '.join(args.args)
 
-    if args.pidfile is None:
-        args.pidfile = '%s.pid' % args.unicorn
+            if args.pidfile is None:
+                args.pidfile = '%s.pid' % args.unicorn
+
+            del args.config
+            herder = Herder(**vars(args))
+    except HerderError as e:
+        # A bad config file is as much a usage error as a bad option.
+        parser.error(str(e))
 
-    herder = Herder(**vars(args))
     if herder.spawn():
         return herder.loop()
 
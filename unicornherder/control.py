@@ -0,0 +1,230 @@
+from __future__ import print_function
+
+import errno
+import json
+import logging
+import os
+import socket
+import sys
+
+log = logging.getLogger(__name__)
+
+# The longest request line we'll accept
+MAX_REQUEST = 1024
+
+
+class ControlError(Exception):
+    pass
+
+
+class ControlServer(object):
+    """
+
+    A UNIX socket at ``path`` through which the herder can be queried and
+    told what to do. Clients send a single line, a command and its
+    arguments separated by spaces, and get a single line of JSON back, after
+    which the connection is closed. Each request is passed to
+    ``handler(connection, words)``, which answers it -- straight away or
+    later on -- with ``connection.respond()``.
+
+    The server and its connections are watchers for the herder's Waiter, so
+    that everything happens on the main loop and no locking is needed. Any
+    requests still unanswered when the server is closed are told so.
+
+    """
+
+    def __init__(self, path, handler):
+        self.path = path
+        self.handler = handler
+        self.socket = None
+        self.waiter = None
+        self.connections = set()
+
+    def start(self, waiter):
+        if os.path.exists(self.path):
+            # A socket left behind by an earlier herder. If anyone is still
+            # listening on it, it isn't ours to take.
+            probe = socket.socket(socket.AF_UNIX)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.unlink(self.path)
+            else:
+                raise ControlError('Control socket %s is already in use' % self.path)
+            finally:
+                probe.close()
+
+        sock = socket.socket(socket.AF_UNIX)
+        try:
+            sock.bind(self.path)
+        except socket.error as e:
+            sock.close()
+            raise ControlError('Could not bind control socket %s: %s' % (self.path, e))
+        sock.listen(16)
+        sock.setblocking(False)
+        self.socket = sock
+        self.waiter = waiter
+        waiter.add_watcher(self)
+
+    def fileno(self):
+        return self.socket.fileno() if self.socket is not None else None
+
+    def read(self):
+        while True:
+            try:
+                conn, _ = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            connection = Connection(conn, self)
+            self.connections.add(connection)
+            self.waiter.add_watcher(connection)
+
+    def close(self):
+        if self.socket is None:
+            return
+        for connection in list(self.connections):
+            connection.respond({'ok': False, 'error': 'The herder is exiting'})
+        # Left in the waiter, we'd have no file descriptor to select on.
+        if self.waiter is not None and self in self.waiter.watchers:
+            self.waiter.remove_watcher(self, close=False)
+        self.socket.close()
+        self.socket = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class Connection(object):
+    """A client of the control socket, waiting to be answered."""
+
+    def __init__(self, sock, server):
+        sock.setblocking(False)
+        self.socket = sock
+        self.server = server
+        self.buffer = b''
+        self.requested = False
+        self.answered = False
+
+    def fileno(self):
+        return self.socket.fileno() if self.socket is not None else None
+
+    def read(self):
+        try:
+            data = self.socket.recv(4096)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b''
+
+        if not data:
+            if self.requested and not self.answered:
+                # The client has finished sending, but may still be waiting
+                # for its answer.
+                self._stop_reading()
+            else:
+                self._hang_up()
+            return
+        if self.requested:
+            return
+
+        self.buffer += data
+        if b'\n' not in self.buffer:
+            if len(self.buffer) > MAX_REQUEST:
+                self.respond({'ok': False, 'error': 'Request too long'})
+            return
+
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        self.requested = True
+        words = line.decode('utf-8', 'replace').split()
+        log.debug('Control request: %s', ' '.join(words))
+        try:
+            self.server.handler(self, words)
+        except Exception as e:
+            log.exception('Control request %r failed', ' '.join(words))
+            self.respond({'ok': False, 'error': str(e)})
+
+    def respond(self, response):
+        """Send ``response`` (a dict) as a line of JSON, and hang up."""
+        if self.socket is None or self.answered:
+            return
+        self.answered = True
+        try:
+            self.socket.setblocking(True)
+            self.socket.settimeout(1)
+            self.socket.sendall((json.dumps(response, sort_keys=True) + '\n').encode('utf-8'))
+        except socket.error as e:
+            log.debug('Could not answer control request: %s', e)
+        self._hang_up()
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        self.server.connections.discard(self)
+
+    def _stop_reading(self):
+        waiter = self.server.waiter
+        if waiter is not None and self in waiter.watchers:
+            waiter.remove_watcher(self, close=False)
+
+    def _hang_up(self):
+        self._stop_reading()
+        self.close()
+
+
+def request(path, command, timeout=None):
+    """
+
+    Send ``command`` to the control socket at ``path``, and return the
+    decoded response. ``timeout`` is in seconds (None waits forever, which a
+    ``reload`` may need).
+
+    """
+    sock = socket.socket(socket.AF_UNIX)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall((command + '\n').encode('utf-8'))
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    except socket.error as e:
+        raise ControlError('Could not talk to %s: %s' % (path, e))
+    finally:
+        sock.close()
+    if not data:
+        raise ControlError('%s hung up without answering' % path)
+    return json.loads(data.decode('utf-8'))
+
+
+def main(argv=None):
+    """
+
+    unicornherderctl SOCKET COMMAND [ARGS...]
+
+    Send a command to a herder's control socket and print its response. Exits
+    non-zero if the command failed.
+
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 2:
+        print('Usage: unicornherderctl SOCKET status|reload|scale up|down [N]|backlog|usage [SECONDS]',
+              file=sys.stderr)
+        return 2
+    try:
+        response = request(argv[0], ' '.join(argv[1:]))
+    except ControlError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(json.dumps(response, indent=2, sort_keys=True))
+    return 0 if response.get('ok') else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+
+log = logging.getLogger(__name__)
+
+
+def pidfd_open(pid):
+    """
+
+    Return a file descriptor referring to process ``pid`` which becomes
+    readable when the process exits, or None if pidfds aren't supported by
+    this Python or kernel.
+
+    Raises OSError with errno ESRCH if the process doesn't exist.
+
+    """
+    _pidfd_open = getattr(os, 'pidfd_open', None)
+    if _pidfd_open is None:
+        return None
+    try:
+        return _pidfd_open(pid)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            raise
+        log.debug('pidfd_open(%s) failed (%s), falling back to polling', pid, e)
+        return None
+
+
+class Waiter(object):
+    """
+
+    Multiplexes everything the herder may need to wake up for -- pidfile
+    changes, exiting masters and incoming signals -- into a single
+    ``select()`` call.
+
+    Signals are delivered through a self-pipe registered with
+    ``signal.set_wakeup_fd``, so that a signal arriving while we're blocked
+    wakes us up straight away rather than only running its handler.
+
+    """
+
+    def __init__(self):
+        self.watchers = []
+        self.pidfds = {}
+        self.exited = set()
+        self._wakeup = None
+        self._old_wakeup_fd = None
+
+    def add_watcher(self, watcher):
+        self.watchers.append(watcher)
+
+    def remove_watcher(self, watcher, close=True):
+        self.watchers.remove(watcher)
+        if close:
+            watcher.close()
+
+    def install_wakeup_fd(self):
+        r, w = os.pipe()
+        for fd in (r, w):
+            _set_nonblocking(fd)
+        try:
+            self._old_wakeup_fd = signal.set_wakeup_fd(w)
+        except ValueError:
+            # Not in the main thread: signals can't wake us up anyway.
+            os.close(r)
+            os.close(w)
+            return
+        self._wakeup = (r, w)
+
+    def track(self, pids):
+        """
+
+        Ensure we hold a pidfd for each of ``pids``, and only those. Returns
+        True if every process is being tracked by pidfd, and False if some of
+        them have to be polled.
+
+        """
+        pids = set(pids)
+        for pid in list(self.pidfds):
+            if pid not in pids:
+                self._close_pidfd(pid)
+        self.exited &= pids
+
+        complete = True
+        for pid in pids:
+            if pid in self.pidfds or pid in self.exited:
+                continue
+            try:
+                fd = pidfd_open(pid)
+            except OSError:
+                self.exited.add(pid)
+                continue
+            if fd is None:
+                complete = False
+            else:
+                self.pidfds[pid] = fd
+        return complete
+
+    def wait(self, timeout):
+        """
+
+        Block until something interesting happens, or for up to ``timeout``
+        seconds (None meaning forever). Returns True if we were woken up by an
+        event rather than the timeout.
+
+        """
+        fds = [w.fileno() for w in self.watchers if w.fileno() is not None]
+        fds.extend(self.pidfds.values())
+        if self._wakeup is not None:
+            fds.append(self._wakeup[0])
+
+        if not fds:
+            # Nothing to wait on: we're a plain poller.
+            select.select([], [], [], timeout)
+            return False
+
+        try:
+            ready, _, _ = select.select(fds, [], [], timeout)
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return True
+
+        # Watchers may come and go as we read them.
+        for watcher in list(self.watchers):
+            if watcher.fileno() in ready:
+                watcher.read()
+        if self._wakeup is not None and self._wakeup[0] in ready:
+            _drain(self._wakeup[0])
+        for pid, fd in list(self.pidfds.items()):
+            if fd in ready:
+                log.debug('PID %s exited', pid)
+                self.exited.add(pid)
+                self._close_pidfd(pid)
+
+        return bool(ready)
+
+    def close(self):
+        for pid in list(self.pidfds):
+            self._close_pidfd(pid)
+        for watcher in self.watchers:
+            watcher.close()
+        if self._wakeup is not None:
+            signal.set_wakeup_fd(self._old_wakeup_fd)
+            for fd in self._wakeup:
+                os.close(fd)
+            self._wakeup = None
+
+    def _close_pidfd(self, pid):
+        os.close(self.pidfds.pop(pid))
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+
+def _drain(fd):
+    while True:
+        try:
+            if not os.read(fd, 4096):
+                return
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
@@ -0,0 +1,320 @@
+import collections
+import logging
+import psutil
+
+try:
+    from configparser import RawConfigParser
+except ImportError:  # Python 2
+    from ConfigParser import RawConfigParser
+
+from .events import Waiter
+from .herder import (MANAGED_PIDS, WAIT_INTERVAL, Herder, HerderError,
+                     install_signal_handlers, poll_interval)
+from .notify import Notifier
+from .timeout import TimeoutError
+
+log = logging.getLogger(__name__)
+
+# The settings an instance may have in a config file, and their types. These
+# are the keyword arguments of Herder.
+OPTIONS = {
+    'unicorn': str,
+    'unicorn_bin': str,
+    'gunicorn_bin': str,
+    'pidfile': str,
+    'args': str,
+    'boot_timeout': int,
+    'overlap': int,
+    'probe': str,
+    'probe_timeout': int,
+    'drain_timeout': int,
+    'metrics': str,
+    'worker_memory_limit': int,
+    'memory_budget': int,
+    'memory_metric': str,
+    'memory_interval': float,
+    'max_recycling': int,
+    'min_workers': int,
+    'max_workers': int,
+    'scale_up_cpu': float,
+    'scale_down_cpu': float,
+    'scale_queue': int,
+    'scale_cooldown': float,
+    'scale_interval': float,
+    'backlog_threshold': int,
+    'backlog_duration': float,
+    'backlog_interval': float,
+    'usage_interval': float,
+    'usage_history': int,
+    'sharing_delay': float,
+    'pin_workers': str,
+    'pin_interval': float,
+    'demote_old': int,
+    'warmup': str,
+    'warmup_target': str,
+    'warmup_concurrency': int,
+    'warmup_latency': float,
+    'warmup_timeout': int,
+    'rolling_step': int,
+    'rolling_budget': int,
+    'rollback_crashes': int,
+    'rollback_probe_failures': int,
+    'reload_log': str,
+    'control': str,
+}
+
+
+def load_config(filename):
+    """
+
+    Read the instances to herd from an INI-style config file, with one
+    section per instance::
+
+        [DEFAULT]
+        overlap = 10
+
+        [frontend]
+        unicorn = gunicorn
+        pidfile = /run/frontend.pid
+        args = -w 4 frontend:app
+
+    Settings are named after Herder's keyword arguments (dashes may be used
+    in place of underscores), and those in ``[DEFAULT]`` apply to every
+    instance. Returns an OrderedDict mapping instance names to keyword
+    arguments.
+
+    """
+    parser = RawConfigParser()
+    try:
+        with open(filename) as f:
+            if hasattr(parser, 'read_file'):
+                parser.read_file(f)
+            else:
+                parser.readfp(f)
+    except (IOError, ValueError) as e:
+        raise HerderError('Could not read config file %s: %s' % (filename, e))
+    except Exception as e:
+        # configparser.Error, which doesn't share a base with the above
+        raise HerderError('Could not parse config file %s: %s' % (filename, e))
+
+    instances = collections.OrderedDict()
+    for section in parser.sections():
+        kwargs = {}
+        for key, value in parser.items(section):
+            name = key.replace('-', '_')
+            if name not in OPTIONS:
+                raise HerderError('Unknown setting %r for instance %s in %s' %
+                                  (key, section, filename))
+            try:
+                kwargs[name] = OPTIONS[name](value)
+            except ValueError:
+                raise HerderError('Invalid value %r for %s of instance %s in %s' %
+                                  (value, key, section, filename))
+        instances[section] = kwargs
+
+    if not instances:
+        raise HerderError('No instances defined in %s' % filename)
+    return instances
+
+
+class Flock(object):
+    """
+
+    A Flock herds several unicorn instances from one process, with a single
+    event loop, set of signal handlers and psutil import between them. Each
+    instance is an ordinary Herder, and is spawned and monitored just as it
+    would be on its own, except that:
+
+    - every instance is spawned at once, rather than each waiting for the
+      last to daemonize
+    - signals received by the flock go to every instance, and ``reload()``
+      reloads just one of them
+    - if an instance's unicorn dies, or its herder fails (say its pidfile
+      can't be read), the rest carry on; ``loop()`` exits once none are left
+
+    Example::
+
+        flock = Flock(load_config('/etc/unicornherder.ini'))
+        if flock.spawn():
+            sys.exit(flock.loop())
+
+    """
+
+    def __init__(self, instances):
+        """
+
+        Creates a Flock from an ordered mapping of instance names to Herder
+        keyword arguments, as returned by ``load_config()``.
+
+        """
+        self.herders = collections.OrderedDict()
+        # Things no two instances can share, and which instance has each.
+        claimed = {'pidfile': {}, 'metrics address': {}, 'control socket': {}}
+        for name, kwargs in instances.items():
+            try:
+                herder = Herder(**kwargs)
+            except HerderError as e:
+                raise HerderError('Instance %s: %s' % (name, e))
+            for what, value in [('pidfile', herder.pidfile),
+                                ('metrics address', herder.metrics_address),
+                                ('control socket', herder.control)]:
+                if value is None:
+                    continue
+                if value in claimed[what]:
+                    raise HerderError('Instances %s and %s both use the %s %s' %
+                                      (claimed[what][value], name, what, value))
+                claimed[what][value] = name
+            self.herders[name] = herder
+        self.waiter = None
+        self.notifier = None
+
+    def spawn(self):
+        """
+
+        Spawn every instance, and wait for them all to daemonize.
+
+        Returns False if any of them fails to, and True otherwise. Either way
+        all or none are left running: after a failure the others are stopped,
+        since nothing would be herding them.
+
+        """
+        booting = collections.OrderedDict()
+        daemonized = []
+        for name, herder in self.herders.items():
+            cmd = herder._command()
+            process = herder._popen(cmd) if cmd is not None else None
+            if process is None:
+                log.error('Could not spawn instance %s', name)
+                self._stop_spawned(booting, daemonized)
+                return False
+            booting[name] = (herder, process, herder.boot_deadline)
+
+        waiter = Waiter()
+        try:
+            while booting:
+                for name, (herder, process, deadline) in list(booting.items()):
+                    try:
+                        if herder._daemonized(process, deadline):
+                            del booting[name]
+                            daemonized.append(herder)
+                    except TimeoutError:
+                        log.error('Instance %s failed to boot', name)
+                        herder._abandon(process)
+                        del booting[name]
+                        self._stop_spawned(booting, daemonized)
+                        return False
+                if booting:
+                    # With pidfds, we're woken as soon as any of them exits.
+                    waiter.track([process.pid for _, process, _ in booting.values()])
+                    waiter.wait(WAIT_INTERVAL)
+        finally:
+            waiter.close()
+
+        install_signal_handlers(self._queue_signal)
+        return True
+
+    def _stop_spawned(self, booting, daemonized):
+        for herder, process, _ in booting.values():
+            if process.poll() is None:
+                process.terminate()
+        for herder in daemonized:
+            herder._terminate_spawned()
+
+    def loop(self):
+        """Enter the monitoring loop"""
+        self.waiter = Waiter()
+        self.notifier = Notifier.from_environment()
+        self.waiter.install_wakeup_fd()
+        try:
+            for name, herder in list(self.herders.items()):
+                try:
+                    herder._start(self.waiter)
+                except HerderError as e:
+                    self._fail(name, e)
+            while True:
+                for name, herder in list(self.herders.items()):
+                    try:
+                        alive = herder._tick()
+                    except HerderError as e:
+                        self._fail(name, e)
+                        continue
+                    if not alive:
+                        log.error('Instance %s (%s) died.', name, herder.unicorn)
+                        self._remove(name)
+                if not self.herders:
+                    log.error('No instances left. Exiting.')
+                    return 1
+
+                pids = []
+                for herder in self.herders.values():
+                    pids.extend(herder._tracked_pids())
+                timeout = poll_interval(self.waiter, pids)
+                for herder in self.herders.values():
+                    timeout = herder.timers.next_timeout(timeout)
+                if self.notifier is not None:
+                    self._notify()
+                    timeout = self.notifier.next_timeout(timeout)
+                self.waiter.wait(timeout)
+
+                for herder in self.herders.values():
+                    herder.tree.refresh()
+                    herder.timers.run()
+        finally:
+            for herder in self.herders.values():
+                herder._stop()
+            if self.notifier is not None:
+                self.notifier.close()
+                self.notifier = None
+            self.waiter.close()
+
+    def _notify(self):
+        # The flock is ready once every instance is, and reloading while any
+        # of them are.
+        herders = list(self.herders.values())
+        ready = all([h._check_ready() for h in herders])
+        self.notifier.update(ready,
+                             reloading=any(h.reload_state != 'idle' for h in herders),
+                             stopping=any(h.terminating for h in herders),
+                             status='; '.join('%s: %s' % (name, h._describe())
+                                              for name, h in self.herders.items()))
+
+    def reload(self, name):
+        """Gracefully restart instance ``name``, as if it alone had been sent HUP."""
+        try:
+            herder = self.herders[name]
+        except KeyError:
+            raise HerderError('No such instance: %s' % name)
+        herder._handle_HUP(None, None)
+
+    def _fail(self, name, error):
+        # On its own, the herder would exit with this error, and take its
+        # master with it; only this instance does here.
+        log.error('Instance %s (%s) failed: %s', name, self.herders[name].unicorn, error)
+        master = self.herders[name].master
+        self._remove(name)
+        if master is not None:
+            try:
+                master.kill()
+            except psutil.NoSuchProcess:
+                pass
+
+    def _remove(self, name):
+        herder = self.herders.pop(name)
+        herder._stop()
+        if herder.watcher is not None:
+            self.waiter.remove_watcher(herder.watcher)
+
+        # On its own, the herder would exit now, and take any old masters it
+        # was retiring with it. They still need to go.
+        for reload in herder.reloads:
+            try:
+                reload.old_master.kill()
+            except psutil.NoSuchProcess:
+                pass
+            MANAGED_PIDS.discard(reload.old_master.pid)
+        if herder.master is not None:
+            MANAGED_PIDS.discard(herder.master.pid)
+
+    def _queue_signal(self, signum, frame):
+        for herder in self.herders.values():
+            herder.pending_signals.append(signum)
@@ -6,8 +6,25 @@ import signal
 import subprocess
 import time
 
+from .affinity import AffinityError, WorkerPlacer
+from .autoscale import Autoscaler
+from .backlog import BacklogMonitor
+from .control import ControlError, ControlServer
+from .events import Waiter
+from .history import HISTORY, UsageHistory
+from .memory import MB, MemoryGuard
+from .metrics import Metrics, MetricsError, MetricsServer, parse_address
+from .netstat import is_listening
+from .notify import Notifier
 from .pidfile import Pidfile, PidfileError
-from .timeout import timeout, TimeoutError
+from .probe import parse_probe, ProbeError
+from .reload import SIGNAL_INTERVAL, Reload
+from .sharing import SharingMonitor
+from .snapshot import ProcessTree
+from .timeline import Timeline, TimelineError
+from .timeout import Deadline, Timers, TimeoutError, monotonic
+from .warmup import Warmup, WarmupError, load_requests, parse_target
+from .watcher import watch
 
 log = logging.getLogger(__name__)
 
@@ -22,6 +39,40 @@ COMMANDS = {
 
 MANAGED_PIDS = set([])
 
+# How often to check on the master when nothing else wakes us up. With
+# inotify available, pidfile changes are noticed as soon as they happen.
+POLL_INTERVAL = 2
+
+# When the kernel tells us about both pidfile changes and master exits, the
+# periodic check is only a safety net.
+IDLE_INTERVAL = 30
+
+# How often to re-check on a daemonizing unicorn or a missing pidfile while
+# we're waiting for them
+WAIT_INTERVAL = 0.25
+
+# How long a pidfile may be unreadable before we give up
+PIDFILE_TIMEOUT = 5
+
+# Returned by Herder._read_pidfile while the pidfile is briefly unreadable
+RETRY = object()
+
+# While unicorn boots, how often to check for its pidfile (if we can't be
+# told when it's written) and its listen sockets.
+BOOT_INTERVAL = 0.05
+
+# How long after USR2 we expect the new master to have written its pidfile.
+# If it hasn't, the reload is given up on so that later HUPs aren't coalesced
+# into it forever.
+FORK_TIMEOUT = 120
+
+# Signals we forward to the currently tracked master process.
+#
+# We do NOT forward SIGWINCH, because it is triggered by terminal resize,
+# leading to some *seriously* weird behaviour (resize xterm, unicorn workers
+# are killed).
+FORWARDED_SIGNALS = ['INT', 'QUIT', 'TERM', 'TTIN', 'TTOU', 'USR1', 'USR2']
+
 
 class HerderError(Exception):
     pass
@@ -47,7 +98,19 @@ class Herder(object):
     """
 
     def __init__(self, unicorn='gunicorn', unicorn_bin=None, gunicorn_bin=None,
-                 pidfile=None, boot_timeout=30, overlap=30, args=''):
+                 pidfile=None, boot_timeout=30, overlap=30, args='',
+                 probe=None, probe_timeout=120, drain_timeout=None,
+                 metrics=None, worker_memory_limit=None, memory_budget=None,
+                 memory_metric='rss', memory_interval=30, max_recycling=1,
+                 min_workers=None, max_workers=None, scale_up_cpu=0.75,
+                 scale_down_cpu=0.25, scale_queue=0, scale_cooldown=60,
+                 scale_interval=5, rolling_step=None, rolling_budget=None,
+                 reload_log=None, control=None, rollback_crashes=None,
+                 rollback_probe_failures=None, backlog_threshold=None,
+                 backlog_duration=10, backlog_interval=1, usage_interval=None,
+                 usage_history=HISTORY, sharing_delay=None, pin_workers=None,
+                 pin_interval=1, demote_old=None, warmup=None, warmup_target=None,
+                 warmup_concurrency=4, warmup_latency=100, warmup_timeout=120):
         """
 
         Creates a new Herder instance.
@@ -65,6 +128,92 @@ class Herder(object):
         overlap      - how long to wait before killing the old unicorns when reloading
         args         - any additional arguments to pass to the unicorn executable
                        (Default: '')
+        probe        - a readiness probe which must pass before the old unicorns
+                       are killed when reloading, in place of the fixed overlap:
+                       an http://, tcp://host:port or unix:///path URL
+                       (Default: None)
+        probe_timeout - how long to wait for the readiness probe to pass
+                       (Default: 120)
+        drain_timeout - if set, how long to wait for the old workers' TCP
+                       connections to drain before sending QUIT to the old
+                       master when reloading (Default: None)
+        metrics      - if set, serve Prometheus metrics on this address, either
+                       HOST:PORT or unix:PATH (Default: None)
+        worker_memory_limit - if set, gracefully recycle any worker using more
+                       than this many MB (Default: None)
+        memory_budget - if set, gracefully recycle the largest workers while
+                       the master and its workers use more than this many MB
+                       in total (Default: None)
+        memory_metric - how to measure memory for the above, 'rss' or 'uss'
+                       (Default: rss)
+        memory_interval - how often to check memory use, in seconds
+                       (Default: 30)
+        max_recycling - how many workers may be recycled at once (Default: 1)
+        min_workers, max_workers - if both are set, add and remove workers
+                       with TTIN/TTOU between these bounds to follow load
+                       (Default: None)
+        scale_up_cpu - add a worker when mean worker CPU utilisation is above
+                       this (Default: 0.75)
+        scale_down_cpu - remove a worker when it is below this (Default: 0.25)
+        scale_queue  - add a worker when more than this many connections are
+                       waiting to be accepted (Default: 0)
+        scale_cooldown - how long to leave the worker count alone after
+                       changing it, in seconds (Default: 60)
+        scale_interval - how often to sample load, in seconds (Default: 5)
+        rolling_step - if set, hand workers over from the old master to the
+                       new one this many at a time when reloading, rather
+                       than running two full sets of workers side by side
+                       (Default: None)
+        rolling_budget - if set, don't grow the new master during a rolling
+                       handover while both masters and their workers would
+                       use more than this many MB (Default: None)
+        reload_log   - if set, record each step of every reload as JSON lines
+                       in this file, or send them to unix:PATH or
+                       udp:HOST:PORT as datagrams (Default: None)
+        control      - if set, the path of a UNIX socket on which to accept
+                       status, reload and scale commands (Default: None)
+        rollback_crashes - if set, abandon a reload and go back to the old
+                       master once this many of the new master's workers
+                       have died (Default: None)
+        rollback_probe_failures - if set, do the same once the readiness
+                       probe has failed this many times in a row
+                       (Default: None)
+        backlog_threshold - if set, sample the master's listen queues, and
+                       warn when more than this many connections have been
+                       waiting to be accepted for ``backlog_duration``
+                       seconds (Default: None)
+        backlog_duration - see above (Default: 10)
+        backlog_interval - how often to sample the listen queues, in seconds
+                       (Default: 1)
+        usage_interval - if set, record the CPU time, RSS, context switches
+                       and open files of the master and every worker this
+                       often, in seconds (Default: None)
+        usage_history - how many of those records (one per process) to keep
+                       (Default: 50000)
+        sharing_delay - if set, log how much memory the workers share with
+                       their master this many seconds after boot and after
+                       each reload (Default: None)
+        pin_workers  - if set, pin each worker to a single CPU ('cpu') or to
+                       the CPUs of one NUMA node ('node'), spreading them
+                       evenly (Default: None)
+        pin_interval - how often to look for new workers to pin, in seconds
+                       (Default: 1)
+        demote_old   - if set, once the new master has all its workers when
+                       reloading, renice the old master and its workers by
+                       this many levels and give them the lowest best-effort
+                       I/O priority, until they're retired (Default: None)
+        warmup       - if set, a file of requests ('GET /path', one per line)
+                       to replay against the new master when reloading, in
+                       rounds, before the old master is retired (Default: None)
+        warmup_target - where to send them, http://HOST:PORT or unix:///PATH,
+                       which only the new master may listen on (required
+                       with warmup)
+        warmup_concurrency - how many warm-up requests to send at once
+                       (Default: 4)
+        warmup_latency - the old master is retired once a round's 90th
+                       percentile latency is at most this many milliseconds
+                       (Default: 100)
+        warmup_timeout - or once this many seconds have passed (Default: 120)
 
         """
 
@@ -81,6 +230,124 @@ class Herder(object):
         self.args = args
         self.boot_timeout = boot_timeout
         self.overlap = overlap
+        self.probe_timeout = probe_timeout
+        self.drain_timeout = drain_timeout
+        self.rolling_step = rolling_step
+        self.rolling_budget = _megabytes(rolling_budget)
+        if rolling_step is not None and rolling_step < 1:
+            raise HerderError('rolling_step must be at least 1, not %s' % rolling_step)
+        for name, value in [('rollback_crashes', rollback_crashes),
+                            ('rollback_probe_failures', rollback_probe_failures)]:
+            if value is not None and value < 1:
+                raise HerderError('%s must be at least 1, not %s' % (name, value))
+        self.rollback_crashes = rollback_crashes
+        self.rollback_probe_failures = rollback_probe_failures
+        if demote_old is not None and not 1 <= demote_old <= 19:
+            raise HerderError('demote_old must be between 1 and 19, not %s' % demote_old)
+        self.demote_old = demote_old
+
+        try:
+            self.probe = parse_probe(probe) if probe else None
+        except ProbeError as e:
+            raise HerderError(str(e))
+
+        if warmup_concurrency < 1:
+            raise HerderError('warmup_concurrency must be at least 1, not %s'
+                              % warmup_concurrency)
+        if warmup and not warmup_target:
+            # On the socket it shares with the old master, the old workers
+            # would answer most of the warm-up requests.
+            raise HerderError('warmup needs a warmup_target that only the new '
+                              'master listens on')
+        try:
+            self.warmup = (Warmup(load_requests(warmup), parse_target(warmup_target),
+                                  concurrency=warmup_concurrency,
+                                  latency=warmup_latency / 1000.0)
+                           if warmup else None)
+        except WarmupError as e:
+            raise HerderError(str(e))
+        self.warmup_timeout = warmup_timeout
+
+        try:
+            if metrics is not None:
+                parse_address(metrics)
+        except MetricsError as e:
+            raise HerderError(str(e))
+        self.metrics_address = metrics
+        self.metrics = Metrics()
+        self.metrics_server = None
+
+        try:
+            self.timeline = (Timeline(reload_log, pidfile=self.pidfile)
+                             if reload_log is not None else None)
+        except TimelineError as e:
+            raise HerderError(str(e))
+
+        self.control = control
+        self.control_server = None
+
+        # One snapshot of the process tree, shared by everything that looks
+        # at the workers.
+        self.tree = ProcessTree()
+
+        if unicorn_bin:
+            self.flavour = 'unicorn'
+        elif gunicorn_bin or unicorn.startswith('gunicorn'):
+            self.flavour = 'gunicorn'
+        else:
+            self.flavour = 'unicorn'
+
+        self.memory_interval = memory_interval
+        if worker_memory_limit is not None or memory_budget is not None:
+            self.memory_guard = MemoryGuard(
+                worker_limit=_megabytes(worker_memory_limit),
+                total_limit=_megabytes(memory_budget),
+                metric=memory_metric,
+                max_recycling=max_recycling,
+                recycle_signal=self._graceful_signal(),
+                tree=self.tree)
+        else:
+            self.memory_guard = None
+
+        self.usage_interval = usage_interval
+        if usage_interval is not None:
+            if usage_history < 1:
+                raise HerderError('usage_history must be at least 1, not %s' % usage_history)
+            self.usage_history = UsageHistory(usage_history, tree=self.tree)
+        else:
+            self.usage_history = None
+
+        self.pin_interval = pin_interval
+        try:
+            self.placer = (WorkerPlacer(pin_workers, tree=self.tree)
+                           if pin_workers is not None else None)
+        except AffinityError as e:
+            raise HerderError(str(e))
+
+        self.sharing_delay = sharing_delay
+        self.sharing_monitor = (SharingMonitor(tree=self.tree)
+                                if sharing_delay is not None else None)
+
+        self.backlog_interval = backlog_interval
+        if backlog_threshold is not None:
+            self.backlog_monitor = BacklogMonitor(backlog_threshold,
+                                                  duration=backlog_duration)
+        else:
+            self.backlog_monitor = None
+
+        self.scale_interval = scale_interval
+        if min_workers is not None and max_workers is not None:
+            if min_workers > max_workers:
+                raise HerderError('min_workers (%s) is greater than '
+                                  'max_workers (%s)' % (min_workers, max_workers))
+            self.autoscaler = Autoscaler(min_workers, max_workers,
+                                         up_cpu=scale_up_cpu,
+                                         down_cpu=scale_down_cpu,
+                                         up_queue=scale_queue,
+                                         cooldown=scale_cooldown,
+                                         tree=self.tree)
+        else:
+            self.autoscaler = None
 
         try:
             if not unicorn_bin and not gunicorn_bin:
@@ -89,8 +356,43 @@ class Herder(object):
             raise HerderError('Unknown unicorn type: %s' % self.unicorn)
 
         self.master = None
+        self.watcher = None
+        # Set by loop() if we were started by systemd
+        self.notifier = None
+        self.ready = False
         self.reloading = False
         self.terminating = False
+        self.waiter = None
+        self.timers = Timers()
+        self.reloads = []
+        self.pending_signals = []
+        self.spawned_at = None
+        # While we're waiting for a spawned unicorn to boot, when we give up
+        self.boot_deadline = None
+        self.booted = False
+        self.reload_requested_at = None
+        self.reload_count = 0
+        self.reload_timeline = None
+        # A HUP arrived during a reload, so we'll reload again once it's done
+        self.reload_pending = False
+        # If the new master turns up after FORK_TIMEOUT, the master it
+        # forked from still needs retiring.
+        self.late_fork_from = None
+        # New masters we've rolled back from, which the pidfile may name
+        # until the old master puts it back.
+        self.rolled_back_pids = set()
+        # Until when we'll keep retrying a pidfile we can't read
+        self.pidfile_deadline = None
+        # Workers added (or, if negative, removed) from the master with
+        # TTIN/TTOU since it started, which a new master won't start with
+        self.scaled_workers = 0
+        # TTINs and TTOUs still to be sent to the master, by the scale command
+        self.master_signals = []
+        # Control clients waiting for the reload being forked to start, for
+        # the queued follow-up reload, and for those in progress to finish.
+        self.reload_clients = []
+        self.followup_clients = []
+        self.reload_waiters = {}
 
     def spawn(self):
         """
@@ -100,19 +402,51 @@ class Herder(object):
         Returns False if unicorn fails to daemonize, and True otherwise.
 
         """
+        cmd = self._command()
+        if cmd is None:
+            return False
+
+        process = self._popen(cmd)
+        if process is None:
+            return False
+
+        deadline = self.boot_deadline
+        waiter = Waiter()
+        try:
+            while not self._daemonized(process, deadline):
+                # With a pidfd, we're woken as soon as it exits.
+                waiter.track([process.pid])
+                waiter.wait(min(WAIT_INTERVAL, deadline.remaining()))
+        except TimeoutError:
+            self._abandon(process)
+            return False
+        finally:
+            waiter.close()
+
+        # The unicorn herder does a graceful unicorn restart on HUP, and
+        # forwards other useful signals to the currently tracked master
+        # process. Either way, the signal is only queued here, and acted on
+        # by the monitoring loop.
+        install_signal_handlers(self._queue_signal)
+
+        return True
+
+    def _command(self):
         if self.unicorn in COMMANDS:
             cmd = COMMANDS[self.unicorn]
-            cmd = cmd.format(pidfile=self.pidfile, args=self.args)
+            return cmd.format(pidfile=self.pidfile, args=self.args)
         elif self.unicorn_bin:
             cmd = COMMANDS['unicorn_bin']
-            cmd = cmd.format(unicorn_bin=self.unicorn, pidfile=self.pidfile, args=self.args)
+            return cmd.format(unicorn_bin=self.unicorn, pidfile=self.pidfile, args=self.args)
         elif self.gunicorn_bin:
             cmd = COMMANDS['gunicorn_bin']
-            cmd = cmd.format(gunicorn_bin=self.unicorn, pidfile=self.pidfile, args=self.args)
-        else:
-            return False
+            return cmd.format(gunicorn_bin=self.unicorn, pidfile=self.pidfile, args=self.args)
+        return None
 
+    def _popen(self, cmd):
         log.debug("Calling %s: %s", self.unicorn, cmd)
+        self.spawned_at = monotonic()
+        self.boot_deadline = Deadline(self.boot_timeout)
 
         cmd = shlex.split(cmd)
         try:
@@ -120,66 +454,437 @@ class Herder(object):
         except OSError as e:
             if e.errno == 2:
                 log.error("Command '%s' not found. Is it installed?", cmd[0])
-                return False
+                return None
             else:
                 raise
 
         MANAGED_PIDS.add(process.pid)
+        return process
 
-        try:
-            with timeout(self.boot_timeout):
-                process.wait()
-        except TimeoutError:
-            log.error('%s failed to daemonize within %s seconds. Sending TERM '
-                      'and exiting.', self.unicorn, self.boot_timeout)
-            if process.poll() is None:
-                process.terminate()
+    def _daemonized(self, process, deadline):
+        """
+
+        Returns True once the spawned ``process`` has daemonized (i.e. exited),
+        and False while it's still going. Raises TimeoutError if it's still
+        going after ``deadline``.
+
+        """
+        if process.poll() is None:
+            deadline.check()
             return False
 
-        # If we got this far, unicorn has daemonized, and we no longer need to
-        # worry about the original process.
-        MANAGED_PIDS.remove(process.pid)
+        # Unicorn has daemonized, and we no longer need to worry about the
+        # original process.
+        MANAGED_PIDS.discard(process.pid)
+        return True
+
+    def _abandon(self, process):
+        log.error('%s failed to daemonize within %s seconds. Sending TERM '
+                  'and exiting.', self.unicorn, self.boot_timeout)
+        if process.poll() is None:
+            process.terminate()
 
-        # The unicorn herder does a graceful unicorn restart on HUP
-        signal.signal(signal.SIGHUP, self._handle_HUP)
+    def _terminate_spawned(self):
+        """
 
-        # Forward other useful signals to the currently tracked master
-        # process.
-        #
-        # We do NOT forward SIGWINCH, because it is triggered by terminal
-        # resize, leading to some *seriously* weird behaviour (resize
-        # xterm, unicorn workers are killed).
-        for sig in ['INT', 'QUIT', 'TERM', 'TTIN', 'TTOU', 'USR1', 'USR2']:
-            signal.signal(getattr(signal, 'SIG%s' % sig),
-                          self._handle_signal(sig))
+        Send TERM to the master of a unicorn we spawned and which daemonized,
+        but which we aren't going to herd after all. Its PID is read from the
+        pidfile, which may take until the boot deadline to appear.
 
-        return True
+        """
+        # A pidfile left over from before we spawned it isn't ours to act on.
+        spawned = time.time() - (monotonic() - self.spawned_at) - 1
+        while True:
+            try:
+                process = psutil.Process(Pidfile(self.pidfile).pid)
+                if process.create_time() >= spawned:
+                    break
+            except (PidfileError, psutil.NoSuchProcess):
+                pass
+            if self.boot_deadline.expired():
+                log.error('Could not find the master of %s in %s to stop it',
+                          self.unicorn, self.pidfile)
+                return
+            time.sleep(WAIT_INTERVAL)
+
+        log.info('Sending TERM to %s (PID %s)', self.unicorn, process.pid)
+        try:
+            process.terminate()
+        except psutil.NoSuchProcess:
+            pass
 
     def loop(self):
         """Enter the monitoring loop"""
-        while True:
-            if not self._loop_inner():
-                # The unicorn has died. So should we.
-                log.error('%s died. Exiting.', self.unicorn)
-                return 1
-            time.sleep(2)
+        waiter = Waiter()
+        self.notifier = Notifier.from_environment()
+        self._start(waiter)
+        waiter.install_wakeup_fd()
+        try:
+            while True:
+                if not self._tick():
+                    # The unicorn has died. So should we.
+                    log.error('%s died. Exiting.', self.unicorn)
+                    return 1
+                timeout = self.timers.next_timeout(self._poll_interval())
+                if self.notifier is not None:
+                    self.notifier.update(self._check_ready(),
+                                         reloading=self.reload_state != 'idle',
+                                         stopping=self.terminating,
+                                         status=self._describe())
+                    timeout = self.notifier.next_timeout(timeout)
+                waiter.wait(timeout)
+                self.tree.refresh()
+                self.timers.run()
+        finally:
+            self._stop()
+            waiter.close()
+
+    def _start(self, waiter):
+        """Start watching and serving, sharing ``waiter`` with anyone else."""
+        self.waiter = waiter
+        self.watcher = watch(Pidfile(self.pidfile).filenames)
+        waiter.add_watcher(self.watcher)
+        if self.metrics_address is not None:
+            try:
+                self.metrics_server = MetricsServer(self.metrics_address,
+                                                    self._render_metrics)
+            except MetricsError as e:
+                raise HerderError(str(e))
+            self.metrics_server.start()
+        if self.control is not None:
+            self.control_server = ControlServer(self.control, self._control)
+            try:
+                self.control_server.start(waiter)
+            except ControlError as e:
+                raise HerderError(str(e))
+        if self.boot_deadline is not None and not self.booted:
+            self.timers.set('boot', BOOT_INTERVAL, self._check_boot)
+        if self.memory_guard is not None:
+            self.timers.set('memory', self.memory_interval, self._check_memory)
+        if self.autoscaler is not None:
+            self.timers.set('autoscale', self.scale_interval, self._autoscale)
+        if self.backlog_monitor is not None:
+            self.timers.set('backlog', self.backlog_interval, self._check_backlog)
+        if self.usage_history is not None:
+            self.timers.set('usage', self.usage_interval, self._sample_usage)
+        if self.placer is not None:
+            self.timers.set('pin', self.pin_interval, self._pin_workers)
+
+    def _stop(self):
+        if self.control_server is not None:
+            self.control_server.close()
+            self.control_server = None
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        if self.timeline is not None:
+            self.timeline.close()
+        if self.notifier is not None:
+            self.notifier.close()
+            self.notifier = None
+
+    def _tick(self):
+        """Act on any queued signals, then check on the master."""
+        self._dispatch_signals()
+        self._step_exited_reloads()
+        return self._loop_inner()
+
+    def _step_exited_reloads(self):
+        # With a pidfd we're told as soon as an old master exits, so there's
+        # no need to wait for its reload's next step to notice.
+        if self.waiter is None:
+            return
+        for reload in list(self.reloads):
+            if reload.phase == 'exit' and reload.old_master.pid in self.waiter.exited:
+                self._step_reload(reload)
+
+    def _control(self, conn, words):
+        command, args = (words[0], words[1:]) if words else ('', [])
+        if command == 'status':
+            conn.respond(self._status())
+        elif command == 'reload':
+            self._control_reload(conn)
+        elif command == 'scale' and args and args[0] in ('up', 'down'):
+            self._control_scale(conn, args[0], args[1:])
+        elif command == 'backlog':
+            self._control_backlog(conn)
+        elif command == 'usage':
+            self._control_usage(conn, args)
+        else:
+            conn.respond({'ok': False,
+                          'error': 'Unknown command %r: expected status, reload, '
+                                   'scale up|down [N], backlog or usage [SECONDS]'
+                                   % ' '.join(words)})
+
+    def _status(self):
+        status = {
+            'ok': True,
+            'unicorn': self.unicorn,
+            'pidfile': self.pidfile,
+            'master': None,
+            'workers': [],
+            'reloading': self.reloading or bool(self.reloads),
+            'state': self.reload_state,
+            'reload_pending': self.reload_pending,
+            'reloads': [{'old_master': r.old_master.pid,
+                         'new_master': r.new_master.pid,
+                         'phase': r.phase,
+                         'elapsed': monotonic() - r.started}
+                        for r in self.reloads],
+        }
+        if self.master is not None:
+            status['master'] = self.master.pid
+            try:
+                status['workers'] = [w.pid for w in self.tree.children(self.master)]
+            except psutil.NoSuchProcess:
+                pass
+        return status
+
+    def _control_reload(self, conn):
+        if self.master is None:
+            conn.respond({'ok': False, 'error': 'No master to reload'})
+        elif self.reload_state != 'idle':
+            # Answered once the follow-up reload is done, so that the client
+            # knows the code it deployed is live.
+            self.followup_clients.append(conn)
+            self._handle_HUP(signal.SIGHUP, None)
+        else:
+            # Answered from _step_reload, once the old master is dealt with.
+            self.reload_clients.append(conn)
+            self._handle_HUP(signal.SIGHUP, None)
+
+    def _control_scale(self, conn, direction, args):
+        try:
+            count = int(args[0]) if args else 1
+        except ValueError:
+            count = 0
+        if count < 1:
+            conn.respond({'ok': False, 'error': 'Invalid worker count %r' % args[0]})
+        elif self.master is None:
+            conn.respond({'ok': False, 'error': 'No master to scale'})
+        elif self.reloading or self.reloads:
+            conn.respond({'ok': False, 'error': "Can't scale during a reload"})
+        else:
+            signum = signal.SIGTTIN if direction == 'up' else signal.SIGTTOU
+            self._queue_master_signals(signum, count)
+            conn.respond({'ok': True, 'master': self.master.pid,
+                          'signal': 'TTIN' if direction == 'up' else 'TTOU',
+                          'count': count})
+
+    def _control_backlog(self, conn):
+        if self.backlog_monitor is None:
+            conn.respond({'ok': False, 'error': 'The backlog monitor is not enabled'})
+            return
+        conn.respond({'ok': True,
+                      'threshold': self.backlog_monitor.threshold,
+                      'saturated': self.backlog_monitor.warned,
+                      'samples': [s._asdict() for s in self.backlog_monitor.samples]})
+
+    def _control_usage(self, conn, args):
+        if self.usage_history is None:
+            conn.respond({'ok': False, 'error': 'Usage history is not enabled'})
+            return
+        try:
+            since = time.time() - float(args[0]) if args else None
+        except ValueError:
+            conn.respond({'ok': False, 'error': 'Invalid number of seconds %r' % args[0]})
+            return
+        conn.respond({'ok': True,
+                      'fields': list(self.usage_history.buffer.fields),
+                      'rows': self.usage_history.dump(since)})
+
+    def _queue_master_signals(self, signum, count):
+        # Masters drop signals once a few are queued, so we space them out,
+        # sending each in turn to the master they were asked of.
+        self.master_signals.extend([(self.master, signum)] * count)
+        if 'signal-master' not in self.timers:
+            self._signal_master()
+
+    def _signal_master(self):
+        process, signum = self.master_signals.pop(0)
+        try:
+            process.send_signal(signum)
+        except psutil.NoSuchProcess:
+            self._cancel_master_signals()
+            return
+        # Only count what was sent, so that a reload knows how many workers
+        # the master really has beyond its configured number.
+        self.scaled_workers += 1 if signum == signal.SIGTTIN else -1
+        if self.master_signals:
+            self.timers.set('signal-master', SIGNAL_INTERVAL, self._signal_master)
+
+    def _cancel_master_signals(self):
+        self.master_signals = []
+        self.timers.cancel('signal-master')
+
+    @property
+    def reload_state(self):
+        """
+
+        Where the herder is in reloading: 'idle', 'forking' (USR2 sent,
+        waiting for the new master), then 'warming', 'overlapping' and
+        'retiring' as the old master is handed over from (see Reload).
+
+        """
+        if self.reloading:
+            return 'forking'
+        if self.reloads:
+            return self.reloads[0].state
+        return 'idle'
+
+    def _check_ready(self):
+        # We're ready once the master has booted and started a worker, and the
+        # readiness probe (if there is one) passes.
+        if not self.ready and self.booted:
+            try:
+                workers = self.tree.children(self.master)
+            except psutil.NoSuchProcess:
+                workers = []
+            self.ready = bool(workers) and (self.probe is None or bool(self.probe.check()))
+        return self.ready
+
+    def _describe(self):
+        """A one-line summary of what the herder is up to."""
+        if self.master is None:
+            return 'Waiting for %s' % self.unicorn
+        try:
+            workers = len(self.tree.children(self.master))
+        except psutil.NoSuchProcess:
+            workers = 0
+        description = 'PID %s with %s workers' % (self.master.pid, workers)
+        if self.reload_state != 'idle':
+            description += ', reloading (%s)' % self.reload_state
+        return description
+
+    def _render_metrics(self):
+        return self.metrics.render(self.master, self.tree)
+
+    def _graceful_signal(self):
+        """The signal which asks a worker (or master) to stop gracefully."""
+        return signal.SIGTERM if self.flavour == 'gunicorn' else signal.SIGQUIT
+
+    def _check_memory(self):
+        if self.master is not None:
+            try:
+                self.memory_guard.check(self.master)
+            except psutil.NoSuchProcess:
+                pass
+        self.timers.set('memory', self.memory_interval, self._check_memory)
+
+    def _autoscale(self):
+        # Worker counts are in flux during a reload, so leave them be.
+        if self.master is not None and not self.reloads:
+            try:
+                self.scaled_workers += self.autoscaler.check(self.master)
+            except psutil.NoSuchProcess:
+                pass
+        self.timers.set('autoscale', self.scale_interval, self._autoscale)
+
+    def _pin_workers(self):
+        # The old master's workers are included, so that new workers are
+        # placed on the CPUs least busy with either. The placer knows not to
+        # take the new master, the old one's child, for a worker.
+        if self.master is not None:
+            masters = [self.master] + [r.old_master for r in self.reloads
+                                       if r.old_master is not self.master]
+            self.placer.check(*masters)
+        self.timers.set('pin', self.pin_interval, self._pin_workers)
+
+    def _check_backlog(self):
+        if self.master is not None:
+            sample = self.backlog_monitor.check(self.master)
+            if sample is not None:
+                self.metrics.observe_backlog(sample)
+        self.timers.set('backlog', self.backlog_interval, self._check_backlog)
+
+    def _schedule_sharing(self):
+        # Give the workers time to fork and start serving, which is when
+        # they begin writing to pages they were sharing.
+        if self.sharing_monitor is not None:
+            self.timers.set('sharing', self.sharing_delay, self._check_sharing)
+
+    def _check_sharing(self):
+        if self.master is None:
+            return
+        report = self.sharing_monitor.check(self.master)
+        if report is not None:
+            self.metrics.observe_sharing(report)
+
+    def _sample_usage(self):
+        if self.master is not None:
+            self.usage_history.sample(self.master)
+        self.timers.set('usage', self.usage_interval, self._sample_usage)
+
+    def _poll_interval(self):
+        return poll_interval(self.waiter, self._tracked_pids())
+
+    def _tracked_pids(self):
+        if self.master is None:
+            return []
+        return [self.master.pid] + [r.old_master.pid for r in self.reloads]
+
+    def _master_exited(self):
+        return (self.waiter is not None and
+                self.master is not None and
+                self.master.pid in self.waiter.exited)
+
+    def _master_tracked(self, pid):
+        # While we hold a pidfd for the master, we know it's the same process
+        # as last time and there's no need to look it up again.
+        return (self.master is not None and
+                self.master.pid == pid and
+                self.waiter is not None and
+                pid in self.waiter.pidfds and
+                pid not in self.waiter.exited)
 
     def _loop_inner(self):
         old_master = self.master
-        pid = self._read_pidfile()
+
+        if self._master_exited():
+            # We know the master has gone, so there's no point waiting around
+            # for a pidfile that may never be rewritten. If it already names
+            # a different master, carry on with that one.
+            try:
+                pid = Pidfile(self.pidfile).pid
+            except PidfileError:
+                return False
+            if pid == old_master.pid:
+                return False
+        elif self._booting():
+            # The pidfile may not have been written yet. We'll be woken when
+            # it is, rather than sleeping in _read_pidfile.
+            try:
+                pid = Pidfile(self.pidfile).pid
+            except PidfileError:
+                return True
+        else:
+            pid = self._read_pidfile()
+            if pid is RETRY:
+                return True
 
         if pid is None:
             return False
 
-        try:
-            self.master = psutil.Process(pid)
-        except psutil.NoSuchProcess:
-            return False
+        if pid in self.rolled_back_pids:
+            return self.master.is_running()
+        self.rolled_back_pids.clear()
 
-        if old_master is None:
-            log.info('%s booted (PID %s)', self.unicorn, self.master.pid)
+        if not self._master_tracked(pid):
+            try:
+                self.master = psutil.Process(pid)
+            except psutil.NoSuchProcess:
+                return False
 
+        if old_master is None:
             MANAGED_PIDS.add(self.master.pid)
+            if self.boot_deadline is None:
+                # We didn't spawn it, so don't know how long it took.
+                log.info('%s booted (PID %s)', self.unicorn, self.master.pid)
+                self.booted = True
+                self._schedule_sharing()
+            else:
+                log.debug('%s wrote its pidfile (PID %s)', self.unicorn, self.master.pid)
+                self._check_boot()
 
         # Unicorn has forked a new master
         if old_master is not None and self.master.pid != old_master.pid:
@@ -189,36 +894,198 @@ class Herder(object):
                      self.master.pid)
 
             MANAGED_PIDS.add(self.master.pid)
+            self._cancel_master_signals()
 
             if self.reloading:
-                _wait_for_workers(self.overlap, self.master, old_master)
-                _kill_old_master(old_master)
                 self.reloading = False
-
-            MANAGED_PIDS.remove(old_master.pid)
+                self.timers.cancel('fork')
+                if self.reload_timeline is not None:
+                    self.reload_timeline.event('new_pid', old_pid=old_master.pid,
+                                               new_pid=self.master.pid)
+                self._start_reload(old_master)
+            elif old_master.pid == self.late_fork_from:
+                log.info('PID %s forked after all: retiring it', old_master.pid)
+                self._start_reload(old_master)
+            else:
+                MANAGED_PIDS.remove(old_master.pid)
+            self.late_fork_from = None
 
         return True
 
-    def _read_pidfile(self):
-        pidfile = Pidfile(self.pidfile)
+    def _booting(self):
+        return (self.master is None and self.boot_deadline is not None and
+                not self.boot_deadline.expired())
+
+    def _check_boot(self):
+        """
 
-        for _ in range(5):
+        Once unicorn has written its pidfile and is accepting connections,
+        report that it has booted and how long that took.
+
+        """
+        if self.booted or self.boot_deadline is None:
+            return
+        if self.master is not None:
             try:
-                return pidfile.pid
-            except PidfileError as error:
-                # If we are expecting unicorn to die, then this is normal, and
-                # we can just return None, thus triggering a clean exit of the
-                # Herder.
-                if self.terminating:
-                    return None
-                else:
-                    log.debug('Got an error while attempting to read pidfile: %s', error)
-                    log.debug('This is usually not fatal. Retrying in a moment...')
-                    time.sleep(1)
-                    continue
-
-        raise HerderError('Failed to read pidfile %s after 5 attempts, aborting!' %
-                          self.pidfile)
+                listening = is_listening(self.master.pid)
+            except OSError as e:
+                log.debug('Could not read the sockets of PID %s: %s', self.master.pid, e)
+                listening = True
+            if not listening and self.boot_deadline.expired():
+                log.warn('%s (PID %s) was not listening on any socket within %s '
+                         'seconds, carrying on anyway',
+                         self.unicorn, self.master.pid, self.boot_timeout)
+                listening = True
+            if listening:
+                seconds = monotonic() - self.spawned_at
+                log.info('%s booted (PID %s) in %.2f seconds',
+                         self.unicorn, self.master.pid, seconds)
+                self.booted = True
+                self.timers.cancel('boot')
+                self.metrics.observe_boot(seconds)
+                self._schedule_sharing()
+                return
+        elif self.boot_deadline.expired():
+            # _loop_inner will give up on the pidfile.
+            return
+        self.timers.set('boot', BOOT_INTERVAL, self._check_boot)
+
+    def _start_reload(self, old_master):
+        reload = Reload(old_master, self.master,
+                        overlap=self.overlap,
+                        probe=self.probe,
+                        probe_timeout=self.probe_timeout,
+                        drain_timeout=self.drain_timeout,
+                        started=self.reload_requested_at,
+                        scaled_workers=self.scaled_workers,
+                        tree=self.tree,
+                        rolling_step=self.rolling_step,
+                        rolling_budget=self.rolling_budget,
+                        timeline=self.reload_timeline,
+                        rollback_crashes=self.rollback_crashes,
+                        rollback_probe_failures=self.rollback_probe_failures,
+                        demote=self.demote_old,
+                        warmup=self.warmup,
+                        warmup_timeout=self.warmup_timeout)
+        self.scaled_workers = 0
+        self.reload_requested_at = None
+        self.reload_timeline = None
+        if self.reload_clients:
+            self.reload_waiters[reload] = self.reload_clients
+            self.reload_clients = []
+        self.reloads.append(reload)
+        self._step_reload(reload)
+
+    def _step_reload(self, reload):
+        delay = reload.step()
+        if reload.rolled_back and self.master is reload.new_master:
+            log.info('Tracking PID %s again', reload.old_master.pid)
+            self._cancel_master_signals()
+            self.master = reload.old_master
+            self.scaled_workers = reload.scaled_workers
+            self.rolled_back_pids.add(reload.new_master.pid)
+        if delay is not None:
+            self.timers.set(reload, delay, lambda: self._step_reload(reload))
+            return
+
+        self.timers.cancel(reload)
+        self.reloads.remove(reload)
+        retired = reload.new_master if reload.rolled_back else reload.old_master
+        MANAGED_PIDS.discard(retired.pid)
+        self.tree.forget(retired)
+        self.metrics.observe_reload(reload)
+        if not reload.aborted:
+            self._schedule_sharing()
+
+        for conn in self.reload_waiters.pop(reload, []):
+            conn.respond({'ok': not (reload.aborted or reload.rolled_back),
+                          'old_master': reload.old_master.pid,
+                          'new_master': reload.new_master.pid,
+                          'aborted': reload.aborted,
+                          'rolled_back': reload.rolled_back,
+                          'duration': reload.duration,
+                          'durations': reload.durations})
+
+        self._start_followup()
+
+    def _fork_timed_out(self):
+        if not self.reloading:
+            return
+        log.error('PID %s did not fork a new master within %s seconds of USR2, '
+                  'giving up on this reload', self.master.pid, FORK_TIMEOUT)
+        self.reloading = False
+        self.late_fork_from = self.master.pid
+        self.reload_requested_at = None
+        if self.reload_timeline is not None:
+            self.reload_timeline.event('fork_timeout', pid=self.master.pid)
+            self.reload_timeline = None
+        for conn in self.reload_clients:
+            conn.respond({'ok': False,
+                          'error': 'No new master appeared within %s seconds' % FORK_TIMEOUT})
+        self.reload_clients = []
+        self._start_followup()
+
+    def _start_followup(self):
+        # HUPs which arrived during the reload just finished become a single
+        # reload of the new master, so that each master is retired before
+        # the next one is forked.
+        if not self.reload_pending or self.reload_state != 'idle':
+            return
+        self.reload_pending = False
+        self.reload_clients, self.followup_clients = self.followup_clients, []
+        if self.terminating:
+            for conn in self.reload_clients:
+                conn.respond({'ok': False, 'error': 'The herder is exiting'})
+            self.reload_clients = []
+            return
+        log.info('Starting the reload queued during the last one')
+        self._handle_HUP(signal.SIGHUP, None)
+
+    def _read_pidfile(self):
+        """
+
+        Return the PID in the pidfile, None if unicorn is expected to have
+        gone, or RETRY if the pidfile can't be read just now. Retries happen
+        on a timer rather than by sleeping, so that other instances in a
+        flock aren't held up meanwhile. Raises HerderError once the pidfile
+        has been unreadable for PIDFILE_TIMEOUT seconds.
+
+        """
+        try:
+            pid = Pidfile(self.pidfile).pid
+        except PidfileError as error:
+            # If we are expecting unicorn to die, then this is normal, and
+            # we can just return None, thus triggering a clean exit of the
+            # Herder.
+            if self.terminating:
+                return None
+            if self.pidfile_deadline is None:
+                self.pidfile_deadline = Deadline(PIDFILE_TIMEOUT)
+            elif self.pidfile_deadline.expired():
+                raise HerderError('Failed to read pidfile %s within %s seconds, aborting!' %
+                                  (self.pidfile, PIDFILE_TIMEOUT))
+            log.debug('Got an error while attempting to read pidfile: %s', error)
+            log.debug('This is usually not fatal. Retrying in a moment...')
+            # Nothing to do but make sure we're woken to look again.
+            self.timers.set('pidfile', WAIT_INTERVAL, lambda: None)
+            return RETRY
+
+        self.pidfile_deadline = None
+        self.timers.cancel('pidfile')
+        return pid
+
+    def _queue_signal(self, signum, frame):
+        self.pending_signals.append(signum)
+
+    def _dispatch_signals(self):
+        while self.pending_signals:
+            signum = self.pending_signals.pop(0)
+            if signum == signal.SIGHUP:
+                self._handle_HUP(signum, None)
+                continue
+            for name in FORWARDED_SIGNALS:
+                if signum == getattr(signal, 'SIG%s' % name):
+                    self._handle_signal(name)(signum, None)
 
     def _handle_signal(self, name):
         def _handler(signum, frame):
@@ -230,6 +1097,18 @@ class Herder(object):
                 log.debug("Caught %s: expecting termination.", name)
                 self.terminating = True
 
+                # Any old masters we're still retiring should go too, rather
+                # than waiting out the rest of their reload.
+                for reload in list(self.reloads):
+                    log.debug("Forwarding %s to old master PID %s",
+                              name, reload.old_master.pid)
+                    try:
+                        reload.old_master.send_signal(signum)
+                    except psutil.NoSuchProcess:
+                        pass
+                    reload.abort()
+                    self._step_reload(reload)
+
             log.debug("Forwarding %s to PID %s", name, self.master.pid)
             self.master.send_signal(signum)
 
@@ -238,13 +1117,59 @@ class Herder(object):
     def _handle_HUP(self, signum, frame):
         if self.master is None:
             log.warn("Caught HUP but have no tracked process.")
+            for conn in self.reload_clients:
+                conn.respond({'ok': False, 'error': 'No master to reload'})
+            self.reload_clients = []
+            return
+
+        if self.reload_state != 'idle':
+            # Forking another master now would leave the one being started
+            # (or the one being retired) to be handed over to twice, so we
+            # wait and reload once more at the end, however many HUPs come.
+            if self.reload_pending:
+                log.info("Caught HUP: a follow-up reload is already queued")
+            else:
+                log.info("Caught HUP while %s: will reload again once done",
+                         self.reload_state)
+            self.reload_pending = True
             return
 
         log.info("Caught HUP: gracefully restarting PID %s", self.master.pid)
         self.reloading = True
+        self.timers.set('fork', FORK_TIMEOUT, self._fork_timed_out)
+        self.reload_requested_at = monotonic()
+        self.reload_count += 1
+        if self.timeline is not None:
+            self.reload_timeline = self.timeline.bind(reload=self.reload_count)
+            self.reload_timeline.event('hup', pid=self.master.pid)
+            self.reload_timeline.event('signal', signal='USR2', pid=self.master.pid)
         self.master.send_signal(signal.SIGUSR2)
 
 
+def install_signal_handlers(handler):
+    """Send HUP and every forwarded signal to ``handler``."""
+    for sig in ['HUP'] + FORWARDED_SIGNALS:
+        signal.signal(getattr(signal, 'SIG%s' % sig), handler)
+
+
+def poll_interval(waiter, pids):
+    """
+
+    How long ``waiter`` may sleep while watching ``pids``: a long time if the
+    kernel will tell us about both pidfile changes and exits, and a short one
+    if we have to poll for either.
+
+    """
+    watching = all(w.fileno() is not None for w in waiter.watchers)
+    if waiter.track(pids) and watching:
+        return IDLE_INTERVAL
+    return POLL_INTERVAL
+
+
+def _megabytes(mb):
+    return None if mb is None else mb * MB
+
+
 #
 # If the unicorn herder exits abnormally, it is essential that unicorn
 # dies as well. Register an atexit callback to kill off any surviving
@@ -258,48 +1183,3 @@ def _emergency_slaughter():
             proc.kill()
         except:
             pass
-
-
-def _wait_for_workers(overlap, new_process, old_process):
-    # We expect the current process has one extra child (the new process that
-    # was forked aside from the usual number of workers
-    current_workers = len(old_process.children()) - 1
-    # We hope for same number of workers, if we don't have that we'll accept 1
-    expected_children = max(current_workers, 1)
-    # Within 2 minutes we expect to have recovered all our workers, otherwise
-    # we'll assume it's an intentional drop in workers.
-    maximum_time = 120
-    try:
-        with timeout(maximum_time):
-            while len(new_process.children()) < expected_children:
-                time.sleep(1)
-
-        log.debug('Found %s child processes for PID %s, old processes will '
-                  'be stopped in %s seconds',
-                  expected_children, new_process.pid, overlap)
-        time.sleep(overlap)
-    except TimeoutError:
-        log.warn('The expected number of workers (%s) was not reached in %s '
-                 'seconds for PID %s, continuing with shutdown',
-                 expected_children, maximum_time, new_process.pid)
-
-def _kill_old_master(process):
-    """Shut down the old server gracefully.
-
-    There's a bit of extra complexity here, because Unicorn and Gunicorn handle
-    signals differently : both respond to SIGWINCH by gracefully stopping their
-    workers, but while Unicorn treats SIGQUIT as a graceful shutdown and
-    SIGTERM as a quick shutdown, Gunicorn reverses the meaning of these two.
-
-    <http://unicorn.bogomips.org/SIGNALS.html>
-    <http://gunicorn-docs.readthedocs.org/en/latest/signals.html>
-
-    We get around this by sending SIGWINCH first, giving the worker processes
-    some time to shut themselves down first.
-
-    """
-    log.debug("Sending WINCH to old master (PID %s)", process.pid)
-    process.send_signal(signal.SIGWINCH)
-    time.sleep(1)
-    log.debug("Sending QUIT to old master (PID %s)", process.pid)
-    process.send_signal(signal.SIGQUIT)
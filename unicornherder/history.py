@@ -0,0 +1,123 @@
+import array
+import math
+import psutil
+import time
+
+from .snapshot import ProcessTree
+
+# How many rows (one per process per sample) to keep by default: at 72 bytes
+# a row, about 3.5MB.
+HISTORY = 50000
+
+FIELDS = ('time', 'pid', 'master', 'cpu_user', 'cpu_system', 'rss',
+          'ctx_voluntary', 'ctx_involuntary', 'fds')
+
+
+class RingBuffer(object):
+    """
+
+    A fixed number of rows of numbers, overwriting the oldest once full. Each
+    column is a preallocated array of doubles, so the buffer takes the same
+    memory after months of appends as it did after the first.
+
+    """
+
+    __slots__ = ('fields', 'size', 'columns', 'start', 'length')
+
+    def __init__(self, fields, size):
+        if size < 1:
+            raise ValueError('A ring buffer needs room for at least one row')
+        self.fields = tuple(fields)
+        self.size = size
+        self.columns = [array.array('d', [0.0]) * size for _ in self.fields]
+        self.start = 0
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, row):
+        index = (self.start + self.length) % self.size
+        if self.length == self.size:
+            self.start = (self.start + 1) % self.size
+        else:
+            self.length += 1
+        for column, value in zip(self.columns, row):
+            column[index] = value
+
+    def rows(self):
+        """Return every row, oldest first, as tuples."""
+        indexes = [(self.start + i) % self.size for i in range(self.length)]
+        return [tuple(column[i] for column in self.columns) for i in indexes]
+
+
+class UsageHistory(object):
+    """
+
+    A rolling record of the resources used by the master and each of its
+    workers -- CPU time, RSS, context switches and open file descriptors --
+    so that after the fact we can see which process spiked, and when.
+
+    Each ``sample()`` adds a row per process to a RingBuffer of ``size``
+    rows. Anything that can't be read (open files belonging to another user,
+    say) is recorded as NaN, and dumped as None. Workers are found through
+    ``tree``, a ProcessTree shared with the rest of the herder, if given.
+
+    """
+
+    def __init__(self, size=HISTORY, tree=None):
+        self.buffer = RingBuffer(FIELDS, size)
+        self.tree = tree
+
+    def sample(self, master):
+        """Record a row for ``master`` and each of its workers."""
+        tree = self.tree or ProcessTree()
+        now = time.time()
+        try:
+            workers = tree.children(master)
+        except psutil.NoSuchProcess:
+            return
+        for process in [master] + workers:
+            row = _usage(process)
+            if row is not None:
+                self.buffer.append((now, process.pid, process is master) + row)
+
+    def dump(self, since=None):
+        """
+
+        Return the rows recorded at or after wall-clock time ``since`` (all
+        of them if None), oldest first, as lists in the order of ``FIELDS``.
+
+        """
+        rows = []
+        for row in self.buffer.rows():
+            if since is not None and row[0] < since:
+                continue
+            rows.append([None if math.isnan(v) else _number(v) for v in row])
+        return rows
+
+
+def _usage(process):
+    """Read everything we record about ``process``, or None if it's gone."""
+    nan = float('nan')
+    try:
+        with process.oneshot():
+            cpu = process.cpu_times()
+            rss = process.memory_info().rss
+            try:
+                ctx = process.num_ctx_switches()
+                voluntary, involuntary = ctx.voluntary, ctx.involuntary
+            except psutil.AccessDenied:
+                voluntary = involuntary = nan
+            try:
+                fds = process.num_fds()
+            except psutil.AccessDenied:
+                fds = nan
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return None
+    return (cpu.user, cpu.system, rss, voluntary, involuntary, fds)
+
+
+def _number(value):
+    # Counts are stored as doubles, but read better as integers.
+    return int(value) if value == int(value) else value
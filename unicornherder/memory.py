@@ -0,0 +1,93 @@
+import logging
+import psutil
+import signal
+
+from .snapshot import ProcessTree
+
+log = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+class MemoryGuard(object):
+    """
+
+    Gracefully recycles workers which use too much memory, leaving it to the
+    master to fork replacements.
+
+    A worker is recycled when its own memory (RSS, or USS if ``metric`` is
+    'uss') exceeds ``worker_limit`` bytes, or -- largest first -- while the
+    master and all its workers together exceed ``total_limit`` bytes. No more
+    than ``max_recycling`` workers are ever recycled at once, so a leak that
+    affects every worker can't take out the whole pool at the same time.
+
+    Workers are told to stop with ``recycle_signal``, which should be the
+    signal the worker treats as a graceful shutdown: QUIT for unicorn, TERM
+    for gunicorn.
+
+    Workers are read from ``tree``, a ProcessTree shared with the rest of the
+    herder, if given.
+
+    """
+
+    def __init__(self, worker_limit=None, total_limit=None, metric='rss',
+                 max_recycling=1, recycle_signal=signal.SIGQUIT, tree=None):
+        self.worker_limit = worker_limit
+        self.total_limit = total_limit
+        self.metric = metric
+        self.max_recycling = max_recycling
+        self.recycle_signal = recycle_signal
+        self.tree = tree
+        self.recycling = set()
+
+    def check(self, master):
+        """Sample the workers of ``master`` and recycle any that are too big."""
+        tree = self.tree or ProcessTree()
+        usage = {}
+        for worker in tree.children(master):
+            try:
+                usage[worker] = self._memory(worker, tree)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+
+        # Forget about workers which have finished recycling.
+        self.recycling &= set(w.pid for w in usage)
+
+        try:
+            total = self._memory(master, tree) + sum(usage.values())
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return []
+
+        candidates = sorted(usage.items(), key=lambda item: item[1], reverse=True)
+        recycled = []
+        for worker, used in candidates:
+            if len(self.recycling) >= self.max_recycling:
+                break
+            if worker.pid in self.recycling:
+                continue
+
+            if self.worker_limit is not None and used > self.worker_limit:
+                log.warn('Worker PID %s is using %.1fMB (limit %.1fMB), recycling it',
+                         worker.pid, used / float(MB), self.worker_limit / float(MB))
+            elif self.total_limit is not None and total > self.total_limit:
+                log.warn('PID %s and its workers are using %.1fMB (budget %.1fMB), '
+                         'recycling worker PID %s (%.1fMB)',
+                         master.pid, total / float(MB), self.total_limit / float(MB),
+                         worker.pid, used / float(MB))
+            else:
+                continue
+
+            try:
+                worker.send_signal(self.recycle_signal)
+            except psutil.NoSuchProcess:
+                continue
+            self.recycling.add(worker.pid)
+            recycled.append(worker.pid)
+            total -= used
+
+        return recycled
+
+    def _memory(self, process, tree):
+        if self.metric == 'uss':
+            return process.memory_full_info().uss
+        return tree.stats(process).rss
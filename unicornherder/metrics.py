@@ -0,0 +1,335 @@
+import logging
+import os
+import psutil
+import socket
+import stat
+import threading
+import time
+
+from .snapshot import ProcessTree
+
+try:
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    import SocketServer as socketserver
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Reloads take tens of seconds to minutes, so the usual Prometheus default
+# buckets (which top out at 10s) aren't much use.
+RELOAD_BUCKETS = (1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600)
+
+
+class MetricsError(Exception):
+    pass
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=RELOAD_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def render(self, name, labels=''):
+        sep = ',' if labels else ''
+        lines = []
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append('%s_bucket{%s%sle="%s"} %s' % (name, labels, sep, bound, count))
+        lines.append('%s_bucket{%s%sle="+Inf"} %s' % (name, labels, sep, self.count))
+        labels = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %s' % (name, labels, self.sum))
+        lines.append('%s_count%s %s' % (name, labels, self.count))
+        return lines
+
+
+class Metrics(object):
+    """
+
+    Counters and histograms describing a herder's reloads and boot, plus a
+    snapshot of its master and workers taken with psutil whenever the metrics
+    are rendered.
+
+    Updates come from the herder's main loop and renders from the metrics
+    server's thread, so everything is guarded by a lock.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.boot_seconds = None
+        self.reloads = 0
+        self.aborted_reloads = 0
+        self.rolled_back_reloads = 0
+        self.reload_seconds = Histogram()
+        self.phase_seconds = {}
+        self.backlog = None
+        self.sharing = None
+
+    def observe_boot(self, seconds):
+        with self.lock:
+            self.boot_seconds = seconds
+
+    def observe_backlog(self, sample):
+        with self.lock:
+            self.backlog = sample
+
+    def observe_sharing(self, report):
+        with self.lock:
+            self.sharing = report
+
+    def observe_reload(self, reload):
+        with self.lock:
+            if reload.aborted:
+                self.aborted_reloads += 1
+                return
+            if reload.rolled_back:
+                self.rolled_back_reloads += 1
+                return
+            self.reloads += 1
+            self.reload_seconds.observe(reload.duration)
+            for phase, seconds in reload.durations.items():
+                if phase not in self.phase_seconds:
+                    self.phase_seconds[phase] = Histogram()
+                self.phase_seconds[phase].observe(seconds)
+
+    def render(self, master, tree=None):
+        """
+
+        Render every metric in the Prometheus text format, reading the workers
+        of ``master`` from ``tree`` (a ProcessTree) if given.
+
+        """
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.extend(samples)
+
+        if master is not None:
+            _render_processes(master, tree or ProcessTree(), metric)
+
+        with self.lock:
+            if self.boot_seconds is not None:
+                metric('unicornherder_boot_seconds', 'gauge',
+                       'Time from spawning unicorn to it accepting connections.',
+                       ['unicornherder_boot_seconds %s' % self.boot_seconds])
+            metric('unicornherder_reloads_total', 'counter',
+                   'Hot-reloads completed.',
+                   ['unicornherder_reloads_total %s' % self.reloads])
+            metric('unicornherder_aborted_reloads_total', 'counter',
+                   'Hot-reloads abandoned before the old master was retired.',
+                   ['unicornherder_aborted_reloads_total %s' % self.aborted_reloads])
+            metric('unicornherder_rolled_back_reloads_total', 'counter',
+                   'Hot-reloads rolled back to the old master.',
+                   ['unicornherder_rolled_back_reloads_total %s'
+                    % self.rolled_back_reloads])
+            metric('unicornherder_reload_duration_seconds', 'histogram',
+                   'Time from HUP to the old master being retired.',
+                   self.reload_seconds.render('unicornherder_reload_duration_seconds'))
+            samples = []
+            for phase in sorted(self.phase_seconds):
+                samples.extend(self.phase_seconds[phase].render(
+                    'unicornherder_reload_phase_seconds', 'phase="%s"' % phase))
+            metric('unicornherder_reload_phase_seconds', 'histogram',
+                   'Time spent in each phase of a hot-reload.', samples)
+            if self.backlog is not None:
+                _render_backlog(self.backlog, metric)
+            if self.sharing is not None:
+                _render_sharing(self.sharing, metric)
+
+        return '\n'.join(lines) + '\n'
+
+
+def _render_backlog(sample, metric):
+    metric('unicornherder_listen_queue', 'gauge',
+           'Connections waiting to be accepted on the listen sockets.',
+           ['unicornherder_listen_queue %s' % sample.queue])
+    if sample.overflows is not None:
+        metric('unicornherder_listen_overflows_total', 'counter',
+               'Connections dropped because a listen queue was full (whole '
+               'network namespace).',
+               ['unicornherder_listen_overflows_total %s' % sample.overflows])
+        metric('unicornherder_listen_drops_total', 'counter',
+               'Connections dropped by listen sockets for any reason (whole '
+               'network namespace).',
+               ['unicornherder_listen_drops_total %s' % sample.drops])
+
+
+def _render_sharing(report, metric):
+    if report.ratio is not None:
+        metric('unicornherder_shared_memory_ratio', 'gauge',
+               'Fraction of the workers\' resident memory shared with other '
+               'processes, when last reported.',
+               ['unicornherder_shared_memory_ratio %s' % report.ratio])
+    memory = [report.master] + report.workers
+    samples = []
+    for kind in ('rss', 'pss', 'uss'):
+        samples.append('unicornherder_memory_bytes{kind="%s"} %s'
+                       % (kind, sum(getattr(m, kind) for m in memory)))
+    metric('unicornherder_memory_bytes', 'gauge',
+           'Memory of the master and its workers together, when sharing was '
+           'last reported.', samples)
+
+
+def _render_processes(master, tree, metric):
+    try:
+        create_time = master.create_time()
+        workers = tree.children(master)
+    except psutil.NoSuchProcess:
+        return
+
+    metric('unicornherder_master_pid', 'gauge',
+           'PID of the current unicorn master.',
+           ['unicornherder_master_pid %s' % master.pid])
+    metric('unicornherder_master_start_time_seconds', 'gauge',
+           'Start time of the current unicorn master, in seconds since the epoch.',
+           ['unicornherder_master_start_time_seconds %s' % create_time])
+    metric('unicornherder_master_uptime_seconds', 'gauge',
+           'How long the current unicorn master has been running.',
+           ['unicornherder_master_uptime_seconds %s' % (time.time() - create_time)])
+
+    rss, cpu = [], []
+    for worker in workers:
+        try:
+            stats = tree.stats(worker)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+        rss.append('unicornherder_worker_rss_bytes{pid="%s"} %s' % (worker.pid, stats.rss))
+        cpu.append('unicornherder_worker_cpu_seconds_total{pid="%s",mode="user"} %s' %
+                   (worker.pid, stats.cpu_user))
+        cpu.append('unicornherder_worker_cpu_seconds_total{pid="%s",mode="system"} %s' %
+                   (worker.pid, stats.cpu_system))
+
+    metric('unicornherder_workers', 'gauge',
+           'Number of workers of the current unicorn master.',
+           ['unicornherder_workers %s' % len(rss)])
+    metric('unicornherder_worker_rss_bytes', 'gauge',
+           'Resident set size of each worker.', rss)
+    metric('unicornherder_worker_cpu_seconds_total', 'counter',
+           'CPU time used by each worker.', cpu)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('Metrics request: ' + format, *args)
+
+
+class _TCPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address.
+        request, _ = self.socket.accept()
+        return request, ('unix', 0)
+
+
+class MetricsServer(object):
+    """
+
+    Serves ``render()`` over HTTP in a background thread, on either a TCP
+    address (``HOST:PORT``) or a UNIX socket (``unix:PATH``).
+
+    """
+
+    def __init__(self, address, render):
+        self.address = address
+        family, bind = parse_address(address)
+        try:
+            if family == 'unix':
+                if os.path.exists(bind):
+                    _remove_stale_socket(bind)
+                self.path = bind
+                self.server = _UnixServer(bind, _Handler)
+            else:
+                self.path = None
+                self.server = _TCPServer(bind, _Handler)
+        except socket.error as e:
+            raise MetricsError('Could not serve metrics on %s: %s' % (address, e))
+        self.server.render = render
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        log.info('Serving metrics on %s', self.address)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+def _remove_stale_socket(path):
+    # A socket left behind by an earlier herder. If anyone is still
+    # listening on it, it isn't ours to take.
+    if not stat.S_ISSOCK(os.stat(path).st_mode):
+        raise MetricsError('Metrics socket %s exists and is not a socket' % path)
+    probe = socket.socket(socket.AF_UNIX)
+    try:
+        probe.connect(path)
+    except socket.error:
+        os.unlink(path)
+    else:
+        raise MetricsError('Metrics socket %s is already in use' % path)
+    finally:
+        probe.close()
+
+
+def parse_address(address):
+    """
+
+    Parse a metrics address, either ``HOST:PORT`` (HOST defaulting to
+    127.0.0.1) or ``unix:PATH``. Returns ('unix', PATH) or ('tcp', (HOST,
+    PORT)).
+
+    """
+    if address.startswith('unix:'):
+        path = address[len('unix:'):]
+        if path.startswith('//'):
+            path = path[2:]
+        if not path:
+            raise MetricsError('Metrics socket needs a path: %s' % address)
+        return 'unix', path
+
+    host, _, port = address.rpartition(':')
+    try:
+        port = int(port)
+    except ValueError:
+        raise MetricsError('Metrics address must be HOST:PORT or unix:PATH, '
+                           'not %s' % address)
+    return 'tcp', (host or '127.0.0.1', port)
@@ -0,0 +1,200 @@
+import collections
+import logging
+import os
+import socket
+import struct
+
+log = logging.getLogger(__name__)
+
+# Socket state for LISTEN in /proc/net/tcp{,6}
+TCP_LISTEN = '0A'
+
+# __SO_ACCEPTCON, the flag marking listening sockets in /proc/net/unix
+UNIX_ACCEPTCON = 0x10000
+
+ListenSocket = collections.namedtuple('ListenSocket', 'address port queue inode')
+ListenSocket.__doc__ = """
+
+A listening TCP socket. ``queue`` is the number of connections which have
+been established but not yet accepted by a worker.
+
+"""
+
+
+def socket_inodes(pid, proc='/proc'):
+    """Return the inodes of every socket process ``pid`` has open."""
+    fd_dir = os.path.join(proc, str(pid), 'fd')
+    inodes = set()
+    for fd in os.listdir(fd_dir):
+        try:
+            target = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            continue
+        if target.startswith('socket:['):
+            inodes.add(int(target[len('socket:['):-1]))
+    return inodes
+
+
+def listening_sockets(pid, proc='/proc'):
+    """
+
+    Return a ListenSocket for every listening TCP socket held by process
+    ``pid``, as seen in its own network namespace.
+
+    Raises OSError if the process's /proc entries can't be read.
+
+    """
+    inodes = socket_inodes(pid, proc)
+    if not inodes:
+        return []
+
+    sockets = []
+    for table, family in (('tcp', socket.AF_INET), ('tcp6', socket.AF_INET6)):
+        path = os.path.join(proc, str(pid), 'net', table)
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except IOError as e:
+            log.debug('Could not read %s: %s', path, e)
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 10 or fields[3] != TCP_LISTEN:
+                continue
+            inode = int(fields[9])
+            if inode not in inodes:
+                continue
+            address, port = _decode_address(fields[1], family)
+            queue = int(fields[4].split(':')[1], 16)
+            sockets.append(ListenSocket(address, port, queue, inode))
+    return sockets
+
+
+def listening_unix_sockets(pid, proc='/proc'):
+    """
+
+    Return the path of every listening UNIX socket held by process ``pid``
+    (empty for unnamed sockets, and starting with @ for abstract ones).
+
+    Raises OSError if the process's /proc entries can't be read.
+
+    """
+    inodes = socket_inodes(pid, proc)
+    if not inodes:
+        return []
+
+    path = os.path.join(proc, str(pid), 'net', 'unix')
+    try:
+        with open(path) as f:
+            lines = f.readlines()[1:]
+    except IOError as e:
+        log.debug('Could not read %s: %s', path, e)
+        return []
+
+    paths = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 7 or not int(fields[3], 16) & UNIX_ACCEPTCON:
+            continue
+        if int(fields[6]) in inodes:
+            paths.append(fields[7] if len(fields) > 7 else '')
+    return paths
+
+
+def is_listening(pid, proc='/proc'):
+    """
+
+    Return True if process ``pid`` is accepting connections on any TCP or
+    UNIX socket.
+
+    Raises OSError if the process's /proc entries can't be read.
+
+    """
+    return bool(listening_sockets(pid, proc) or listening_unix_sockets(pid, proc))
+
+
+def listens_on(pid, target, proc='/proc'):
+    """
+
+    Return whether process ``pid`` is listening on ``target``: ``('tcp',
+    (HOST, PORT))`` or ``('unix', PATH)``. A TCP socket bound to all
+    addresses matches any host on its port, as does one on the same port
+    when the host is a name we'd have to look up.
+
+    """
+    family, address = target
+    try:
+        if family == 'unix':
+            return address in listening_unix_sockets(pid, proc)
+        host, port = address
+        for sock in listening_sockets(pid, proc):
+            if sock.port != port:
+                continue
+            if sock.address in ('0.0.0.0', '::', host) or not _is_address(host):
+                return True
+    except OSError as e:
+        log.debug('Could not read the listen sockets of PID %s: %s', pid, e)
+    return False
+
+
+def _is_address(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (socket.error, ValueError):
+            continue
+    return False
+
+
+def accept_queue(pid, proc='/proc'):
+    """
+
+    Return the total number of connections waiting to be accepted on the
+    listening sockets of process ``pid``, or None if we can't tell.
+
+    """
+    try:
+        return sum(s.queue for s in listening_sockets(pid, proc))
+    except OSError as e:
+        log.debug('Could not read the listen sockets of PID %s: %s', pid, e)
+        return None
+
+
+def listen_overflows(pid, proc='/proc'):
+    """
+
+    Return the ListenOverflows and ListenDrops counters of the network
+    namespace process ``pid`` is in: how many connections have been turned
+    away because a listen queue was full, or for any reason. These count for
+    every socket in the namespace, not just those of ``pid``.
+
+    Returns None if they can't be read.
+
+    """
+    path = os.path.join(proc, str(pid), 'net', 'netstat')
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except IOError as e:
+        log.debug('Could not read %s: %s', path, e)
+        return None
+
+    # Pairs of lines: a header of names, then a line of values
+    for names, values in zip(lines[::2], lines[1::2]):
+        if not names.startswith('TcpExt:'):
+            continue
+        counters = dict(zip(names.split()[1:], values.split()[1:]))
+        try:
+            return int(counters['ListenOverflows']), int(counters['ListenDrops'])
+        except (KeyError, ValueError):
+            return None
+    return None
+
+
+def _decode_address(field, family):
+    # Addresses are written as hex in host byte order, 32 bits at a time.
+    host, port = field.split(':')
+    words = [int(host[i:i + 8], 16) for i in range(0, len(host), 8)]
+    packed = struct.pack('=%dI' % len(words), *words)
+    return socket.inet_ntop(family, packed), int(port, 16)
@@ -0,0 +1,129 @@
+import logging
+import os
+import socket
+import time
+
+from .timeout import Deadline
+
+log = logging.getLogger(__name__)
+
+# Until we've told systemd we're ready, how often to check whether we are
+READY_INTERVAL = 0.25
+
+
+class Notifier(object):
+    """
+
+    Tells systemd how the herder is getting on, using the sd_notify protocol
+    (so that it can be run as a ``Type=notify`` or ``Type=notify-reload``
+    service), without needing libsystemd.
+
+    The herder calls ``update()`` every time round its loop with whether it is
+    ready, reloading or stopping and a one-line status, and only changes are
+    passed on: ``READY=1`` once ready, ``RELOADING=1`` when a reload starts and
+    ``READY=1`` again when it's over, ``STOPPING=1``, and ``STATUS=``. If systemd
+    has set a watchdog, ``update()`` also sends ``WATCHDOG=1`` at half its
+    interval, so that a herder stuck anywhere in its loop is noticed.
+
+    """
+
+    def __init__(self, address, watchdog=None):
+        # A leading @ means an address in the abstract namespace
+        if address.startswith('@'):
+            address = '\0' + address[1:]
+        self.address = address
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.watchdog = watchdog
+        self.watchdog_deadline = Deadline(0)
+        self.state = None
+        self.status = None
+        self.failing = False
+
+    @classmethod
+    def from_environment(cls, environ=None):
+        """
+
+        Return a Notifier for the socket systemd gave us in ``$NOTIFY_SOCKET``,
+        or None if we weren't started by systemd.
+
+        """
+        environ = os.environ if environ is None else environ
+        address = environ.get('NOTIFY_SOCKET')
+        if not address:
+            return None
+
+        watchdog = None
+        pid = environ.get('WATCHDOG_PID')
+        if environ.get('WATCHDOG_USEC') and (not pid or pid == str(os.getpid())):
+            try:
+                watchdog = int(environ['WATCHDOG_USEC']) / 1e6
+            except ValueError:
+                log.warn('Ignoring invalid WATCHDOG_USEC %r', environ['WATCHDOG_USEC'])
+        return cls(address, watchdog)
+
+    @property
+    def ready(self):
+        return self.state is not None
+
+    def update(self, ready, reloading=False, stopping=False, status=None):
+        lines = []
+        if stopping:
+            if self.state != 'stopping':
+                lines.append('STOPPING=1')
+                self.state = 'stopping'
+        elif self.state is None:
+            if ready:
+                lines.append('READY=1')
+                self.state = 'ready'
+        elif self.state == 'ready' and reloading:
+            lines.append('RELOADING=1')
+            usec = _monotonic_usec()
+            if usec is not None:
+                lines.append('MONOTONIC_USEC=%d' % usec)
+            self.state = 'reloading'
+        elif self.state == 'reloading' and not reloading:
+            lines.append('READY=1')
+            self.state = 'ready'
+
+        if status is not None and status != self.status:
+            lines.append('STATUS=%s' % status)
+            self.status = status
+
+        if self.watchdog is not None and self.watchdog_deadline.expired():
+            lines.append('WATCHDOG=1')
+            self.watchdog_deadline = Deadline(self.watchdog / 2.0)
+
+        if lines:
+            self.send(*lines)
+
+    def next_timeout(self, default):
+        """How long until ``update()`` next needs calling, at most ``default``."""
+        if self.state is None:
+            default = min(default, READY_INTERVAL)
+        if self.watchdog is not None:
+            default = min(default, self.watchdog_deadline.remaining())
+        return default
+
+    def send(self, *lines):
+        message = '\n'.join(lines) + '\n'
+        try:
+            self.socket.sendto(message.encode('utf-8'), self.address)
+        except socket.error as e:
+            # Only complain once until sends start working again.
+            if not self.failing:
+                log.warn('Could not notify systemd at %s: %s', self.address, e)
+            self.failing = True
+            return
+        self.failing = False
+
+    def close(self):
+        self.socket.close()
+
+
+def _monotonic_usec():
+    # systemd wants to know when a reload started on CLOCK_MONOTONIC, which
+    # Python 2 can't read.
+    clock_gettime = getattr(time, 'clock_gettime', None)
+    if clock_gettime is None:
+        return None
+    return int(clock_gettime(time.CLOCK_MONOTONIC) * 1e6)
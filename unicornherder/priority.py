@@ -0,0 +1,70 @@
+import logging
+import psutil
+
+log = logging.getLogger(__name__)
+
+# The highest niceness there is
+MAX_NICE = 19
+
+# The lowest best-effort I/O priority. Not the idle class, which would starve
+# the old workers of I/O altogether while they're still serving requests.
+IONICE_LEVEL = 7
+
+
+class Demotion(object):
+    """
+
+    Lowers the CPU priority of ``processes`` by ``increment`` nice levels, and
+    their I/O priority to the lowest of the best-effort class, remembering
+    what each had so that ``restore()`` can put it back.
+
+    Children forked later inherit their parent's priorities, so demoting a
+    master and its workers covers any workers it replaces afterwards too.
+
+    Raising a priority back up may need CAP_SYS_NICE (or a raised
+    RLIMIT_NICE) that lowering it didn't, so ``restore()`` logs a warning for
+    any process it can't put back.
+
+    """
+
+    def __init__(self, processes, increment):
+        self.increment = increment
+        self.saved = []
+        for process in processes:
+            try:
+                nice = process.nice()
+                ionice = process.ionice() if hasattr(process, 'ionice') else None
+                process.nice(min(nice + increment, MAX_NICE))
+                if ionice is not None:
+                    process.ionice(psutil.IOPRIO_CLASS_BE, IONICE_LEVEL)
+            except psutil.NoSuchProcess:
+                continue
+            except psutil.AccessDenied as e:
+                log.warn('Could not lower the priority of PID %s: %s', process.pid, e)
+                continue
+            self.saved.append((process, nice, ionice))
+
+    @property
+    def pids(self):
+        return [process.pid for process, _, _ in self.saved]
+
+    def restore(self):
+        """Give every demoted process that's still running its priority back."""
+        for process, nice, ionice in self.saved:
+            try:
+                process.nice(nice)
+                if ionice is not None:
+                    _set_ionice(process, ionice)
+            except psutil.NoSuchProcess:
+                continue
+            except psutil.AccessDenied as e:
+                log.warn('Could not restore the priority of PID %s: %s', process.pid, e)
+        self.saved = []
+
+
+def _set_ionice(process, ionice):
+    if ionice.ioclass == psutil.IOPRIO_CLASS_NONE:
+        # Back to following the CPU priority; this class takes no level.
+        process.ionice(psutil.IOPRIO_CLASS_NONE)
+    else:
+        process.ionice(ionice.ioclass, ionice.value)
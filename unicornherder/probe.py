@@ -0,0 +1,152 @@
+import logging
+import socket
+import threading
+
+try:
+    from http.client import HTTPException
+    from urllib.error import URLError
+    from urllib.parse import urlparse
+    from urllib.request import ProxyHandler, build_opener
+except ImportError:  # Python 2
+    from httplib import HTTPException
+    from urllib2 import ProxyHandler, URLError, build_opener
+    from urlparse import urlparse
+
+log = logging.getLogger(__name__)
+
+
+class ProbeError(Exception):
+    pass
+
+
+class HttpProbe(object):
+    """
+
+    Passes if a GET of ``url`` returns a non-error status. Proxy settings
+    in the environment are ignored, since the probe is for the app itself.
+
+    The request is made in a background thread so as not to hold up the
+    herder: ``check()`` starts one if none is in flight, and returns None
+    until it has an answer.
+
+    """
+
+    def __init__(self, url, timeout=1):
+        self.url = url
+        self.timeout = timeout
+        self.opener = build_opener(ProxyHandler({}))
+        self.lock = threading.Lock()
+        self.thread = None
+        self.result = None
+
+        url = urlparse(url)
+        default_port = 443 if url.scheme == 'https' else 80
+        self.target = ('tcp', (url.hostname, url.port or default_port))
+
+    def check(self):
+        with self.lock:
+            if self.result is not None:
+                result, self.result = self.result, None
+                return result
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+        return None
+
+    def _run(self):
+        passed = self._get()
+        with self.lock:
+            self.result = passed
+            self.thread = None
+
+    def _get(self):
+        try:
+            response = self.opener.open(self.url, timeout=self.timeout)
+            try:
+                response.read()
+            finally:
+                response.close()
+        except (URLError, HTTPException, socket.error) as e:
+            # HTTPException covers endpoints that don't speak HTTP at all.
+            log.debug('Probe %s failed: %s', self, e)
+            return False
+        return True
+
+    def __str__(self):
+        return self.url
+
+
+class _SocketProbe(object):
+
+    def check(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except socket.error as e:
+            log.debug('Probe %s failed: %s', self, e)
+            return False
+        finally:
+            sock.close()
+        return True
+
+
+class TcpProbe(_SocketProbe):
+    """Passes if a TCP connection to ``host:port`` can be established."""
+
+    family = socket.AF_INET
+
+    def __init__(self, host, port, timeout=1):
+        if ':' in host:
+            self.family = socket.AF_INET6
+        self.address = (host, port)
+        self.target = ('tcp', self.address)
+        self.timeout = timeout
+
+    def __str__(self):
+        return 'tcp://%s:%s' % self.address
+
+
+class UnixProbe(_SocketProbe):
+    """Passes if the UNIX socket at ``path`` accepts a connection."""
+
+    family = getattr(socket, 'AF_UNIX', None)
+
+    def __init__(self, path, timeout=1):
+        self.address = path
+        self.target = ('unix', path)
+        self.timeout = timeout
+
+    def __str__(self):
+        return 'unix://%s' % self.address
+
+
+def parse_probe(spec):
+    """
+
+    Build a probe from a URL-style specification:
+
+        http://127.0.0.1:8080/healthcheck
+        tcp://127.0.0.1:8080
+        unix:///var/run/myapp.sock
+
+    """
+    url = urlparse(spec)
+
+    if url.scheme in ('http', 'https'):
+        return HttpProbe(spec)
+    if url.scheme == 'tcp':
+        try:
+            port = url.port
+        except ValueError:
+            port = None
+        if not url.hostname or port is None:
+            raise ProbeError('TCP probe needs a host and port: %s' % spec)
+        return TcpProbe(url.hostname, port)
+    if url.scheme == 'unix':
+        if not url.path:
+            raise ProbeError('UNIX socket probe needs a path: %s' % spec)
+        return UnixProbe(url.path)
+
+    raise ProbeError('Unknown probe type: %s' % spec)
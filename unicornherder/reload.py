@@ -0,0 +1,672 @@
+import logging
+import psutil
+import signal
+
+from .netstat import listens_on
+from .priority import Demotion
+from .snapshot import ProcessTree
+from .timeline import signal_name
+from .warmup import describe_target
+from .timeout import Deadline, monotonic
+
+log = logging.getLogger(__name__)
+
+# Within 2 minutes we expect the new master to have recovered all our
+# workers, otherwise we'll assume it's an intentional drop in workers.
+WORKERS_TIMEOUT = 120
+
+# How often to re-count the new master's workers
+WORKERS_INTERVAL = 0.25
+
+# During a rolling handover, how often to re-count both masters' workers,
+# and how long a single step may take before we give up rolling and finish
+# the reload the ordinary way.
+ROLLING_INTERVAL = 0.25
+ROLLING_TIMEOUT = 120
+
+# unicorn and gunicorn masters both drop signals once a handful are queued,
+# so we space out the TTINs and TTOUs of a rolling handover.
+SIGNAL_INTERVAL = 0.1
+
+# How often to retry a failing readiness probe
+PROBE_INTERVAL = 0.5
+
+# How often to check on a round of warm-up requests
+WARMUP_INTERVAL = 0.25
+
+# How often to check whether the old workers have drained their connections,
+# and how long to give the old master to exit after QUIT before we KILL it.
+DRAIN_INTERVAL = 0.5
+KILL_TIMEOUT = 30
+
+# Where each phase of a reload puts the herder as a whole, which also has
+# the states 'forking' (USR2 sent, waiting for the new master's pidfile) and
+# 'idle' (no reload in progress).
+PHASE_STATES = {
+    'rolling': 'warming',
+    'workers': 'warming',
+    'probe': 'warming',
+    'warmup': 'warming',
+    'overlap': 'overlapping',
+    'drain': 'retiring',
+    'exit': 'retiring',
+    'rollback': 'rolling_back',
+    'done': 'idle',
+}
+
+
+class Reload(object):
+    """
+
+    Retires ``old_master`` in favour of ``new_master`` once the latter is
+    ready to take over.
+
+    A Reload never blocks: each call to ``step()`` does whatever can be done
+    right now and returns how many seconds until it next wants to be called,
+    or None once the old master has been dealt with. The herder schedules
+    those calls on its timers, so it stays free to handle signals, pidfile
+    changes and other reloads in the meantime.
+
+    The phases of a reload are:
+
+        rolling - handing workers over from the old master to the new one a
+                  few at a time (if ``rolling_step`` is set)
+        workers - waiting for the new master to start as many workers as the
+                  old one had
+        probe   - waiting for the readiness probe to pass (if there is one)
+        warmup  - replaying warm-up requests until their latency settles (if
+                  ``warmup`` is set)
+        overlap - waiting for the overlap to expire (if there's neither)
+        drain   - WINCH sent; waiting for the old workers to finish
+        exit    - QUIT sent; waiting for the old master to exit (and KILLing
+                  it if it doesn't, in drain mode)
+        rollback - the new master is broken: QUIT sent to it, and the old
+                  master restored to full strength
+        done    - nothing left to do
+
+    In a rolling handover, the new master is first trimmed to
+    ``rolling_step`` workers with TTOU. Then, each time the new master has all
+    the workers it's been asked for (and the readiness probe, if any,
+    passes), the old master gives up ``rolling_step`` workers with TTOU and
+    the new one gains as many with TTIN, until the new master has the full
+    complement. If ``rolling_budget`` is set, the new master isn't grown while
+    that would take both masters and their workers over that many bytes of
+    RSS. Either way both masters together hold about one full set of workers
+    plus one step, rather than two full sets. A step that takes longer than
+    ROLLING_TIMEOUT abandons the rolling handover, and the new master is
+    grown back to full size at once.
+
+    If ``rollback_crashes`` is set, the reload is rolled back once that many
+    of the new master's workers have died without being asked to, up until
+    the old master is sent QUIT. Likewise if ``rollback_probe_failures`` is
+    set and the readiness probe fails that many times in a row. The new
+    master is sent QUIT, and the old master is sent TTIN for every worker it
+    has given up, whether to a rolling handover or to WINCH. Workers are only
+    seen as often as the reload is stepped, so one which dies between two
+    looks goes uncounted. If the new master itself exits before the old one
+    is sent QUIT, the reload is always rolled back.
+
+    If ``warmup`` (a Warmup) is given, once the new master has its workers
+    and has passed the readiness probe, rounds of warm-up requests are sent
+    to it until one is fast enough, or ``warmup_timeout`` seconds have
+    passed; only then is the old master retired. Warm-up is skipped if the
+    old master listens on the warm-up target too.
+
+    If ``demote`` is set, the old master and its workers are reniced by that
+    many levels, and given the lowest best-effort I/O priority, once the new
+    master has all its workers, so that the new workers get the CPU and disk
+    they need to warm up. Their priorities are restored if the reload is
+    aborted or rolled back.
+
+    ``scaled_workers`` is how many workers the old master has been given with
+    TTIN (less those taken away with TTOU) since it started, which the new
+    master won't start with and so isn't waited for.
+
+    Workers are counted using ``tree``, a ProcessTree shared with the rest of
+    the herder, if given. If ``timeline`` (a Timeline) is given, every phase
+    change and signal sent is recorded on it, followed by a ``summary`` event
+    when the reload is done.
+
+    """
+
+    def __init__(self, old_master, new_master, overlap=30, probe=None,
+                 probe_timeout=120, drain_timeout=None, started=None,
+                 scaled_workers=0, tree=None, rolling_step=None,
+                 rolling_budget=None, timeline=None, rollback_crashes=None,
+                 rollback_probe_failures=None, demote=None, warmup=None,
+                 warmup_timeout=120):
+        self.old_master = old_master
+        self.new_master = new_master
+        self.overlap = overlap
+        if probe is not None and listens_on(old_master.pid, probe.target):
+            # The old workers would answer it as readily as the new ones.
+            log.warn('Old master (PID %s) is listening on %s too, so the readiness '
+                     'probe could pass without the new master: ignoring it',
+                     old_master.pid, probe)
+            probe = None
+        self.probe = probe
+        self.probe_timeout = probe_timeout
+        self.drain_timeout = drain_timeout
+        self.tree = tree
+        self.timeline = timeline
+
+        # We expect the current process has one extra child (the new process
+        # that was forked aside from the usual number of workers
+        current_workers = len(self._children(old_master)) - 1
+        # We hope for same number of workers, if we don't have that we'll
+        # accept 1
+        # If the old master was given extra workers at runtime, the new master
+        # will only start its configured number of workers.
+        self.scaled_workers = scaled_workers
+        self.expected_children = max(current_workers - max(scaled_workers, 0), 1)
+
+        # How long was spent in each phase, for metrics. If we know when the
+        # reload was asked for, the time it took the new master to appear is
+        # recorded as the 'fork' phase.
+        now = monotonic()
+        self.started = now if started is None else started
+        self.durations = {}
+        if started is not None:
+            self.durations['fork'] = now - started
+        self.duration = None
+        self.aborted = False
+        self.rolled_back = False
+
+        self.rollback_crashes = rollback_crashes
+        self.rollback_probe_failures = rollback_probe_failures
+        # The new master's workers when we last looked, and how many of them
+        # have died since we started.
+        self.new_workers = set()
+        self.crashes = 0
+        self.probe_failures = 0
+
+        self.demote = demote
+        self.demotion = None
+
+        self.warmup = warmup
+        self.warmup_timeout = warmup_timeout
+        self.warmup_round = None
+        self.warmup_rounds = 0
+
+        self.rolling_step = rolling_step
+        self.rolling_budget = rolling_budget
+        self.signals = []
+        # How many workers we've asked each master to have.
+        self.old_target = self.expected_children
+        self.new_target = self.expected_children
+
+        self.phase_started = now
+        if rolling_step is not None and rolling_step < self.expected_children:
+            self.phase = 'rolling'
+            self.deadline = Deadline(ROLLING_TIMEOUT)
+            self.new_target = rolling_step
+            log.info('Trimming new master (PID %s) to %s workers for a rolling '
+                     'handover', new_master.pid, rolling_step)
+            self._queue_signals(new_master, signal.SIGTTOU,
+                                self.expected_children - rolling_step)
+        else:
+            self.phase = 'workers'
+            self.deadline = Deadline(WORKERS_TIMEOUT)
+        self._event('phase', phase=self.phase, expected_workers=self.expected_children)
+
+    def step(self):
+        """
+
+        Advance the reload as far as it can go right now. Returns the number
+        of seconds until it should be stepped again, or None when it's done.
+
+        """
+        while self.phase != 'done':
+            delay = getattr(self, '_step_%s' % self.phase)()
+            if delay:
+                return delay
+        return None
+
+    @property
+    def state(self):
+        """Which of the herder's reload states this reload is in."""
+        return PHASE_STATES[self.phase]
+
+    def abort(self):
+        """Stop retiring the old master, leaving both masters running."""
+        log.info('Abandoning reload of PID %s', self.old_master.pid)
+        self.aborted = True
+        self._restore_priority()
+        self._enter('done')
+
+    def _enter(self, phase, seconds=None):
+        log.debug('Reload of PID %s entering %s phase', self.old_master.pid, phase)
+        now = monotonic()
+        self.durations[self.phase] = (self.durations.get(self.phase, 0) +
+                                      now - self.phase_started)
+        self.phase = phase
+        self.phase_started = now
+        self._event('phase', phase=phase)
+        if phase == 'done':
+            self.duration = now - self.started
+            self._event('summary',
+                        duration=self.duration,
+                        durations=self.durations,
+                        aborted=self.aborted,
+                        rolled_back=self.rolled_back,
+                        expected_workers=self.expected_children)
+        if seconds is not None:
+            self.deadline = Deadline(seconds)
+
+    def _step_rolling(self):
+        if self.signals:
+            process, signum = self.signals.pop(0)
+            self._signal(process, signum)
+            return SIGNAL_INTERVAL
+
+        if self._new_master_broken():
+            return 0
+
+        if self.new_target >= self.expected_children:
+            self._enter('workers', WORKERS_TIMEOUT)
+            return 0
+
+        if self.deadline.expired():
+            log.warn('Rolling handover from PID %s to PID %s made no progress in '
+                     '%s seconds, growing PID %s to %s workers',
+                     self.old_master.pid, self.new_master.pid, ROLLING_TIMEOUT,
+                     self.new_master.pid, self.expected_children)
+            self._grow(self.expected_children - self.new_target)
+            return 0
+
+        try:
+            old_workers = [c for c in self._children(self.old_master)
+                           if c.pid != self.new_master.pid]
+            new_workers = self._children(self.new_master)
+        except psutil.NoSuchProcess:
+            # One of the masters has gone; there's nothing left to hand over.
+            self._enter('workers', WORKERS_TIMEOUT)
+            return 0
+
+        if len(new_workers) < self.new_target or len(old_workers) > self.old_target:
+            return ROLLING_INTERVAL
+        if self.probe is not None and not self._probe_passes():
+            return 0 if self.phase == 'rollback' else PROBE_INTERVAL
+
+        # Give up old workers first, so that there's room for the new ones.
+        surplus = self.old_target + self.new_target - self.expected_children
+        if surplus > 0 and self.old_target > 1:
+            count = min(surplus, self.old_target - 1)
+            log.debug('Removing %s workers from old master (PID %s)',
+                      count, self.old_master.pid)
+            self.old_target -= count
+            self._queue_signals(self.old_master, signal.SIGTTOU, count)
+            self.deadline = Deadline(ROLLING_TIMEOUT)
+            return 0
+
+        count = min(self.rolling_step, self.expected_children - self.new_target)
+        if self.rolling_budget is not None:
+            rss = self._rss(old_workers + new_workers + [self.old_master, self.new_master])
+            worker_rss = self._rss(new_workers) // max(len(new_workers), 1)
+            if rss + count * worker_rss > self.rolling_budget:
+                log.debug('Waiting to grow new master (PID %s): %.1fMB in use, '
+                          'budget %.1fMB', self.new_master.pid, rss / 1048576.0,
+                          self.rolling_budget / 1048576.0)
+                return ROLLING_INTERVAL
+
+        log.debug('Adding %s workers to new master (PID %s)',
+                  count, self.new_master.pid)
+        self._grow(count)
+        return 0
+
+    def _grow(self, count):
+        self.new_target += count
+        self._queue_signals(self.new_master, signal.SIGTTIN, count)
+        self.deadline = Deadline(ROLLING_TIMEOUT)
+
+    def _queue_signals(self, process, signum, count):
+        self.signals.extend([(process, signum)] * count)
+
+    def _rss(self, processes):
+        tree = self.tree or ProcessTree()
+        total = 0
+        for process in processes:
+            try:
+                total += tree.stats(process).rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        return total
+
+    def _step_workers(self):
+        if self._new_master_broken():
+            return 0
+
+        workers = len(self._children(self.new_master))
+        if workers >= self.expected_children:
+            self._event('workers_ready', workers=workers)
+            self._lower_priority()
+            if self.probe is not None:
+                log.debug('Found %s child processes for PID %s, old processes '
+                          'will be stopped once %s passes',
+                          self.expected_children, self.new_master.pid, self.probe)
+                self._enter('probe', self.probe_timeout)
+            elif self.warmup is not None:
+                self._start_warmup()
+            else:
+                log.debug('Found %s child processes for PID %s, old processes '
+                          'will be stopped in %s seconds',
+                          self.expected_children, self.new_master.pid, self.overlap)
+                self._enter('overlap', self.overlap)
+            return 0
+
+        if self.deadline.expired():
+            log.warn('The expected number of workers (%s) was not reached in %s '
+                     'seconds for PID %s, continuing with shutdown',
+                     self.expected_children, WORKERS_TIMEOUT, self.new_master.pid)
+            self._winch()
+            return 0
+
+        return WORKERS_INTERVAL
+
+    def _step_probe(self):
+        if self._new_master_broken():
+            return 0
+
+        if self._probe_passes():
+            log.info('Readiness probe %s passed for PID %s',
+                     self.probe, self.new_master.pid)
+            if self.warmup is not None:
+                self._start_warmup()
+            else:
+                self._winch()
+            return 0
+        if self.phase == 'rollback':
+            return 0
+
+        if self.deadline.expired():
+            log.warn('Readiness probe %s did not pass within %s seconds for '
+                     'PID %s, continuing with shutdown',
+                     self.probe, self.probe_timeout, self.new_master.pid)
+            self._winch()
+            return 0
+
+        return PROBE_INTERVAL
+
+    def _start_warmup(self):
+        target = describe_target(self.warmup.target)
+        if listens_on(self.old_master.pid, self.warmup.target):
+            log.warn('Old master (PID %s) is listening on %s too, so its workers '
+                     'would answer the warm-up requests: skipping warm-up',
+                     self.old_master.pid, target)
+            self._winch()
+            return
+        log.debug('Sending %s to PID %s at %s', self.warmup, self.new_master.pid,
+                  target)
+        self._enter('warmup', self.warmup_timeout)
+        self.warmup_round = self.warmup.start()
+
+    def _step_warmup(self):
+        if self._new_master_broken():
+            return 0
+
+        current = self.warmup_round
+        if current.done():
+            self.warmup_rounds += 1
+            self._event('warmup_round', latency=current.latency, errors=current.errors)
+            if self.warmup.settled(current):
+                log.info('Warm-up requests for PID %s settled at %.0fms after %s '
+                         'rounds', self.new_master.pid, current.latency * 1000,
+                         self.warmup_rounds)
+                self._winch()
+                return 0
+            log.debug('Warm-up round %s for PID %s: %s errors, latency %s',
+                      self.warmup_rounds, self.new_master.pid, current.errors,
+                      current.latency)
+            if not self.deadline.expired():
+                self.warmup_round = self.warmup.start()
+
+        if self.deadline.expired():
+            log.warn('Warm-up requests for PID %s did not settle within %s '
+                     'seconds, continuing with shutdown',
+                     self.new_master.pid, self.warmup_timeout)
+            self._winch()
+            return 0
+
+        return min(self.deadline.remaining(), WARMUP_INTERVAL)
+
+    def _step_overlap(self):
+        if self._new_master_broken():
+            return 0
+        if self.deadline.expired():
+            self._winch()
+            return 0
+        if self.rollback_crashes is not None:
+            return min(self.deadline.remaining(), WORKERS_INTERVAL)
+        return self.deadline.remaining()
+
+    def _winch(self):
+        # Unicorn and Gunicorn handle signals differently: both respond to
+        # SIGWINCH by gracefully stopping their workers, but while Unicorn
+        # treats SIGQUIT as a graceful shutdown and SIGTERM as a quick
+        # shutdown, Gunicorn reverses the meaning of these two.
+        #
+        # <http://unicorn.bogomips.org/SIGNALS.html>
+        # <http://gunicorn-docs.readthedocs.org/en/latest/signals.html>
+        #
+        # We get around this by sending SIGWINCH first, giving the worker
+        # processes some time to shut themselves down first.
+        log.debug("Sending WINCH to old master (PID %s)", self.old_master.pid)
+        self._signal(self.old_master, signal.SIGWINCH)
+        self.old_target = 0
+        # Without a drain timeout, we just give the workers a second.
+        self._enter('drain', 1 if self.drain_timeout is None else self.drain_timeout)
+
+    def _step_drain(self):
+        if self._new_master_broken():
+            return 0
+
+        if self.drain_timeout is None:
+            if not self.deadline.expired():
+                return self.deadline.remaining()
+            self._quit()
+            self._enter('exit', KILL_TIMEOUT)
+            return 0
+
+        try:
+            connections = _established_connections(self._children(self.old_master))
+        except psutil.NoSuchProcess:
+            connections = 0
+
+        if connections == 0:
+            log.debug('Old master (PID %s) has drained its connections',
+                      self.old_master.pid)
+        elif self.deadline.expired():
+            log.warn('Old workers of PID %s still had %s established '
+                     'connections after %s seconds, continuing with shutdown',
+                     self.old_master.pid, connections, self.drain_timeout)
+        else:
+            return DRAIN_INTERVAL
+
+        self._event('drained', connections=connections)
+        self._quit()
+        self._enter('exit', KILL_TIMEOUT)
+        return 0
+
+    def _step_exit(self):
+        if _exited(self.old_master):
+            self._event('exited', pid=self.old_master.pid)
+            self._enter('done')
+            return 0
+
+        if self.deadline.expired() and self.drain_timeout is None:
+            # Without a drain timeout, we only wait to see when the old master
+            # goes. It may still be finishing long requests, so let it.
+            log.info('Old master (PID %s) has not exited within %s seconds of '
+                     'QUIT, no longer waiting for it', self.old_master.pid, KILL_TIMEOUT)
+            self._enter('done')
+            return 0
+
+        if self.deadline.expired():
+            log.warn('Old master (PID %s) did not exit within %s seconds of '
+                     'QUIT, sending KILL', self.old_master.pid, KILL_TIMEOUT)
+            self._event('signal', signal='KILL', pid=self.old_master.pid)
+            try:
+                self.old_master.kill()
+            except psutil.NoSuchProcess:
+                pass
+            self._enter('done')
+            return 0
+
+        return DRAIN_INTERVAL
+
+    def _step_rollback(self):
+        if self.signals:
+            process, signum = self.signals.pop(0)
+            self._signal(process, signum)
+            return SIGNAL_INTERVAL
+
+        if _exited(self.new_master):
+            self._event('exited', pid=self.new_master.pid)
+            self._enter('done')
+            return 0
+
+        if self.deadline.expired():
+            log.warn('New master (PID %s) did not exit within %s seconds of '
+                     'QUIT, sending KILL', self.new_master.pid, KILL_TIMEOUT)
+            self._event('signal', signal='KILL', pid=self.new_master.pid)
+            try:
+                self.new_master.kill()
+            except psutil.NoSuchProcess:
+                pass
+            self._enter('done')
+            return 0
+
+        return DRAIN_INTERVAL
+
+    def _new_master_broken(self):
+        """
+
+        Count the new master's workers which have died since we last looked,
+        and roll back if there have been too many, or if the new master has
+        gone altogether. Returns True if we have.
+
+        """
+        try:
+            children = self._children(self.new_master)
+        except psutil.NoSuchProcess:
+            # Whether or not we were asked to roll back, there's nothing
+            # left to hand over to.
+            self._roll_back('the new master exited', new_master_gone=True)
+            return True
+
+        if self.rollback_crashes is None:
+            return False
+
+        workers = set(c.pid for c in children)
+
+        # Workers above the number we've asked for are going because of our
+        # TTOUs, so don't count.
+        gone = len(self.new_workers - workers)
+        excused = max(len(self.new_workers) - self.new_target, 0)
+        self.crashes += max(gone - excused, 0)
+        self.new_workers = workers
+        if self.crashes >= self.rollback_crashes:
+            self._roll_back('%s of its workers died' % self.crashes)
+            return True
+        return False
+
+    def _probe_passes(self):
+        passed = self.probe.check()
+        if passed is None:
+            # Still waiting for an answer
+            return False
+        if passed:
+            self.probe_failures = 0
+            return True
+        self.probe_failures += 1
+        if (self.rollback_probe_failures is not None and
+                self.probe_failures >= self.rollback_probe_failures):
+            self._roll_back('the readiness probe failed %s times in a row'
+                            % self.probe_failures)
+        return False
+
+    def _roll_back(self, reason, new_master_gone=False):
+        log.error('Rolling back from PID %s to PID %s: %s',
+                  self.new_master.pid, self.old_master.pid, reason)
+        self.rolled_back = True
+        self._event('rollback', reason=reason)
+        self._restore_priority()
+        # Drop whatever handover signals were still to be sent, stop the new
+        # master, then give the old one back the workers it gave up.
+        unsent = sum(1 for process, signum in self.signals
+                     if process is self.old_master and signum == signal.SIGTTOU)
+        self.signals = [] if new_master_gone else [(self.new_master, signal.SIGQUIT)]
+        self._queue_signals(self.old_master, signal.SIGTTIN,
+                            self.expected_children - self.old_target - unsent)
+        self.old_target = self.expected_children
+        self._enter('rollback', KILL_TIMEOUT + len(self.signals) * SIGNAL_INTERVAL)
+
+    def _lower_priority(self):
+        if self.demote is None:
+            return
+        try:
+            # The new master started life as one of the old master's
+            # children, and may still be one.
+            workers = [c for c in self._children(self.old_master)
+                       if c.pid != self.new_master.pid]
+        except psutil.NoSuchProcess:
+            return
+        self.demotion = Demotion([self.old_master] + workers, self.demote)
+        log.info('Lowered the priority of old master (PID %s) and its workers by '
+                 '%s nice levels', self.old_master.pid, self.demote)
+        self._event('demoted', pids=self.demotion.pids)
+
+    def _restore_priority(self):
+        if self.demotion is None:
+            return
+        log.info('Restoring the priority of old master (PID %s)', self.old_master.pid)
+        self.demotion.restore()
+        self.demotion = None
+        self._event('restored', pid=self.old_master.pid)
+
+    def _signal(self, process, signum):
+        self._event('signal', signal=signal_name(signum), pid=process.pid)
+        _send_signal(process, signum)
+
+    def _event(self, name, **fields):
+        if self.timeline is not None:
+            self.timeline.event(name, **fields)
+
+    def _children(self, process):
+        return (self.tree or ProcessTree()).children(process)
+
+    def _quit(self):
+        log.debug("Sending QUIT to old master (PID %s)", self.old_master.pid)
+        self._signal(self.old_master, signal.SIGQUIT)
+
+
+def _send_signal(process, signum):
+    try:
+        process.send_signal(signum)
+    except psutil.NoSuchProcess:
+        pass
+
+
+def _exited(process):
+    # A master is reparented once it daemonizes, and if nothing reaps it (as
+    # when the herder is PID 1 in a container) it lingers as a zombie.
+    if not process.is_running():
+        return True
+    try:
+        return process.status() == psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return True
+
+
+def _established_connections(workers):
+    """Count the established TCP connections held by ``workers``."""
+    count = 0
+    for child in workers:
+        # psutil 6.0 renamed connections() to net_connections()
+        connections = getattr(child, 'net_connections', None) or child.connections
+        try:
+            count += sum(1 for c in connections(kind='tcp')
+                         if c.status == psutil.CONN_ESTABLISHED)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+    return count
@@ -0,0 +1,132 @@
+import collections
+import logging
+import os
+import psutil
+
+from .snapshot import ProcessTree
+
+log = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# How far the shared ratio may fall from one report to the next before we
+# warn that something has broken copy-on-write sharing.
+RATIO_DROP = 0.2
+
+ProcessMemory = collections.namedtuple('ProcessMemory', 'pid rss pss uss shared')
+ProcessMemory.__doc__ = """
+
+How much of a process's resident memory is its own (``uss``), how much it
+shares with other processes (``shared``), and its proportional share of the
+latter added to the former (``pss``), all in bytes.
+
+"""
+
+SharingReport = collections.namedtuple('SharingReport', 'master workers ratio')
+SharingReport.__doc__ = """
+
+The ProcessMemory of a master and of each of its workers, and the fraction of
+the workers' resident memory which is shared (``ratio``), or None if there
+were no workers to read.
+
+"""
+
+
+def smaps_rollup(pid, proc='/proc'):
+    """
+
+    Return a ProcessMemory for process ``pid`` from /proc/PID/smaps_rollup,
+    which the kernel sums for us, or None if it can't be read (it needs Linux
+    4.14).
+
+    """
+    fields = {}
+    try:
+        with open(os.path.join(proc, str(pid), 'smaps_rollup')) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    except (IOError, OSError, ValueError):
+        return None
+    if 'Rss' not in fields:
+        return None
+    return ProcessMemory(pid, fields['Rss'], fields.get('Pss', 0),
+                         fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0),
+                         fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0))
+
+
+def process_memory(process, proc='/proc'):
+    """
+
+    Return a ProcessMemory for ``process``, from smaps_rollup where possible
+    and otherwise from psutil's ``memory_full_info()``, which reads every
+    mapping in /proc/PID/smaps.
+
+    Raises psutil.NoSuchProcess or psutil.AccessDenied if it can't be read.
+
+    """
+    memory = smaps_rollup(process.pid, proc) if proc is not None else None
+    if memory is not None:
+        return memory
+    info = process.memory_full_info()
+    return ProcessMemory(process.pid, info.rss, getattr(info, 'pss', info.uss),
+                         info.uss, info.rss - info.uss)
+
+
+class SharingMonitor(object):
+    """
+
+    Reports how well the workers share memory with their master. An app
+    loaded before the workers are forked (``preload_app`` for unicorn,
+    ``--preload`` for gunicorn) is shared copy-on-write until the workers
+    write to it, so a deploy that makes them touch every page -- or stops the
+    app being preloaded -- can quietly multiply the memory unicorn needs.
+
+    Each ``check()`` logs the shared ratio of the workers' resident memory,
+    with the totals behind it, and warns if it has fallen by more than
+    ``drop`` since the last check.
+
+    """
+
+    def __init__(self, drop=RATIO_DROP, tree=None, proc='/proc'):
+        self.drop = drop
+        self.tree = tree
+        self.proc = proc
+        self.previous = None
+
+    def check(self, master):
+        """Read the memory of ``master`` and its workers, and log a SharingReport."""
+        tree = self.tree or ProcessTree()
+        try:
+            workers = tree.children(master)
+            master_memory = process_memory(master, self.proc)
+        except (psutil.NoSuchProcess, psutil.AccessDenied) as e:
+            log.debug('Could not read the memory of PID %s: %s', master.pid, e)
+            return None
+
+        memory = []
+        for worker in workers:
+            try:
+                memory.append(process_memory(worker, self.proc))
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+
+        rss = sum(m.rss for m in memory)
+        ratio = sum(m.shared for m in memory) / float(rss) if rss else None
+        report = SharingReport(master_memory, memory, ratio)
+        if ratio is None:
+            return report
+
+        everything = [master_memory] + memory
+        log.info('Memory sharing: pid=%s workers=%s shared_ratio=%.2f rss=%.1fMB '
+                 'pss=%.1fMB uss=%.1fMB',
+                 master.pid, len(memory), ratio,
+                 sum(m.rss for m in everything) / float(MB),
+                 sum(m.pss for m in everything) / float(MB),
+                 sum(m.uss for m in everything) / float(MB))
+        if self.previous is not None and ratio < self.previous - self.drop:
+            log.warn('Memory sharing fell: pid=%s shared_ratio=%.2f previous=%.2f',
+                     master.pid, ratio, self.previous)
+        self.previous = ratio
+        return report
@@ -0,0 +1,131 @@
+import collections
+import logging
+import os
+import psutil
+import threading
+
+log = logging.getLogger(__name__)
+
+ProcessStats = collections.namedtuple('ProcessStats', 'rss cpu_user cpu_system')
+ProcessStats.__doc__ = """
+
+The attributes of a process that the herder looks at regularly, all read at
+once.
+
+"""
+
+
+def child_pids(pid, proc='/proc'):
+    """
+
+    Return the PIDs of the direct children of process ``pid``, from
+    /proc/PID/task/TID/children, or None if the kernel doesn't provide those
+    files (it needs CONFIG_PROC_CHILDREN) or the process has gone.
+
+    Unlike ``psutil.Process.children()``, this doesn't need to read the
+    status of every process on the machine.
+
+    """
+    task_dir = os.path.join(proc, str(pid), 'task')
+    pids = []
+    try:
+        for tid in os.listdir(task_dir):
+            with open(os.path.join(task_dir, tid, 'children')) as f:
+                pids.extend(int(p) for p in f.read().split())
+    except (IOError, OSError):
+        return None
+    return pids
+
+
+class ProcessTree(object):
+    """
+
+    A snapshot of the master -> worker process tree, shared by everything in
+    the herder that looks at workers: reloads counting them, metrics, and the
+    memory guard and autoscaler. Whoever owns the tree calls ``refresh()``
+    each time round their loop, and until then every ``children()`` and
+    ``stats()`` call for the same process is answered from the snapshot.
+
+    Workers' children are found through /proc/PID/task/TID/children where
+    possible, rather than by scanning all of /proc, and the psutil.Process
+    objects for workers are kept from one snapshot to the next while the
+    worker lives.
+
+    A tree may be shared with the metrics server's thread.
+
+    """
+
+    def __init__(self, proc='/proc'):
+        self.proc = proc
+        self._children = {}
+        self._stats = {}
+        self._processes = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Forget the current snapshot, so the next calls read afresh."""
+        with self._lock:
+            self._children.clear()
+            self._stats.clear()
+
+    def forget(self, process):
+        """Drop everything held about ``process``, once it has gone."""
+        with self._lock:
+            for cache in (self._children, self._stats, self._processes):
+                cache.pop(process.pid, None)
+
+    def children(self, process):
+        """
+
+        Return the direct children of ``process``, as psutil.Process objects.
+
+        Raises psutil.NoSuchProcess if ``process`` has gone.
+
+        """
+        with self._lock:
+            children = self._children.get(process.pid)
+            if children is None:
+                children = self._read_children(process)
+                self._children[process.pid] = children
+        return list(children)
+
+    def stats(self, process):
+        """
+
+        Return a ProcessStats for ``process``, read with a single
+        ``oneshot()``.
+
+        Raises psutil.NoSuchProcess or psutil.AccessDenied if it can't be read.
+
+        """
+        with self._lock:
+            stats = self._stats.get(process.pid)
+            if stats is None:
+                with process.oneshot():
+                    cpu = process.cpu_times()
+                    stats = ProcessStats(process.memory_info().rss,
+                                         cpu.user, cpu.system)
+                self._stats[process.pid] = stats
+        return stats
+
+    def _read_children(self, process):
+        pids = None
+        if self.proc is not None:
+            pids = child_pids(process.pid, self.proc)
+        if pids is None:
+            return process.children()
+
+        # Keep the objects for children we already knew about, so that
+        # anything psutil has cached on them survives.
+        known = self._processes.get(process.pid, {})
+        children = {}
+        for pid in pids:
+            child = known.get(pid)
+            if child is None:
+                try:
+                    child = psutil.Process(pid)
+                except psutil.NoSuchProcess:
+                    continue
+            children[pid] = child
+        self._processes[process.pid] = children
+        return [children[pid] for pid in pids if pid in children]
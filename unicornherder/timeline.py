@@ -0,0 +1,106 @@
+import copy
+import json
+import logging
+import signal
+import socket
+import time
+
+from .timeout import monotonic
+
+log = logging.getLogger(__name__)
+
+SIGNAL_NAMES = dict((getattr(signal, name), name[3:]) for name in dir(signal)
+                    if name.startswith('SIG') and not name.startswith('SIG_')
+                    and name not in ('SIGIOT', 'SIGCLD', 'SIGPOLL'))
+
+
+class TimelineError(Exception):
+    pass
+
+
+class Timeline(object):
+    """
+
+    Records what happens during reloads as JSON lines, one object per event,
+    so that the time taken by each step can be analysed without scraping
+    logs. Every event has an ``event`` name, the wall-clock ``time`` and a
+    ``monotonic`` timestamp (for measuring intervals), as well as any fields
+    the timeline was created or bound with.
+
+    ``target`` is where events go: a file to append to, ``unix:PATH`` for a
+    UNIX datagram socket or ``udp:HOST:PORT``. Failing to write an event is
+    logged, but never interrupts a reload.
+
+    """
+
+    def __init__(self, target, **fields):
+        self.fields = fields
+        self.sink = _Sink(target)
+
+    def bind(self, **fields):
+        """Return a timeline writing to the same place with extra ``fields``."""
+        bound = copy.copy(self)
+        bound.fields = dict(self.fields, **fields)
+        return bound
+
+    def event(self, name, **fields):
+        record = dict(self.fields, **fields)
+        record['event'] = name
+        record['time'] = time.time()
+        record['monotonic'] = monotonic()
+        self.sink.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def close(self):
+        self.sink.close()
+
+
+class _Sink(object):
+
+    def __init__(self, target):
+        self.target = target
+        self.file = None
+        self.socket = None
+        self.address = None
+        self.failing = False
+
+        if target.startswith('unix:'):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.address = target[len('unix:'):]
+        elif target.startswith('udp:'):
+            host, _, port = target[len('udp:'):].rpartition(':')
+            try:
+                self.address = (host or '127.0.0.1', int(port))
+            except ValueError:
+                raise TimelineError('Invalid timeline address %r: expected '
+                                    'udp:HOST:PORT' % target)
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            try:
+                self.file = open(target, 'a')
+            except IOError as e:
+                raise TimelineError('Could not open timeline %s: %s' % (target, e))
+
+    def write(self, line):
+        try:
+            if self.file is not None:
+                self.file.write(line)
+                self.file.flush()
+            else:
+                self.socket.sendto(line.encode('utf-8'), self.address)
+        except (IOError, OSError, socket.error) as e:
+            # Only complain once until writes start working again.
+            if not self.failing:
+                log.warn('Could not write to reload timeline %s: %s', self.target, e)
+            self.failing = True
+            return
+        self.failing = False
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        if self.socket is not None:
+            self.socket.close()
+
+
+def signal_name(signum):
+    return SIGNAL_NAMES.get(signum, str(signum))
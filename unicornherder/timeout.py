@@ -1,18 +1,93 @@
-import contextlib
-import signal
+import time
+
+try:
+    monotonic = time.monotonic
+except AttributeError:  # Python 2
+    # time.time would jump with the system clock; setup.py installs the
+    # monotonic backport, which reads the OS's monotonic clock instead.
+    from monotonic import monotonic
 
 
 class TimeoutError(Exception):
     pass
 
 
-@contextlib.contextmanager
-def timeout(time=30):
-    def _fail(signal, frame):
-        raise TimeoutError("%s second timeout expired" % time)
+class Deadline(object):
+    """
+
+    A point in time ``seconds`` from now, measured on the monotonic clock.
+    Unlike an alarm signal, any number of deadlines can be outstanding at
+    once, and they have sub-second resolution.
+
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = monotonic() + seconds
+
+    def remaining(self):
+        return max(0, self.expires - monotonic())
+
+    def expired(self):
+        return monotonic() >= self.expires
+
+    def check(self):
+        if self.expired():
+            raise TimeoutError("%s second timeout expired" % self.seconds)
+
+
+class Timers(object):
+    """
+
+    A set of named callbacks, each due at some point on the monotonic clock.
+    The herder's main loop sleeps until the next one is due (``next_timeout``)
+    and then fires whichever have come due (``run``), which lets several
+    deadlines -- one per in-flight reload, say -- run side by side without
+    blocking each other or the handling of signals.
+
+    """
+
+    def __init__(self):
+        self._timers = {}
+
+    def __contains__(self, name):
+        return name in self._timers
+
+    def __len__(self):
+        return len(self._timers)
+
+    def set(self, name, seconds, callback):
+        """Call ``callback`` in ``seconds``, replacing any timer called ``name``."""
+        self._timers[name] = (monotonic() + seconds, callback)
+
+    def cancel(self, name):
+        self._timers.pop(name, None)
+
+    def next_timeout(self, default=None):
+        """
+
+        Return the number of seconds until the next timer is due, or
+        ``default`` if that is sooner (or there are no timers).
+
+        """
+        if not self._timers:
+            return default
+        now = monotonic()
+        soonest = max(0, min(e for e, _ in self._timers.values()) - now)
+        if default is None:
+            return soonest
+        return min(soonest, default)
 
-    signal.signal(signal.SIGALRM, _fail)
-    signal.alarm(time)
-    yield
-    signal.alarm(0)
-    signal.signal(signal.SIGALRM, signal.SIG_DFL)
+    def run(self):
+        """Fire every timer which has come due."""
+        now = monotonic()
+        due = [(expires, name) for name, (expires, _) in self._timers.items()
+               if expires <= now]
+        for expires, name in sorted(due, key=lambda d: d[0]):
+            timer = self._timers.get(name)
+            # A callback we've already run may have cancelled or rescheduled
+            # this timer.
+            if timer is None or timer[0] != expires:
+                continue
+            del self._timers[name]
+            timer[1]()
@@ -0,0 +1,213 @@
+import collections
+import logging
+import socket
+import threading
+
+try:
+    import queue
+    from http.client import HTTPConnection, HTTPException
+    from urllib.parse import urlparse
+except ImportError:  # Python 2
+    import Queue as queue
+    from httplib import HTTPConnection, HTTPException
+    from urlparse import urlparse
+
+from .timeout import monotonic
+
+log = logging.getLogger(__name__)
+
+# How long a single warm-up request may take
+REQUEST_TIMEOUT = 5
+
+# Which percentile of a round's latencies has to settle
+PERCENTILE = 0.9
+
+WarmupRequest = collections.namedtuple('WarmupRequest', 'method path')
+
+
+class WarmupError(Exception):
+    pass
+
+
+def load_requests(filename):
+    """
+
+    Read warm-up requests from ``filename``, one per line: a path, or a
+    method and a path, such as ``GET /products?page=2``. Blank lines and lines
+    starting with # are ignored.
+
+    """
+    requests = []
+    try:
+        with open(filename) as f:
+            for number, line in enumerate(f, 1):
+                words = line.split()
+                if not words or words[0].startswith('#'):
+                    continue
+                if len(words) == 1:
+                    words.insert(0, 'GET')
+                if len(words) != 2 or not words[1].startswith('/'):
+                    raise WarmupError('Invalid warm-up request on line %s of %s: %r'
+                                      % (number, filename, line.strip()))
+                requests.append(WarmupRequest(words[0].upper(), words[1]))
+    except IOError as e:
+        raise WarmupError('Could not read warm-up requests from %s: %s' % (filename, e))
+    if not requests:
+        raise WarmupError('No warm-up requests in %s' % filename)
+    return requests
+
+
+def parse_target(spec):
+    """
+
+    Parse where to send warm-up requests, ``http://HOST:PORT`` or
+    ``unix:///PATH``, into a (family, address) pair.
+
+    """
+    url = urlparse(spec)
+    if url.scheme == 'http':
+        try:
+            port = url.port or 80
+        except ValueError:
+            port = None
+        if not url.hostname or port is None:
+            raise WarmupError('Warm-up target needs a host and port: %s' % spec)
+        return ('tcp', (url.hostname, port))
+    if url.scheme == 'unix':
+        if not url.path:
+            raise WarmupError('Warm-up target needs a path: %s' % spec)
+        return ('unix', url.path)
+    raise WarmupError('Unknown warm-up target: %s' % spec)
+
+
+def describe_target(target):
+    family, address = target
+    if family == 'unix':
+        return 'unix://%s' % address
+    return 'http://%s:%s' % address
+
+
+class Warmup(object):
+    """
+
+    Replays a list of requests against a freshly started master, so that its
+    workers fill their caches, finish importing code and so on before they
+    take all the traffic.
+
+    Each ``start()`` begins a WarmupRound, which sends every request once,
+    ``concurrency`` at a time. Requests go to ``target``, a (family, address)
+    pair from ``parse_target()``, which has to be somewhere only the new
+    master listens: on a socket shared with the old master, its warm workers
+    would answer most of them. Warm-up is over once a round completes without
+    errors and its 90th percentile latency is no more than ``latency``
+    seconds.
+
+    """
+
+    def __init__(self, requests, target, concurrency=4, latency=0.1):
+        self.requests = requests
+        self.target = target
+        self.concurrency = concurrency
+        self.latency = latency
+
+    def start(self):
+        return WarmupRound(self.requests, self.target, self.concurrency)
+
+    def settled(self, round):
+        return round.errors == 0 and round.latency <= self.latency
+
+    def __str__(self):
+        return '%s warm-up requests' % len(self.requests)
+
+
+class WarmupRound(object):
+    """
+
+    One pass over the warm-up requests, sent from ``concurrency`` background
+    threads so that the herder's loop never waits on them. Poll ``done()``,
+    then read ``latency`` and ``errors``.
+
+    """
+
+    def __init__(self, requests, target, concurrency):
+        self.target = target
+        self.latencies = []
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        for request in requests:
+            self.pending.put(request)
+        self.remaining = len(requests)
+        self.finished = threading.Event()
+        if not requests:
+            self.finished.set()
+
+        for _ in range(max(min(concurrency, len(requests)), 1)):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+    def done(self):
+        return self.finished.is_set()
+
+    @property
+    def latency(self):
+        """The 90th percentile latency of the round, in seconds."""
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * PERCENTILE), len(latencies) - 1)]
+
+    def _run(self):
+        while True:
+            try:
+                request = self.pending.get_nowait()
+            except queue.Empty:
+                return
+            ok, seconds = _send(self.target, request)
+            with self.lock:
+                if ok:
+                    self.latencies.append(seconds)
+                else:
+                    self.errors += 1
+                self.remaining -= 1
+                if self.remaining == 0:
+                    self.finished.set()
+
+
+class _UnixHTTPConnection(HTTPConnection):
+
+    def __init__(self, path, timeout):
+        HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+def _send(target, request):
+    """Send ``request``, returning whether it succeeded and how long it took."""
+    family, address = target
+    if family == 'unix':
+        conn = _UnixHTTPConnection(address, REQUEST_TIMEOUT)
+    else:
+        conn = HTTPConnection(address[0], address[1], timeout=REQUEST_TIMEOUT)
+    started = monotonic()
+    try:
+        conn.request(request.method, request.path,
+                     headers={'User-Agent': 'unicornherder-warmup'})
+        response = conn.getresponse()
+        response.read()
+        status = response.status
+    except (HTTPException, socket.error) as e:
+        log.debug('Warm-up request %s %s failed: %s', request.method, request.path, e)
+        return False, None
+    finally:
+        conn.close()
+    if status >= 500:
+        log.debug('Warm-up request %s %s failed with status %s',
+                  request.method, request.path, status)
+        return False, None
+    return True, monotonic() - started
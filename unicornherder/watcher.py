@@ -0,0 +1,151 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+
+
+log = logging.getLogger(__name__)
+
+# Constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# We deliberately don't watch IN_CREATE or IN_MODIFY: a pidfile which has just
+# been created may not have been written yet, and we'd rather wake up once the
+# writer has closed it (or renamed it into place).
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class WatcherError(OSError):
+    pass
+
+
+class PollWatcher(object):
+    """
+
+    Fallback watcher for platforms without inotify. It has no file descriptor
+    to wait on, so a Waiter holding it simply sleeps for the full timeout,
+    and the herder polls the pidfile.
+
+    """
+
+    def __init__(self, filenames):
+        self.filenames = filenames
+
+    def fileno(self):
+        return None
+
+    def read(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+
+    Watches the directory containing a set of pidfiles using inotify, so that
+    the herder can react to a master rewriting (or removing) its pidfile
+    immediately, rather than on its next polling tick.
+
+    """
+
+    def __init__(self, filenames):
+        self.filenames = filenames
+        self.names = set(os.path.basename(f) for f in filenames)
+        self.directory = os.path.dirname(os.path.abspath(filenames[0]))
+
+        libc = _libc()
+        if libc is None or not hasattr(libc, 'inotify_init1'):
+            raise WatcherError(errno.ENOSYS, 'inotify is not available')
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise WatcherError(err, os.strerror(err))
+
+        wd = libc.inotify_add_watch(self.fd,
+                                    self.directory.encode('utf-8'),
+                                    WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise WatcherError(err, '%s: %s' % (os.strerror(err), self.directory))
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """
+
+        Drain pending inotify events. Returns True if any of them concerned
+        one of the watched pidfiles.
+
+        """
+        changed = False
+        while True:
+            try:
+                buf = os.read(self.fd, 4096)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not buf:
+                break
+            for name in _parse_events(buf):
+                if name in self.names:
+                    changed = True
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def watch(filenames):
+    """
+
+    Return the best available watcher for the given pidfiles: an
+    InotifyWatcher where the platform supports it, and a PollWatcher
+    otherwise.
+
+    """
+    try:
+        return InotifyWatcher(filenames)
+    except (OSError, AttributeError) as e:
+        log.debug('Unable to watch pidfiles with inotify (%s), falling back '
+                  'to polling', e)
+        return PollWatcher(filenames)
+
+
+def _parse_events(buf):
+    offset = 0
+    while offset + _EVENT_HEADER.size <= len(buf):
+        _, _, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+        offset += _EVENT_HEADER.size
+        name = buf[offset:offset + length].rstrip(b'\0')
+        offset += length
+        yield name.decode('utf-8', 'replace')
+
+
+_LIBC = []
+
+
+def _libc():
+    if not _LIBC:
+        name = ctypes.util.find_library('c')
+        try:
+            _LIBC.append(ctypes.CDLL(name, use_errno=True) if name else None)
+        except OSError:
+            _LIBC.append(None)
+    return _LIBC[0]